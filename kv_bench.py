@@ -0,0 +1,1737 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Simple Persistent Key-Value Store.
+
+Everything runs locally against a temporary directory, so it is safe to run
+anywhere. Each benchmark is a subcommand:
+
+    python kv_bench.py scan --records 10000000
+    python kv_bench.py loadgen --connections 1,16,64
+    python kv_bench.py index-memory --keys 1000000,10000000
+    python kv_bench.py --json results.json ycsb --workload all
+    python kv_bench.py stress --readers 1,2,4,8 --writers 2
+    python kv_bench.py shard --shards 1,2,4,8,16,32
+    python kv_bench.py large-value --sizes-mb 64,256,1024
+    python kv_bench.py lsm --memory-mb 64 --ratio 10
+    python kv_bench.py replica --followers 1,2,4
+    python kv_bench.py lazy-start --log-mb 256
+    python kv_bench.py compression --keys 200000 --value-size 200
+
+It is also a module: Workload, WORKLOADS, load_store(), run_api() and
+run_repl() can drive a store from other scripts.
+
+Benchmarks:
+- scan: records per second scanned by the recovery parser, comparing the
+  original read/seek loop with the mmap-based scan_segment()
+- loadgen: throughput and p50/p99 latency of kv_server.py as the number of
+  concurrent connections grows. It starts its own server on a temporary
+  data file unless --port points at a running one.
+- index-memory: resident bytes per key of the dict index vs. CompactIndex.
+  Every measurement runs in a fresh process; 50M keys with the dict engine
+  needs well over 10GB of RAM.
+- ycsb: YCSB-style workloads (read-heavy, update-heavy, write-heavy,
+  zipfian, large-values, cold-start, recovery) through the Python API or
+  the REPL. Reports throughput, p50/p99/p999 latency, fsyncs per second,
+  log size against live data and recovery time.
+- stress: N reader threads and M writer threads on one store. Every value
+  encodes its key and version with a checksum, so readers detect torn or
+  misattributed reads and versions going backwards. Reports read and write
+  throughput as the reader count grows, optionally with compaction running.
+  Under CPython's GIL reads only scale as far as the time spent in pread
+  (which releases it), and busy readers slow down the writer/flusher
+  hand-offs, so expect write throughput to drop as readers are added.
+- shard: MSET/MGET throughput of kv_shard.ShardedKVStore as the number of
+  shard processes grows, with client threads sending batches of keys.
+  First it splits and reshards a store with large, binary and TTL values
+  and checks that every key ends up intact in the shard that owns it.
+- large-value: writes one value of each size with set_stream() and reads it
+  back with get_stream() (readinto into a reused buffer, and sendfile() to a
+  socket), reporting MB/s and the peak RSS growth of each phase. The RSS
+  growth should stay flat as the value grows; --compare-get adds a
+  get_bytes() read, which holds the whole value. First it writes values
+  right at the single-record size limit, with and without a TTL, and checks
+  that all of them survive a reopen without the hint file.
+- lsm: loads kv_lsm.LSMKVStore with a keyspace --ratio times larger than
+  --memory-mb, reopens it and checks that its resident memory (memtable,
+  block indexes and bloom filters) stays within --memory-mb. Then it drops
+  the tables from the OS page cache (posix_fadvise, where available) and
+  measures GET latency for random existing keys and for missing keys,
+  with the blocks read per GET; misses should almost never touch disk.
+- replica: a primary taking MSET batches with 1, 2, 4... followers
+  (kv_replica.py) tailing its log. Reports the followers' lag in bytes and
+  milliseconds, how long they take to catch up once writes stop, whether
+  their values match the primary's, and how many bytes a restarted
+  follower copies (only what it missed, not the whole log).
+- lazy-start: opens a synthetic log without a hint eagerly and with
+  lazy_recovery, reporting the eager open time against the lazy time to
+  the first GET, GET/SET latency while the background replay runs (GETs for
+  keys not replayed yet, and for missing keys, search the log tail), how
+  long the replay takes and GET latency afterwards. Every value read is
+  checked.
+- compression: loads the same JSON-like documents with compression off,
+  zlib, lzma and zlib with a dictionary trained from a sample of them.
+  Reports the compacted log size, the compression ratio against the off
+  run, load throughput and GET p50/p99 (value cache off), and checks every
+  value read.
+"""
+
+import sys
+import os
+import time
+import json
+import random
+import itertools
+import threading
+import asyncio
+import argparse
+import tempfile
+import socket
+import zlib
+import subprocess
+import multiprocessing
+import concurrent.futures
+import io
+from typing import Optional, List, Dict, Tuple
+
+from kv_store import SimpleKVStore, scan_segment, HEADER_SIZE, DURABILITY_MODES, READ_MODES, \
+    MAX_VALUE_LENGTH, MAX_TTL_VALUE_LENGTH
+from kv_index import IndexEntry, CompactIndex, INDEX_ENGINES
+from kv_shard import ShardedKVStore, split_store, reshard, shard_of, shard_path
+from kv_lsm import LSMKVStore
+from kv_replica import ReplicaKVStore
+
+
+def write_synthetic_log(path: str, records: int, key_count: Optional[int] = None,
+                        value_size: int = 32) -> int:
+    """
+    Write a log of `records` SET records straight in the on-disk format.
+
+    I build the file in large buffers instead of going through
+    SimpleKVStore.set, so generating millions of records takes seconds
+    rather than one fsync per record.
+
+    Args:
+        path: File to create
+        records: Number of records to write
+        key_count: Number of distinct keys (default: one key per record)
+        value_size: Size of every value in bytes
+
+    Returns:
+        The size of the file in bytes
+    """
+    key_count = key_count or records
+    value = b"v" * value_size
+    value_len = len(value).to_bytes(4, 'big')
+    with open(path, 'wb', buffering=8 * 1024 * 1024) as out:
+        batch = []
+        for i in range(records):
+            key = b"key%d" % (i % key_count)
+            batch.append(len(key).to_bytes(4, 'big') + value_len + key + value)
+            if len(batch) == 65536:
+                out.write(b''.join(batch))
+                batch.clear()
+        out.write(b''.join(batch))
+    return os.path.getsize(path)
+
+
+def legacy_scan(path: str) -> int:
+    """
+    The original recovery loop: three read() calls and one seek() per record.
+
+    I keep it here only as the "before" side of the scan benchmark.
+
+    Returns:
+        The number of records scanned
+    """
+    index = {}
+    count = 0
+    with open(path, 'rb') as file_handle:
+        while True:
+            offset = file_handle.tell()
+            key_len_bytes = file_handle.read(4)
+            if len(key_len_bytes) < 4:
+                break
+            key_len = int.from_bytes(key_len_bytes, 'big')
+            val_len_bytes = file_handle.read(4)
+            if len(val_len_bytes) < 4:
+                break
+            val_len = int.from_bytes(val_len_bytes, 'big')
+            key_bytes = file_handle.read(key_len)
+            if len(key_bytes) < key_len:
+                break
+            key = key_bytes.decode('utf-8')
+            file_handle.seek(val_len, 1)
+            index[key] = (offset + HEADER_SIZE + key_len, val_len)
+            count += 1
+    return count
+
+
+def bench_scan(args: argparse.Namespace) -> Dict[str, object]:
+    """
+    Compare the legacy recovery loop with scan_segment() on one synthetic log.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "data.db")
+        print(f"Writing {args.records} records...", file=sys.stderr, flush=True)
+        size = write_synthetic_log(path, args.records, args.keys, args.value_size)
+
+        result: Dict[str, object] = {"records": args.records, "log_bytes": size}
+        if not args.skip_legacy:
+            started = time.perf_counter()
+            count = legacy_scan(path)
+            elapsed = time.perf_counter() - started
+            result["legacy_seconds"] = elapsed
+            result["legacy_records_per_s"] = count / elapsed
+
+        started = time.perf_counter()
+        records, valid_end = scan_segment(path)
+        elapsed = time.perf_counter() - started
+        if valid_end != size:
+            raise RuntimeError(f"scan stopped at {valid_end} of {size} bytes")
+        result["scan_seconds"] = elapsed
+        result["scan_records_per_s"] = args.records / elapsed
+        result["unique_keys"] = len(records)
+        if "legacy_seconds" in result:
+            result["speedup"] = result["legacy_seconds"] / elapsed
+    return result
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """
+    The value at `fraction` (0..1) of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def start_server(data_file: str, extra: Optional[List[str]] = None) -> Tuple[subprocess.Popen, int]:
+    """
+    Start kv_server.py on a free port and wait until it listens.
+
+    Returns:
+        (the server process, the port it listens on)
+    """
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kv_server.py")
+    process = subprocess.Popen([sys.executable, server, "--port", "0", "--data-file", data_file]
+                               + (extra or []),
+                               stderr=subprocess.PIPE, text=True)
+    for line in process.stderr:
+        if line.startswith("Listening on "):
+            return process, int(line.rsplit(":", 1)[1])
+    raise RuntimeError("kv_server.py exited before it started listening")
+
+
+async def _loadgen_connection(host: str, port: int, args: argparse.Namespace,
+                              latencies: List[float], seed: int) -> int:
+    """
+    One client connection: send `args.requests` commands in pipelined
+    batches of `args.pipeline` and time each batch round trip.
+
+    Every command in a batch is charged the batch's round trip, which is
+    the latency its caller would see.
+
+    Returns:
+        The number of commands completed
+    """
+    rng = random.Random(seed)
+    value = "v" * args.value_size
+    reader, writer = await asyncio.open_connection(host, port)
+    done = 0
+    while done < args.requests:
+        count = min(args.pipeline, args.requests - done)
+        commands = []
+        for _ in range(count):
+            key = rng.randrange(args.keys)
+            if rng.random() < args.set_ratio:
+                commands.append(f"SET key{key} {value}\n")
+            else:
+                commands.append(f"GET key{key}\n")
+        started = time.perf_counter()
+        writer.write("".join(commands).encode('utf-8'))
+        await writer.drain()
+        for _ in range(count):
+            await reader.readline()
+        elapsed = time.perf_counter() - started
+        latencies.extend([elapsed] * count)
+        done += count
+    writer.write(b"EXIT\n")
+    writer.close()
+    return done
+
+
+async def _loadgen_run(host: str, port: int, connections: int,
+                       args: argparse.Namespace) -> Dict[str, object]:
+    """
+    Drive `connections` concurrent clients and summarize their latencies.
+    """
+    latencies: List[float] = []
+    started = time.perf_counter()
+    counts = await asyncio.gather(*(_loadgen_connection(host, port, args, latencies, seed)
+                                    for seed in range(connections)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "connections": connections,
+        "commands": sum(counts),
+        "seconds": elapsed,
+        "ops_per_s": sum(counts) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "p999_ms": percentile(latencies, 0.999) * 1000,
+    }
+
+
+def bench_loadgen(args: argparse.Namespace) -> Dict[str, object]:
+    """
+    Measure kv_server.py throughput and latency at each connection count.
+    """
+    levels = [int(level) for level in args.connections.split(",")]
+    result: Dict[str, object] = {"pipeline": args.pipeline, "set_ratio": args.set_ratio,
+                                 "value_size": args.value_size, "runs": []}
+    with tempfile.TemporaryDirectory() as directory:
+        process = None
+        port = args.port
+        if port is None:
+            process, port = start_server(os.path.join(directory, "data.db"),
+                                         ["--durability", args.durability])
+            result["durability"] = args.durability
+        try:
+            for connections in levels:
+                print(f"{connections} connections...", file=sys.stderr, flush=True)
+                result["runs"].append(asyncio.run(_loadgen_run(args.host, port, connections, args)))
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+    return result
+
+
+def rss_bytes() -> int:
+    """
+    Resident set size of this process.
+
+    I read /proc where it exists (current RSS). Elsewhere I fall back to
+    the peak RSS from getrusage, which is still fine for a fresh process
+    that only grows.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _build_index(engine: str, keys: int, key_size: int) -> Tuple[int, float]:
+    """
+    Fill a fresh index with `keys` synthetic entries (runs in a child process).
+
+    Returns:
+        (RSS growth in bytes, build time in seconds)
+    """
+    import gc
+    gc.collect()
+    before = rss_bytes()
+    started = time.perf_counter()
+    index = INDEX_ENGINES[engine]()
+    if isinstance(index, CompactIndex):
+        index.reserve(keys)  # what _rebuild_index does before a bulk load
+    width = max(1, key_size - 4)
+    for i in range(keys):
+        index[f"key:{i:0{width}d}"] = IndexEntry(i * 64, 32, i >> 20)
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    return rss_bytes() - before, elapsed
+
+
+def bench_index_memory(args: argparse.Namespace) -> Dict[str, object]:
+    """
+    Compare bytes per key of each index engine at several keyspace sizes.
+    """
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    for keys in (int(count) for count in args.keys.split(",")):
+        for engine in args.engines.split(","):
+            print(f"{engine}: {keys} keys...", file=sys.stderr, flush=True)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                used, elapsed = pool.submit(_build_index, engine, keys, args.key_size).result()
+            runs.append({"engine": engine, "keys": keys, "bytes": used,
+                         "bytes_per_key": used / keys, "build_seconds": elapsed})
+    return {"key_size": args.key_size, "runs": runs}
+
+
+class ZipfianGenerator:
+    """
+    Zipfian key chooser, the algorithm YCSB uses (Gray et al., "Quickly
+    Generating Billion-Record Synthetic Databases").
+
+    Rank 0 is the hottest item. I scatter ranks over the keyspace with a
+    multiplicative hash so the hot keys aren't all neighbours in the log.
+    """
+
+    def __init__(self, items: int, theta: float = 0.99, rng: Optional[random.Random] = None) -> None:
+        self.items = items
+        self.theta = theta
+        self.rng = rng or random.Random()
+        self.zeta_n = sum(1.0 / (i ** theta) for i in range(1, items + 1))
+        zeta_2 = 1.0 + 0.5 ** theta
+        self.alpha = 1.0 / (1.0 - theta)
+        self.eta = (1.0 - (2.0 / items) ** (1.0 - theta)) / (1.0 - zeta_2 / self.zeta_n)
+
+    def next(self) -> int:
+        u = self.rng.random()
+        uz = u * self.zeta_n
+        if uz < 1.0:
+            rank = 0
+        elif uz < 1.0 + 0.5 ** self.theta:
+            rank = 1
+        else:
+            rank = int(self.items * (self.eta * u - self.eta + 1.0) ** self.alpha)
+        return (min(rank, self.items - 1) * 2654435761) % self.items
+
+
+class Workload:
+    """
+    One YCSB-style workload: a load phase of `records` keys, then
+    `operations` reads and updates picked by `read_ratio` and `distribution`.
+    """
+
+    def __init__(self, name: str, read_ratio: float = 0.5, distribution: str = "uniform",
+                 records: int = 100_000, operations: int = 100_000, value_size: int = 100) -> None:
+        self.name = name
+        self.read_ratio = read_ratio
+        self.distribution = distribution
+        self.records = records
+        self.operations = operations
+        self.value_size = value_size
+
+
+# The standard mixes. cold-start and recovery reuse these fields for the
+# log they build, but measure opening the store rather than a run phase.
+WORKLOADS = {
+    "read-heavy": dict(read_ratio=0.95),
+    "update-heavy": dict(read_ratio=0.5),
+    "write-heavy": dict(read_ratio=0.05),
+    "zipfian": dict(read_ratio=0.9, distribution="zipfian"),
+    "large-values": dict(read_ratio=0.5, records=2_000, operations=2_000, value_size=64 * 1024),
+    "cold-start": dict(read_ratio=1.0, operations=10_000),
+    "recovery": dict(read_ratio=0.0),
+}
+
+
+class FsyncCounter:
+    """
+    Count os.fsync calls made in this process while the context is active.
+    """
+
+    def __enter__(self) -> "FsyncCounter":
+        self._calls = itertools.count()
+        self._fsync = os.fsync
+
+        def counting_fsync(fd: int) -> None:
+            next(self._calls)
+            self._fsync(fd)
+        os.fsync = counting_fsync
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        os.fsync = self._fsync
+
+    @property
+    def count(self) -> int:
+        # next() returns how many calls came before it, but also counts
+        # itself, so I only read this once, at the end
+        return next(self._calls)
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, float]:
+    """
+    p50/p99/p999 (in milliseconds) and count of a list of latencies in seconds.
+    """
+    latencies = sorted(latencies)
+    return {"count": len(latencies),
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "p999_ms": percentile(latencies, 0.999) * 1000}
+
+
+def _key_chooser(workload: Workload, rng: random.Random):
+    if workload.distribution == "zipfian":
+        return ZipfianGenerator(workload.records, rng=rng).next
+    return lambda: rng.randrange(workload.records)
+
+
+def _operations(workload: Workload, count: int, seed: int):
+    """
+    Yield (is_read, key) for `count` operations of the workload's mix.
+    """
+    rng = random.Random(seed)
+    choose = _key_chooser(workload, rng)
+    for _ in range(count):
+        yield rng.random() < workload.read_ratio, b"key%d" % choose()
+
+
+def load_store(store: SimpleKVStore, workload: Workload, batch: int = 1000) -> float:
+    """
+    Load phase: write every key once through mset(). Returns the seconds taken.
+    """
+    value = "v" * workload.value_size
+    started = time.perf_counter()
+    for first in range(0, workload.records, batch):
+        store.mset((f"key{i}", value) for i in range(first, min(first + batch, workload.records)))
+    return time.perf_counter() - started
+
+
+def run_api(store: SimpleKVStore, workload: Workload, threads: int = 1) -> Dict[str, object]:
+    """
+    Run phase through SimpleKVStore.get/set, on `threads` threads.
+
+    Returns:
+        Throughput, per-operation latency summaries and fsyncs per second
+    """
+    value = "u" * workload.value_size
+    per_thread = workload.operations // threads
+    reads: List[List[float]] = [[] for _ in range(threads)]
+    updates: List[List[float]] = [[] for _ in range(threads)]
+
+    def worker(number: int) -> None:
+        clock = time.perf_counter
+        for is_read, key in _operations(workload, per_thread, seed=number):
+            key = key.decode()
+            started = clock()
+            if is_read:
+                store.get(key)
+                reads[number].append(clock() - started)
+            else:
+                store.set(key, value)
+                updates[number].append(clock() - started)
+
+    with FsyncCounter() as fsyncs:
+        started = time.perf_counter()
+        pool = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        fsync_count = fsyncs.count
+    return {"seconds": elapsed,
+            "ops_per_s": per_thread * threads / elapsed,
+            "read": latency_summary([t for part in reads for t in part]),
+            "update": latency_summary([t for part in updates for t in part]),
+            "fsyncs_per_s": fsync_count / elapsed}
+
+
+def run_repl(data_file: str, workload: Workload, store_args: List[str]) -> Dict[str, object]:
+    """
+    Run phase through the stdin/stdout REPL of kv_store.py in a subprocess,
+    one command per round trip - what a client of `python kv_store.py` sees.
+
+    fsyncs happen in the child, so I can't count them here.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kv_store.py")
+    process = subprocess.Popen([sys.executable, script, "--data-file", data_file] + store_args,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    value = b"u" * workload.value_size
+    reads: List[float] = []
+    updates: List[float] = []
+    send = process.stdin
+    receive = process.stdout
+    clock = time.perf_counter
+    started = clock()
+    for is_read, key in _operations(workload, workload.operations, seed=0):
+        command = b"GET %s\n" % key if is_read else b"SET %s %s\n" % (key, value)
+        sent = clock()
+        send.write(command)
+        send.flush()
+        receive.readline()
+        (reads if is_read else updates).append(clock() - sent)
+    elapsed = clock() - started
+    send.write(b"EXIT\n")
+    send.close()
+    process.wait()
+    return {"seconds": elapsed,
+            "ops_per_s": workload.operations / elapsed,
+            "read": latency_summary(reads),
+            "update": latency_summary(updates),
+            "fsyncs_per_s": None}
+
+
+def time_open(data_file: str, **options) -> float:
+    """
+    Seconds to open (recover) and close a store on an existing log.
+    """
+    started = time.perf_counter()
+    store = SimpleKVStore(data_file, **options)
+    elapsed = time.perf_counter() - started
+    store.close()
+    return elapsed
+
+
+def space_usage(data_file: str) -> Dict[str, object]:
+    """
+    Log size on disk against the bytes the index still points to.
+    """
+    store = SimpleKVStore(data_file, compact_dead_ratio=None)
+    try:
+        stats = store.compaction_stats()
+    finally:
+        store.close()
+    return {"log_bytes": stats["log_bytes"], "live_bytes": stats["live_bytes"],
+            "space_amplification": stats["log_bytes"] / max(1, stats["live_bytes"])}
+
+
+def run_cold_start(directory: str, workload: Workload, log_bytes: int,
+                   store_options: Dict[str, object]) -> Dict[str, object]:
+    """
+    Build a log of about `log_bytes` bytes (with every key written several
+    times), then time recovery and the first reads against it.
+    """
+    record_size = HEADER_SIZE + len(b"key%d" % workload.records) + workload.value_size
+    records = max(workload.records, log_bytes // record_size)
+    data_file = os.path.join(directory, "cold.db")
+    print(f"Writing a {records * record_size / 1e9:.2f}GB log...", file=sys.stderr, flush=True)
+    size = write_synthetic_log(data_file, records, workload.records, workload.value_size)
+
+    started = time.perf_counter()
+    store = SimpleKVStore(data_file, use_hint=False, compact_dead_ratio=None, **store_options)
+    recovery = time.perf_counter() - started
+    try:
+        reads: List[float] = []
+        clock = time.perf_counter
+        for _, key in _operations(workload, workload.operations, seed=0):
+            key = key.decode()
+            sent = clock()
+            store.get(key)
+            reads.append(clock() - sent)
+    finally:
+        store.close()
+    return {"log_bytes": size, "records": records, "recovery_s": recovery,
+            "first_reads_ops_per_s": len(reads) / max(sum(reads), 1e-9),
+            "read": latency_summary(reads)}
+
+
+def bench_ycsb(args: argparse.Namespace) -> Dict[str, object]:
+    """
+    Run one or all YCSB-style workloads against a temporary store.
+    """
+    names = list(WORKLOADS) if args.workload == "all" else [args.workload]
+    store_options = {"durability": args.durability, "read_mode": args.read_mode,
+                     "cache_bytes": args.cache_bytes}
+    store_args = ["--durability", args.durability, "--read-mode", args.read_mode,
+                  "--cache-bytes", str(args.cache_bytes)]
+    results = []
+    for name in names:
+        preset = dict(WORKLOADS[name])
+        for field in ("records", "operations", "value_size", "read_ratio", "distribution"):
+            if getattr(args, field) is not None:
+                preset[field] = getattr(args, field)
+        workload = Workload(name, **preset)
+        print(f"{name}...", file=sys.stderr, flush=True)
+
+        result: Dict[str, object] = {"workload": name, "driver": args.driver,
+                                     **{field: getattr(workload, field) for field in
+                                        ("records", "operations", "value_size",
+                                         "read_ratio", "distribution")},
+                                     **store_options}
+        with tempfile.TemporaryDirectory() as directory:
+            if name == "cold-start":
+                result.update(run_cold_start(directory, workload,
+                                             int(args.log_gb * 1e9), store_options))
+                results.append(result)
+                continue
+
+            data_file = os.path.join(directory, "data.db")
+            store = SimpleKVStore(data_file, **store_options)
+            try:
+                result["load_seconds"] = load_store(store, workload)
+                if name == "recovery":
+                    # Overwrite every key so recovery has dead records to skip
+                    load_store(store, workload)
+                elif args.driver == "api":
+                    result.update(run_api(store, workload, args.threads))
+            finally:
+                store.close()
+            if args.driver == "repl" and name != "recovery":
+                result.update(run_repl(data_file, workload, store_args))
+
+            result.update(space_usage(data_file))
+            result["recovery_s"] = {
+                "hint": time_open(data_file),
+                "full_replay": time_open(data_file, use_hint=False),
+            }
+        results.append(result)
+    return {"runs": results}
+
+
+def stress_value(key: str, version: int, size: int) -> str:
+    """
+    The value a stress writer stores: "<key>|<version>|" padded to `size`
+    with a checksum of the prefix, so a reader can tell a whole value from
+    a torn one or one that belongs to another key.
+    """
+    prefix = f"{key}|{version}|"
+    filler = "%08x" % zlib.crc32(prefix.encode())
+    return prefix + filler * (max(0, size - len(prefix)) // 8 + 1)
+
+
+def check_stress_value(key: str, value: Optional[str], size: int) -> int:
+    """
+    The version encoded in a stress value, or -1 if the value is missing,
+    torn or for another key.
+    """
+    if value is None:
+        return -1
+    parts = value.split("|", 2)
+    if len(parts) != 3 or parts[0] != key or not parts[1].isdigit():
+        return -1
+    version = int(parts[1])
+    return version if value == stress_value(key, version, size) else -1
+
+
+def run_stress(store: SimpleKVStore, readers: int, writers: int, keys: int,
+               seconds: float, value_size: int, compact: bool = False) -> Dict[str, object]:
+    """
+    Hammer one store with reader and writer threads for `seconds`.
+
+    Writer w owns the keys i with i % writers == w and writes each with an
+    increasing version, so every key has a single writer and its versions
+    only ever go up. Each reader remembers the last version it saw per key;
+    seeing an older one afterwards means a GET returned a stale entry.
+
+    Args:
+        store: A store already holding version 0 of every key
+        readers: Reader threads calling get()
+        writers: Writer threads calling set()
+        keys: Keys key0..key{keys-1}
+        seconds: How long to run
+        value_size: Bytes per value
+        compact: Also run compact() in a loop, so reads overlap file swaps
+
+    Returns:
+        Read/write throughput, read latency, torn and stale read counts
+    """
+    writers = min(writers, keys)
+    stop = threading.Event()
+    reads = [0] * readers
+    writes = [0] * writers
+    torn = [0] * readers
+    stale = [0] * readers
+    latencies: List[List[float]] = [[] for _ in range(readers)]
+    compactions = [0]
+
+    def reader(number: int) -> None:
+        rng = random.Random(number)
+        seen: Dict[int, int] = {}
+        clock = time.perf_counter
+        sample = latencies[number]
+        while not stop.is_set():
+            i = rng.randrange(keys)
+            key = f"key{i}"
+            started = clock()
+            value = store.get(key)
+            if reads[number] % 16 == 0:
+                sample.append(clock() - started)
+            reads[number] += 1
+            version = check_stress_value(key, value, value_size)
+            if version < 0:
+                torn[number] += 1
+            elif version < seen.get(i, 0):
+                stale[number] += 1
+            else:
+                seen[i] = version
+
+    def writer(number: int) -> None:
+        rng = random.Random(-1 - number)
+        owned = list(range(number, keys, writers))
+        versions = dict.fromkeys(owned, 0)
+        while not stop.is_set():
+            i = rng.choice(owned)
+            versions[i] += 1
+            key = f"key{i}"
+            store.set(key, stress_value(key, versions[i], value_size))
+            writes[number] += 1
+
+    def compactor() -> None:
+        while not stop.is_set():
+            store.compact(wait=True)
+            compactions[0] += 1
+
+    threads = [threading.Thread(target=reader, args=(n,)) for n in range(readers)]
+    threads += [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    if compact:
+        threads.append(threading.Thread(target=compactor))
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    stop.wait(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {"readers": readers, "writers": writers,
+            "reads_per_s": sum(reads) / elapsed,
+            "writes_per_s": sum(writes) / elapsed,
+            "read": latency_summary([t for part in latencies for t in part]),
+            "torn_reads": sum(torn), "stale_reads": sum(stale),
+            "compactions": compactions[0]}
+
+
+def bench_stress(args: argparse.Namespace) -> Dict[str, object]:
+    """
+    run_stress() for each reader count, each on a fresh temporary store.
+    """
+    store_options = {"durability": args.durability, "read_mode": args.read_mode,
+                     "index_engine": args.index_engine, "cache_bytes": args.cache_bytes,
+                     "segment_max_bytes": args.segment_bytes}
+    results = []
+    for readers in [int(n) for n in args.readers.split(",")]:
+        print(f"{readers} readers, {args.writers} writers...", file=sys.stderr, flush=True)
+        with tempfile.TemporaryDirectory() as directory:
+            store = SimpleKVStore(os.path.join(directory, "data.db"), **store_options)
+            try:
+                for first in range(0, args.keys, 1000):
+                    store.mset((f"key{i}", stress_value(f"key{i}", 0, args.value_size))
+                               for i in range(first, min(first + 1000, args.keys)))
+                results.append(run_stress(store, readers, args.writers, args.keys,
+                                          args.seconds, args.value_size, args.compact))
+            finally:
+                store.close()
+    base = results[0]["reads_per_s"] if results and results[0]["reads_per_s"] else None
+    for result in results:
+        result["read_speedup"] = result["reads_per_s"] / base if base else None
+    failures = sum(result["torn_reads"] + result["stale_reads"] for result in results)
+    if failures:
+        print(f"FAILED: {failures} torn or stale reads", file=sys.stderr, flush=True)
+    return {**store_options, "keys": args.keys, "value_size": args.value_size,
+            "compact": args.compact, "runs": results, "ok": not failures}
+
+
+def run_sharded(store: ShardedKVStore, clients: int, keys: int, batch: int,
+                seconds: float, value_size: int) -> Dict[str, float]:
+    """
+    `clients` threads send mset() batches for `seconds`, then mget() batches
+    for `seconds`. Returns keys written and read per second.
+    """
+    value = "v" * value_size
+
+    def phase(write: bool) -> float:
+        stop = threading.Event()
+        done = [0] * clients
+
+        def client(number: int) -> None:
+            rng = random.Random(number)
+            while not stop.is_set():
+                chosen = [f"key{rng.randrange(keys)}" for _ in range(batch)]
+                if write:
+                    store.mset((key, value) for key in chosen)
+                else:
+                    store.mget(chosen)
+                done[number] += batch
+
+        threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        stop.wait(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        return sum(done) / (time.perf_counter() - started)
+
+    return {"writes_per_s": phase(True), "reads_per_s": phase(False)}
+
+
+class _Interrupted(Exception):
+    """Stands in for a crash in the middle of a reshard."""
+
+
+def _interrupted_reshard(directory: str, shards: int, deletes: Optional[int]) -> None:
+    """
+    Run reshard() and crash it once the keys are copied: before delete
+    call number `deletes` + 1 from the old shards, or (deletes None) when
+    it switches the manifest over. Then open the directory, which has to
+    finish the reshard.
+    """
+    import kv_shard
+    original_store, original_manifest = kv_shard.SimpleKVStore, kv_shard.write_manifest
+    calls = [0]
+
+    class CrashingStore(SimpleKVStore):
+        def delete(self, *keys: str) -> int:
+            if deletes is not None:
+                calls[0] += 1
+                if calls[0] > deletes:
+                    raise _Interrupted()
+            return super().delete(*keys)
+
+    def crashing_manifest(path: str, manifest: Dict[str, int]) -> None:
+        if deletes is None and "target" not in manifest:
+            raise _Interrupted()
+        original_manifest(path, manifest)
+
+    kv_shard.SimpleKVStore, kv_shard.write_manifest = CrashingStore, crashing_manifest
+    try:
+        reshard(directory, shards)
+        raise AssertionError("the reshard wasn't interrupted")
+    except _Interrupted:
+        pass
+    finally:
+        kv_shard.SimpleKVStore, kv_shard.write_manifest = original_store, original_manifest
+    ShardedKVStore(directory).close()
+
+
+def check_resharding(directory: str, keys: int = 2000) -> int:
+    """
+    Split a store holding every kind of value over 2 shards, grow it to 5
+    and shrink it to 1, checking after each step that every key is in the
+    shard that owns it with the same bytes and TTL, and in no other shard.
+    Then reshard again three times with a crash after the copy (before the
+    first delete, between two delete batches, and before the manifest
+    switch) and check that reopening the directory finishes each one
+    without losing a key.
+
+    Besides plain values the store holds values over MAX_VALUE_LENGTH
+    (with and without a TTL) and binary values written with set_stream(),
+    short and long, which a copy through mset() or get() would lose.
+
+    Returns:
+        How many keys were missing, wrong or left behind
+    """
+    data_file = os.path.join(directory, "source.db")
+    sharded = os.path.join(directory, "shards")
+    expected: Dict[str, bytes] = {}
+    with_ttl = set()
+    large = "L" * (MAX_VALUE_LENGTH + 1000)
+    with SimpleKVStore(data_file, compact_dead_ratio=None) as store:
+        store.mset([(f"key{i}", f"value{i}") for i in range(keys)])
+        expected.update((f"key{i}", f"value{i}".encode()) for i in range(keys))
+        # Several of each, so they land in (and move between) several shards
+        for i in range(8):
+            store.set(f"large{i}", large)
+            store.set(f"large-ttl{i}", large, ttl_ms=3_600_000)
+            store.set(f"ttl{i}", f"t{i}", ttl_ms=3_600_000)
+            store.set_stream(f"binary{i}", io.BytesIO(bytes(range(256)) * 4))
+            store.set_stream(f"binary-large{i}", io.BytesIO(b"\xff" * (2 * MAX_VALUE_LENGTH + i)))
+            expected[f"large{i}"] = expected[f"large-ttl{i}"] = large.encode()
+            expected[f"ttl{i}"] = f"t{i}".encode()
+            expected[f"binary{i}"] = bytes(range(256)) * 4
+            expected[f"binary-large{i}"] = b"\xff" * (2 * MAX_VALUE_LENGTH + i)
+            with_ttl.update((f"large-ttl{i}", f"ttl{i}"))
+
+    def verify(shards: int) -> int:
+        stores = [SimpleKVStore(shard_path(sharded, shard), compact_dead_ratio=None)
+                  for shard in range(shards)]
+        try:
+            bad = 0
+            for key, value in expected.items():
+                store = stores[shard_of(key, shards)]
+                found = store.get_bytes(key)
+                if found is None or bytes(found) != value or (store.ttl(key) > 0) != (key in with_ttl):
+                    bad += 1
+            return bad + sum(len(store.index) for store in stores) - len(expected)
+        finally:
+            for store in stores:
+                store.close()
+
+    split_store(data_file, sharded, 2)
+    bad = verify(2)
+    for shards in (5, 1):
+        reshard(sharded, shards)
+        bad += verify(shards)
+    # Growing from 1 shard moves most of its keys, in more than one batch
+    for shards, deletes in ((3, 0), (6, 1), (2, None)):
+        _interrupted_reshard(sharded, shards, deletes)
+        bad += verify(shards)
+    return bad
+
+
+def bench_shard(args: argparse.Namespace) -> Dict[str, object]:
+    """
+    run_sharded() for each shard count, each on a fresh temporary directory,
+    after check_resharding().
+    """
+    print("Checking split and reshard...", file=sys.stderr, flush=True)
+    with tempfile.TemporaryDirectory() as directory:
+        reshard_mismatches = check_resharding(directory)
+    if reshard_mismatches:
+        print(f"FAILED: {reshard_mismatches} keys lost or wrong after split/reshard",
+              file=sys.stderr, flush=True)
+    results = []
+    for shards in [int(n) for n in args.shards.split(",")]:
+        print(f"{shards} shards...", file=sys.stderr, flush=True)
+        with tempfile.TemporaryDirectory() as directory:
+            with ShardedKVStore(directory, shards, durability=args.durability) as store:
+                result = {"shards": shards}
+                result.update(run_sharded(store, args.clients, args.keys, args.batch,
+                                          args.seconds, args.value_size))
+                results.append(result)
+    for name in ("writes_per_s", "reads_per_s"):
+        base = results[0][name] if results else 0
+        for result in results:
+            result[name.replace("_per_s", "_speedup")] = result[name] / base if base else None
+    return {"durability": args.durability, "clients": args.clients, "batch": args.batch,
+            "keys": args.keys, "value_size": args.value_size, "cpus": os.cpu_count(),
+            "runs": results, "reshard_mismatches": reshard_mismatches,
+            "ok": not reshard_mismatches}
+
+
+class PatternStream(io.RawIOBase):
+    """
+    A readable stream of `size` bytes that repeats one random 1MB block, so
+    feeding a 1GB value to set_stream() costs no memory on my side.
+    """
+
+    def __init__(self, size: int) -> None:
+        super().__init__()
+        self.size = size
+        self._block = os.urandom(1024 * 1024)
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast('B')
+        within = self._position % len(self._block)
+        count = min(len(view), len(self._block) - within, self.size - self._position)
+        view[:count] = self._block[within:within + count]
+        self._position += count
+        return count
+
+
+class PeakRss:
+    """
+    Samples rss_bytes() in a background thread while the block runs.
+
+    Attributes:
+        growth: Peak RSS minus the RSS when the block started, in bytes
+    """
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.growth = 0
+        self._stop = threading.Event()
+
+    def __enter__(self) -> "PeakRss":
+        self._start = rss_bytes()
+        self._peak = self._start
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._peak = max(self._peak, rss_bytes())
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        self._thread.join()
+        self._peak = max(self._peak, rss_bytes())
+        self.growth = self._peak - self._start
+
+
+def run_large_value(store: SimpleKVStore, size: int, buffer_bytes: int,
+                    compare_get: bool = False) -> Dict[str, object]:
+    """
+    Write one `size`-byte value with set_stream() and read it back in each
+    streaming mode, measuring throughput and peak RSS growth per phase.
+
+    The readinto phase reads front to back, so the reader checks the
+    value's CRC; a mismatch raises and fails the run.
+    """
+    mb = size / (1024 * 1024)
+    result: Dict[str, object] = {"size_mb": round(mb, 1)}
+
+    def phase(name: str, action) -> None:
+        with PeakRss() as rss:
+            started = time.perf_counter()
+            action()
+            elapsed = time.perf_counter() - started
+        result[name] = {"mb_per_s": round(mb / elapsed, 1) if elapsed else None,
+                        "peak_rss_growth_mb": round(rss.growth / (1024 * 1024), 1)}
+
+    phase("set_stream", lambda: store.set_stream("large", PatternStream(size)))
+
+    def read_into() -> None:
+        buffer = memoryview(bytearray(buffer_bytes))
+        total = 0
+        with store.get_stream("large") as stream:
+            while True:
+                count = stream.readinto(buffer)
+                if not count:
+                    break
+                total += count
+        if total != size:
+            raise IOError(f"read {total} of {size} bytes")
+    phase("readinto", read_into)
+
+    def send_file() -> None:
+        sender, receiver = socket.socketpair()
+        received = [0]
+
+        def drain() -> None:
+            buffer = bytearray(buffer_bytes)
+            while True:
+                count = receiver.recv_into(buffer)
+                if not count:
+                    break
+                received[0] += count
+        thread = threading.Thread(target=drain)
+        thread.start()
+        try:
+            with store.get_stream("large") as stream:
+                stream.sendfile(sender)
+        finally:
+            sender.close()
+            thread.join()
+            receiver.close()
+        if received[0] != size:
+            raise IOError(f"sent {received[0]} of {size} bytes")
+    phase("sendfile", send_file)
+
+    if compare_get:
+        phase("get_bytes", lambda: len(store.get_bytes("large")))
+    return result
+
+
+def check_value_limits(directory: str) -> int:
+    """
+    Write values right at the single-record limit, with and without a TTL,
+    through SET EX/PX, set(), import_records() and a native import, then
+    reopen without the hint file and read them back.
+
+    A value with a TTL has 8 fewer bytes to spare in its record, so values
+    at MAX_VALUE_LENGTH with a TTL have to take the chunked path; a record
+    that recovery rejects would hide every record after it.
+
+    Returns:
+        How many values were missing or wrong after the reopen
+    """
+    import kv_bulk
+    data_file = os.path.join(directory, "limits.db")
+    expected: Dict[str, str] = {}
+    sizes = (MAX_TTL_VALUE_LENGTH, MAX_TTL_VALUE_LENGTH + 1, MAX_VALUE_LENGTH, MAX_VALUE_LENGTH + 1)
+    far = int(time.time() * 1000) + 3_600_000
+    with SimpleKVStore(data_file, compact_dead_ratio=None) as store:
+        for size in sizes:
+            for command in ("EX 3600", "PX 3600000"):
+                key = f"repl-{size}-{command[:2]}"
+                expected[key] = "e" * size
+                store.execute(f"SET {key} {expected[key]} {command}")
+            for ttl_ms in (None, 3_600_000):
+                key = f"set-{size}-{ttl_ms}"
+                expected[key] = "s" * size
+                store.set(key, expected[key], ttl_ms=ttl_ms)
+            for expires_at in (0, far):
+                key = f"import-{size}-{expires_at}"
+                expected[key] = "i" * size
+                store.import_records([(key, expected[key], expires_at)])
+        native = io.BytesIO()
+        records = [(f"native-{size}", "n" * size, far) for size in sizes]
+        kv_bulk.write_records(native, records, "native")
+        native.seek(0)
+        store.import_records(kv_bulk.read_records(native, "native"))
+        expected.update((key, value) for key, value, _ in records)
+        store.set("after", "v")
+        expected["after"] = "v"
+    with SimpleKVStore(data_file, use_hint=False, compact_dead_ratio=None) as store:
+        return sum(store.get(key) != value for key, value in expected.items())
+
+
+def bench_large_value(args: argparse.Namespace) -> Dict[str, object]:
+    """
+    run_large_value() for each size, each on a fresh temporary store, after
+    check_value_limits().
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        limit_mismatches = check_value_limits(directory)
+    if limit_mismatches:
+        print(f"FAILED: {limit_mismatches} values at the record size limit lost on reopen",
+              file=sys.stderr, flush=True)
+    results = []
+    for size_mb in [float(n) for n in args.sizes_mb.split(",")]:
+        print(f"{size_mb:g} MB value...", file=sys.stderr, flush=True)
+        with tempfile.TemporaryDirectory() as directory:
+            with SimpleKVStore(os.path.join(directory, "large.db"),
+                               compact_dead_ratio=None) as store:
+                results.append(run_large_value(store, int(size_mb * 1024 * 1024),
+                                               args.buffer_bytes, args.compare_get))
+    return {"buffer_bytes": args.buffer_bytes, "runs": results,
+            "limit_mismatches": limit_mismatches, "ok": not limit_mismatches}
+
+
+def _lsm_key(i: int, keys: int) -> str:
+    """
+    The i-th key loaded, in a scrambled order: i times a large prime is a
+    permutation of range(keys) as long as keys isn't a multiple of it.
+    """
+    return f"user{(i * 1_000_003) % keys:012d}"
+
+
+def _lsm_value(key: str, size: int) -> str:
+    return (key + ":") * (size // (len(key) + 1)) + "#" * (size % (len(key) + 1))
+
+
+def drop_page_cache(directory: str) -> bool:
+    """
+    Ask the OS to evict every file in `directory` from the page cache, so
+    the next reads really go to disk. Only clean pages can be dropped; the
+    tables were fsynced when they were written.
+
+    Returns:
+        False where posix_fadvise isn't available
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    for name in os.listdir(directory):
+        fd = os.open(os.path.join(directory, name), os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    return True
+
+
+def _lsm_lookups(directory: str, keys: int, value_size: int, lookups: int,
+                 seed: int, options: Dict[str, object]) -> Dict[str, object]:
+    """
+    Open the loaded store, drop it from the page cache and time GETs for
+    existing and missing keys (runs in a fresh child process, so its RSS
+    growth is the store's memory and nothing left over from the load).
+    """
+    import gc
+    gc.collect()
+    before = rss_bytes()
+    store = LSMKVStore(directory, **options)
+    try:
+        gc.collect()
+        result: Dict[str, object] = {"resident_bytes": rss_bytes() - before,
+                                     "levels": store.lsm_stats(),
+                                     "page_cache_dropped": drop_page_cache(directory)}
+        rng = random.Random(seed)
+        counters = store.metrics.counters
+        for name, make_key in (("get_hit", lambda: _lsm_key(rng.randrange(keys), keys)),
+                               ("get_miss", lambda: f"miss{rng.randrange(keys):012d}")):
+            blocks_before = counters.get("block_reads", 0)
+            latencies = []
+            wrong = 0
+            for _ in range(lookups):
+                key = make_key()
+                began = time.perf_counter()
+                value = store.get(key)
+                latencies.append(time.perf_counter() - began)
+                wrong += value != (_lsm_value(key, value_size) if name == "get_hit" else None)
+            result[name] = {**latency_summary(latencies),
+                            "blocks_per_get": round((counters.get("block_reads", 0) - blocks_before)
+                                                    / lookups, 3),
+                            "wrong_values": wrong}
+        return result
+    finally:
+        store.close()
+
+
+def run_lsm(directory: str, keys: int, value_size: int, lookups: int,
+            memory_bytes: int, seed: int = 1, **options) -> Dict[str, object]:
+    """
+    Load `keys` keys into an LSMKVStore, then reopen it in a fresh process
+    and time cold GETs there.
+
+    Returns:
+        Load time, data size on disk, resident memory of the reopened store
+        against `memory_bytes`, and GET latency for hits and misses
+    """
+    if keys % 1_000_003 == 0:
+        keys += 1
+    result: Dict[str, object] = {"keys": keys, "value_size": value_size}
+    started = time.perf_counter()
+    with LSMKVStore(directory, **options) as store:
+        store.import_records((key, _lsm_value(key, value_size), 0)
+                             for key in (_lsm_key(i, keys) for i in range(keys)))
+        # Let background compaction settle, as a long-running store would
+        store.wait_idle()
+        result["compaction"] = store.compaction_stats()
+    result["load_seconds"] = round(time.perf_counter() - started, 2)
+    data_bytes = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+    result["data_mb"] = round(data_bytes / (1024 * 1024), 1)
+
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        lookup = pool.submit(_lsm_lookups, directory, keys, value_size, lookups, seed, options).result()
+    resident = lookup.pop("resident_bytes")
+    result["resident_mb"] = round(resident / (1024 * 1024), 2)
+    result["memory_budget_mb"] = round(memory_bytes / (1024 * 1024), 1)
+    result["data_to_memory_ratio"] = round(data_bytes / memory_bytes, 1)
+    result["fits_in_memory_budget"] = resident <= memory_bytes
+    result.update(lookup)
+    result["ok"] = lookup["get_hit"]["wrong_values"] == 0 and lookup["get_miss"]["wrong_values"] == 0
+    return result
+
+
+def bench_lsm(args: argparse.Namespace) -> Dict[str, object]:
+    """
+    run_lsm() with a keyspace `ratio` times the memory budget, on a fresh
+    temporary directory (or --directory, reused if it is already loaded).
+    """
+    memory_bytes = int(args.memory_mb * 1024 * 1024)
+    # A record on disk is the value, the key and an 8-byte header
+    keys = args.keys or int(memory_bytes * args.ratio / (args.value_size + 16 + 8)) + 1
+    options = {"memtable_bytes": args.memtable_mb * 1024 * 1024}
+    print(f"LSM: {keys} keys of {args.value_size} bytes...", file=sys.stderr, flush=True)
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        result = run_lsm(directory, keys, args.value_size, args.lookups, memory_bytes, **options)
+    return {"ratio": args.ratio, **result}
+
+
+def run_replica(directory: str, followers: int, seconds: float, keys: int, batch: int,
+                value_size: int, segment_bytes: Optional[int] = None) -> Dict[str, object]:
+    """
+    One primary and `followers` kv_replica.ReplicaKVStore followers in one
+    directory, all in this process.
+
+    A writer thread sends mset() batches to the primary for `seconds` while
+    a sampler records every follower's lag (bytes and seconds) every 20ms.
+    Then I time how long the followers take to catch up and compare their
+    values with the primary's. Finally I close one follower, write another
+    batch and reopen it, to check that it only copies the new bytes.
+
+    The followers share this process (and its GIL) with the writer, so this
+    measures replication cost and lag, not read scaling.
+
+    Returns:
+        Write throughput, lag percentiles, catch-up time, value mismatches
+        and the bytes a restarted follower copied
+    """
+    primary_file = os.path.join(directory, "primary.db")
+    primary = SimpleKVStore(primary_file, durability="group",
+                            segment_max_bytes=segment_bytes)
+    replicas = [ReplicaKVStore(primary_file, os.path.join(directory, f"replica{n}.db"))
+                for n in range(followers)]
+    stop = threading.Event()
+    lag_bytes: List[float] = []
+    lag_seconds: List[float] = []
+    written = [0]
+
+    def writer() -> None:
+        rng = random.Random(1)
+        version = 0
+        while not stop.is_set():
+            version += 1
+            primary.mset((f"key{rng.randrange(keys)}", f"{version:08d}".ljust(value_size, "v"))
+                         for _ in range(batch))
+            written[0] += batch
+
+    def sampler() -> None:
+        while not stop.wait(0.02):
+            for replica in replicas:
+                stats = replica.replication_stats()
+                lag_bytes.append(stats["lag_bytes"])
+                lag_seconds.append(stats["lag_s"])
+
+    try:
+        threads = [threading.Thread(target=writer), threading.Thread(target=sampler)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        stop.wait(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        caught_up = time.perf_counter()
+        while any(replica.replication_stats()["lag_bytes"] for replica in replicas):
+            time.sleep(0.001)
+        catch_up_s = time.perf_counter() - caught_up
+
+        sample = [f"key{i}" for i in range(0, keys, max(1, keys // 1000))]
+        expected = primary.mget(sample)
+        mismatches = sum(replica.mget(sample) != expected for replica in replicas)
+
+        # Restart one follower behind the primary: it should resume
+        replicas[0].close()
+        log_bytes = primary.compaction_stats()["log_bytes"]
+        primary.mset((f"key{i}", "restart") for i in range(batch))
+        replicas[0] = ReplicaKVStore(primary_file, os.path.join(directory, "replica0.db"))
+        resumed = replicas[0].replication_stats()
+        if replicas[0].get("key0") != "restart":
+            mismatches += 1
+    finally:
+        for replica in replicas:
+            replica.close()
+        primary.close()
+
+    lag_bytes.sort()
+    lag_seconds.sort()
+    return {"followers": followers, "writes_per_s": written[0] / elapsed,
+            "lag_bytes_p50": percentile(lag_bytes, 0.50) if lag_bytes else 0,
+            "lag_bytes_p99": percentile(lag_bytes, 0.99) if lag_bytes else 0,
+            "lag_ms_p50": percentile(lag_seconds, 0.50) * 1000 if lag_seconds else 0.0,
+            "lag_ms_p99": percentile(lag_seconds, 0.99) * 1000 if lag_seconds else 0.0,
+            "catch_up_ms": catch_up_s * 1000, "mismatches": mismatches,
+            "log_bytes": log_bytes, "restart_bytes_copied": resumed["bytes_copied"]}
+
+
+def bench_replica(args: argparse.Namespace) -> Dict[str, object]:
+    """
+    run_replica() for each follower count, each on a fresh temporary directory.
+    """
+    results = []
+    for followers in [int(n) for n in args.followers.split(",")]:
+        print(f"{followers} followers...", file=sys.stderr, flush=True)
+        with tempfile.TemporaryDirectory() as directory:
+            results.append(run_replica(directory, followers, args.seconds, args.keys,
+                                       args.batch, args.value_size, args.segment_bytes))
+    failures = sum(result["mismatches"] for result in results)
+    if failures:
+        print(f"FAILED: {failures} followers disagree with the primary",
+              file=sys.stderr, flush=True)
+    return {"keys": args.keys, "batch": args.batch, "value_size": args.value_size,
+            "segment_bytes": args.segment_bytes, "runs": results, "ok": not failures}
+
+
+def run_lazy_start(directory: str, records: int, keys: int, value_size: int,
+                   miss_ratio: float = 0.1) -> Dict[str, object]:
+    """
+    Time an eager open of a synthetic log against a lazy_recovery open.
+
+    After the lazy open I keep sending GETs for random keys (miss_ratio of
+    them for keys that don't exist) and SETs of new keys until the replay
+    is done, then read everything back. A SET during recovery must win over
+    the old log, so I also overwrite keys that the replay hasn't reached.
+
+    Returns:
+        Eager open time, lazy open and first-GET times, latencies during and
+        after recovery, recovery_progress() samples and value mismatches
+    """
+    data_file = os.path.join(directory, "lazy.db")
+    print(f"Writing {records} records...", file=sys.stderr, flush=True)
+    size = write_synthetic_log(data_file, records, keys, value_size)
+    expected = "v" * value_size
+    options = {"use_hint": False, "compact_dead_ratio": None}
+    eager_s = time_open(data_file, **options)
+
+    clock = time.perf_counter
+    started = clock()
+    store = SimpleKVStore(data_file, lazy_recovery=True, **options)
+    open_s = clock() - started
+    rng = random.Random(1)
+    mismatches = 0
+    hits: List[float] = []
+    misses: List[float] = []
+    sets: List[float] = []
+    written: Dict[str, str] = {}
+    samples = []
+    try:
+        first = f"key{keys - 1}"
+        if store.get(first) != expected:
+            mismatches += 1
+        first_get_s = clock() - started
+        while store.recovery_progress()["recovering"]:
+            if rng.random() < miss_ratio:
+                sent = clock()
+                if store.get(f"missing{rng.randrange(keys)}") is not None:
+                    mismatches += 1
+                misses.append(clock() - sent)
+            else:
+                key = f"key{rng.randrange(keys)}"
+                sent = clock()
+                if store.get(key) != written.get(key, expected):
+                    mismatches += 1
+                hits.append(clock() - sent)
+            if len(hits) % 10 == 0:
+                key = f"key{rng.randrange(keys)}"
+                written[key] = f"new{len(sets)}"
+                sent = clock()
+                store.set(key, written[key])
+                sets.append(clock() - sent)
+            if len(hits) % 100 == 0:
+                progress = store.recovery_progress()
+                samples.append({name: progress[name] for name in ("progress", "elapsed_s", "eta_s")})
+        recovered_s = clock() - started
+
+        after: List[float] = []
+        for i in range(keys):
+            key = f"key{i}"
+            sent = clock()
+            if store.get(key) != written.get(key, expected):
+                mismatches += 1
+            after.append(clock() - sent)
+        progress = store.recovery_progress()
+    finally:
+        store.close()
+    return {"log_bytes": size, "records": records, "eager_open_s": eager_s,
+            "lazy_open_s": open_s, "lazy_first_get_s": first_get_s,
+            "recovered_s": recovered_s, "fallback_lookups": progress["fallback_lookups"],
+            "sets_during_recovery": len(sets),
+            "get_during_recovery": latency_summary(hits),
+            "get_missing_during_recovery": latency_summary(misses),
+            "set_during_recovery": latency_summary(sets),
+            "get_after_recovery": latency_summary(after),
+            "progress_samples": samples[::max(1, len(samples) // 10)],
+            "mismatches": mismatches}
+
+
+def bench_lazy_start(args: argparse.Namespace) -> Dict[str, object]:
+    """
+    run_lazy_start() on a log of about --log-mb megabytes.
+    """
+    record_size = HEADER_SIZE + len(b"key%d" % args.keys) + args.value_size
+    records = max(args.keys, int(args.log_mb * 1024 * 1024) // record_size)
+    with tempfile.TemporaryDirectory() as directory:
+        result = run_lazy_start(directory, records, args.keys, args.value_size)
+    if result["mismatches"]:
+        print(f"FAILED: {result['mismatches']} wrong values", file=sys.stderr, flush=True)
+    return {"keys": args.keys, "value_size": args.value_size, **result,
+            "ok": not result["mismatches"]}
+
+
+COMPRESSION_MODES = ("off", "zlib", "lzma", "zlib+dict")
+
+
+def json_document(i: int, size: int, rng: random.Random) -> str:
+    """
+    A JSON object of about `size` bytes, shaped like typical application
+    data: the same field names in every document, a few repeated values
+    and some unique ones.
+    """
+    document = {"id": i, "type": rng.choice(("user", "order", "session")),
+                "email": f"user{i}@example.com", "active": rng.random() < 0.5,
+                "created": 1700000000000 + rng.randrange(10 ** 9),
+                "country": rng.choice(("US", "IN", "DE", "BR", "JP")),
+                "tags": rng.sample(("new", "vip", "mobile", "trial", "beta"), 2),
+                "notes": ""}
+    text = json.dumps(document)
+    words = ("status", "pending", "shipped", "delivered", "returned", "note")
+    notes = []
+    while len(text) + sum(len(word) + 1 for word in notes) < size:
+        notes.append(rng.choice(words) if rng.random() < 0.7 else f"{rng.getrandbits(32):x}")
+    document["notes"] = " ".join(notes)
+    return json.dumps(document)
+
+
+def run_compression(directory: str, mode: str, keys: int, value_size: int,
+                    lookups: int, samples: int) -> Dict[str, object]:
+    """
+    Load `keys` documents into a fresh store with one COMPRESSION_MODES
+    setting, compact it and time random GETs.
+
+    For "zlib+dict" I load the first `samples` documents, train a
+    dictionary on them and then load everything, so every live value is
+    compressed against it; compaction drops the first copies.
+
+    Returns:
+        Log bytes after compaction, load and GET timings, mismatches
+    """
+    data_file = os.path.join(directory, mode.replace("+", "-") + ".db")
+    compression = None if mode == "off" else mode.split("+")[0]
+    store = SimpleKVStore(data_file, compression=compression, compact_dead_ratio=None)
+    clock = time.perf_counter
+    rng = random.Random(1)
+    values = [json_document(i, value_size, rng) for i in range(keys)]
+    try:
+        if mode.endswith("+dict"):
+            store.import_records((f"doc{i}", values[i], 0) for i in range(min(samples, keys)))
+            store.train_dictionary(samples)
+        started = clock()
+        store.import_records((f"doc{i}", value, 0) for i, value in enumerate(values))
+        load_s = clock() - started
+        store.compact(wait=True)
+        log_bytes = store.compaction_stats()["log_bytes"]
+
+        mismatches = 0
+        latencies: List[float] = []
+        for _ in range(lookups):
+            i = rng.randrange(keys)
+            sent = clock()
+            value = store.get(f"doc{i}")
+            latencies.append(clock() - sent)
+            if value != values[i]:
+                mismatches += 1
+        counters = store.stats()["counters"]
+    finally:
+        store.close()
+    raw_bytes = sum(len(value) for value in values)
+    return {"mode": mode, "log_bytes": log_bytes, "value_bytes": raw_bytes,
+            "values_compressed": counters.get("values_compressed", 0),
+            "load_records_per_s": keys / load_s if load_s else 0.0,
+            "get": latency_summary(latencies), "mismatches": mismatches}
+
+
+def bench_compression(args: argparse.Namespace) -> Dict[str, object]:
+    """
+    run_compression() for every mode in --modes, with each log's size as a
+    ratio of the uncompressed one.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in args.modes.split(","):
+            if mode not in COMPRESSION_MODES:
+                raise SystemExit(f"Unknown mode '{mode}', expected some of {','.join(COMPRESSION_MODES)}")
+            print(f"Loading {args.keys} values with compression {mode}...", file=sys.stderr, flush=True)
+            results.append(run_compression(directory, mode, args.keys, args.value_size,
+                                           args.lookups, args.samples))
+    baseline = next((result["log_bytes"] for result in results if result["mode"] == "off"), None)
+    for result in results:
+        if baseline:
+            result["log_ratio"] = baseline / result["log_bytes"]
+    mismatches = sum(result["mismatches"] for result in results)
+    if mismatches:
+        print(f"FAILED: {mismatches} wrong values", file=sys.stderr, flush=True)
+    return {"keys": args.keys, "value_size": args.value_size, "results": results,
+            "ok": not mismatches}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks for kv_store.py")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    subcommands = parser.add_subparsers(dest="benchmark", required=True)
+
+    scan = subcommands.add_parser("scan", help="Recovery scan throughput")
+    scan.add_argument("--records", type=int, default=10_000_000)
+    scan.add_argument("--keys", type=int, default=None,
+                      help="Distinct keys (default: one per record)")
+    scan.add_argument("--value-size", type=int, default=32)
+    scan.add_argument("--skip-legacy", action="store_true",
+                      help="Only time the new scanner")
+    scan.set_defaults(run=bench_scan)
+
+    loadgen = subcommands.add_parser("loadgen", help="kv_server.py connection scaling")
+    loadgen.add_argument("--host", default="127.0.0.1")
+    loadgen.add_argument("--port", type=int, default=None,
+                         help="Use a running server (default: start one on a temp file)")
+    loadgen.add_argument("--durability", default="group",
+                         help="Durability of the server I start (default: group)")
+    loadgen.add_argument("--connections", default="1,4,16,64",
+                         help="Comma-separated connection counts to run")
+    loadgen.add_argument("--requests", type=int, default=2000,
+                         help="Commands per connection")
+    loadgen.add_argument("--pipeline", type=int, default=1,
+                         help="Commands sent per round trip")
+    loadgen.add_argument("--set-ratio", type=float, default=0.5)
+    loadgen.add_argument("--keys", type=int, default=10_000)
+    loadgen.add_argument("--value-size", type=int, default=100)
+    loadgen.set_defaults(run=bench_loadgen)
+
+    memory = subcommands.add_parser("index-memory", help="Index bytes per key")
+    memory.add_argument("--keys", default="1000000,10000000,50000000",
+                        help="Comma-separated keyspace sizes")
+    memory.add_argument("--engines", default=",".join(INDEX_ENGINES),
+                        help="Comma-separated index engines to measure")
+    memory.add_argument("--key-size", type=int, default=16)
+    memory.set_defaults(run=bench_index_memory)
+
+    ycsb = subcommands.add_parser("ycsb", help="YCSB-style workloads")
+    ycsb.add_argument("--workload", choices=["all"] + list(WORKLOADS), default="all")
+    ycsb.add_argument("--driver", choices=["api", "repl"], default="api",
+                      help="Call SimpleKVStore directly or drive the REPL in a subprocess")
+    ycsb.add_argument("--threads", type=int, default=1,
+                      help="Client threads for the api driver")
+    ycsb.add_argument("--durability", choices=DURABILITY_MODES, default="always")
+    ycsb.add_argument("--read-mode", choices=READ_MODES, default="pread")
+    ycsb.add_argument("--cache-bytes", type=int, default=0)
+    ycsb.add_argument("--log-gb", type=float, default=1.0,
+                      help="Log size for the cold-start workload")
+    ycsb.add_argument("--records", type=int, default=None, help="Override the preset")
+    ycsb.add_argument("--operations", type=int, default=None, help="Override the preset")
+    ycsb.add_argument("--value-size", type=int, default=None, help="Override the preset")
+    ycsb.add_argument("--read-ratio", type=float, default=None, help="Override the preset")
+    ycsb.add_argument("--distribution", choices=["uniform", "zipfian"], default=None,
+                      help="Override the preset")
+    ycsb.set_defaults(run=bench_ycsb)
+
+    stress = subcommands.add_parser("stress", help="Concurrent readers and writers")
+    stress.add_argument("--readers", default="1,2,4,8",
+                        help="Comma-separated reader thread counts to run")
+    stress.add_argument("--writers", type=int, default=2)
+    stress.add_argument("--seconds", type=float, default=5.0,
+                        help="Duration of each run")
+    stress.add_argument("--keys", type=int, default=10_000)
+    stress.add_argument("--value-size", type=int, default=100)
+    stress.add_argument("--durability", choices=DURABILITY_MODES, default="group")
+    stress.add_argument("--read-mode", choices=READ_MODES, default="pread")
+    stress.add_argument("--index-engine", choices=list(INDEX_ENGINES), default="dict")
+    stress.add_argument("--cache-bytes", type=int, default=0)
+    stress.add_argument("--segment-bytes", type=int, default=None,
+                        help="Split the log into segments of this size")
+    stress.add_argument("--compact", action="store_true",
+                        help="Keep a compaction running during the test")
+    stress.set_defaults(run=bench_stress)
+
+    shard = subcommands.add_parser("shard", help="Sharded store scaling")
+    shard.add_argument("--shards", default="1,2,4,8",
+                       help="Comma-separated shard counts to run")
+    shard.add_argument("--clients", type=int, default=16,
+                       help="Client threads sending batches")
+    shard.add_argument("--batch", type=int, default=256, help="Keys per MSET/MGET")
+    shard.add_argument("--seconds", type=float, default=5.0, help="Duration of each phase")
+    shard.add_argument("--keys", type=int, default=100_000)
+    shard.add_argument("--value-size", type=int, default=100)
+    shard.add_argument("--durability", choices=DURABILITY_MODES, default="always")
+    shard.set_defaults(run=bench_shard)
+
+    large = subcommands.add_parser("large-value", help="Streaming large values")
+    large.add_argument("--sizes-mb", default="64,256,1024",
+                       help="Comma-separated value sizes in MB")
+    large.add_argument("--buffer-bytes", type=int, default=1024 * 1024,
+                       help="Size of the reused read buffer")
+    large.add_argument("--compare-get", action="store_true",
+                       help="Also read with get_bytes(), which holds the whole value")
+    large.set_defaults(run=bench_large_value)
+
+    lsm = subcommands.add_parser("lsm", help="LSM engine GETs on a keyspace larger than memory")
+    lsm.add_argument("--memory-mb", type=float, default=64,
+                     help="Memory budget the store has to fit in")
+    lsm.add_argument("--ratio", type=float, default=10,
+                     help="Data size as a multiple of the memory budget")
+    lsm.add_argument("--keys", type=int, default=None,
+                     help="Override the key count derived from --memory-mb and --ratio")
+    lsm.add_argument("--value-size", type=int, default=200)
+    lsm.add_argument("--memtable-mb", type=int, default=4)
+    lsm.add_argument("--lookups", type=int, default=20_000, help="GETs per phase")
+    lsm.add_argument("--directory", default=None,
+                     help="Where to create the temporary store (default: the system temp dir)")
+    lsm.set_defaults(run=bench_lsm)
+
+    replica = subcommands.add_parser("replica", help="Log-shipping read replicas")
+    replica.add_argument("--followers", default="1,2,4",
+                         help="Comma-separated follower counts to run")
+    replica.add_argument("--seconds", type=float, default=5.0,
+                         help="How long the primary takes writes")
+    replica.add_argument("--keys", type=int, default=100_000)
+    replica.add_argument("--batch", type=int, default=100, help="Keys per MSET")
+    replica.add_argument("--value-size", type=int, default=100)
+    replica.add_argument("--segment-bytes", type=int, default=None,
+                         help="Split the primary's log into segments of this size")
+    replica.set_defaults(run=bench_replica)
+
+    lazy = subcommands.add_parser("lazy-start", help="Serving during background recovery")
+    lazy.add_argument("--log-mb", type=float, default=256, help="Size of the synthetic log")
+    lazy.add_argument("--keys", type=int, default=1_000_000)
+    lazy.add_argument("--value-size", type=int, default=100)
+    lazy.set_defaults(run=bench_lazy_start)
+
+    compression = subcommands.add_parser("compression", help="Log size and GET latency per codec")
+    compression.add_argument("--modes", default=",".join(COMPRESSION_MODES),
+                             help="Comma-separated modes: off, zlib, lzma, zlib+dict")
+    compression.add_argument("--keys", type=int, default=200_000)
+    compression.add_argument("--value-size", type=int, default=200,
+                             help="Approximate size of each JSON document")
+    compression.add_argument("--lookups", type=int, default=100_000)
+    compression.add_argument("--samples", type=int, default=1000,
+                             help="Values the dictionary is trained on")
+    compression.set_defaults(run=bench_compression)
+
+    args = parser.parse_args(argv)
+    result = {"benchmark": args.benchmark, **args.run(args)}
+    print(json.dumps(result, indent=2))
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(result, out, indent=2)
+    return 0 if result.get("ok", True) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,316 @@
+"""
+Bulk import/export formats for the Simple Persistent Key-Value Store.
+
+SimpleKVStore.import_records() and export_records() work on
+(key, value, expires_at) tuples; this module turns those into files and
+back, streaming, so neither side ever holds the whole data set:
+
+- tsv: one "key<TAB>value[<TAB>expires_at]" line per record. Backslash,
+  tab, CR and newline inside keys and values are escaped as \\\\, \\t, \\r, \\n.
+- jsonl: one {"key": ..., "value": ..., "expires_at": ...} object per line
+  (expires_at only for keys with a TTL)
+- native: my log record format. An export is a valid data file, and a log
+  file (or a copy of one) can be imported directly, tombstones included.
+  Values over MAX_VALUE_LENGTH are written as chunk records plus a
+  manifest, like SimpleKVStore.set_stream() does; reading one back
+  assembles it in memory, since a record carries the value as a string.
+  Compressed records (from a store with compression on) are decompressed;
+  those compressed against a dictionary need the store's dictionaries.
+
+expires_at is an absolute unix time in milliseconds, so a TTL survives the
+round trip; records that have already expired are skipped on import.
+"""
+
+import sys
+import json
+import zlib
+from typing import BinaryIO, Dict, Iterable, Iterator, Optional, Tuple
+
+from kv_store import RECORD_HEADER, HEADER_SIZE, RECORD_PUT, RECORD_BATCH, RECORD_DELETE, \
+    RECORD_CHUNK, RECORD_LARGE, RECORD_TYPE_MASK, RECORD_FLAG_TTL, RECORD_FLAG_COMPRESSED, \
+    RECORD_TYPE_SHIFT, KEY_LENGTH_MASK, BATCH_INFO, EXPIRY, LARGE_INFO, LARGE_CHUNK_SIZE, \
+    MAX_KEY_LENGTH, MAX_VALUE_LENGTH, MAX_TTL_VALUE_LENGTH
+from kv_codec import decompress
+
+FORMATS = ("tsv", "jsonl", "native")
+
+# (key, value, expires_at): value None means delete, expires_at 0 means no TTL
+Record = Tuple[str, Optional[str], int]
+
+_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+_UNESCAPES = {"\\": "\\", "t": "\t", "n": "\n", "r": "\r"}
+
+
+def guess_format(path: str, default: str = "tsv") -> str:
+    """
+    Pick a format from a file name: *.jsonl/*.json, *.tsv, *.db/*.kv (native).
+    """
+    lower = path.lower()
+    if lower.endswith((".jsonl", ".json", ".ndjson")):
+        return "jsonl"
+    if lower.endswith(".tsv"):
+        return "tsv"
+    if lower.endswith((".db", ".kv")) or ".db." in lower:
+        return "native"
+    return default
+
+
+def _unescape(field: str) -> str:
+    if "\\" not in field:
+        return field
+    out = []
+    position = 0
+    while True:
+        slash = field.find("\\", position)
+        if slash < 0 or slash == len(field) - 1:
+            out.append(field[position:])
+            return "".join(out)
+        out.append(field[position:slash])
+        out.append(_UNESCAPES.get(field[slash + 1], field[slash + 1]))
+        position = slash + 2
+
+
+def read_records(stream: BinaryIO, fmt: str,
+                 dictionaries: Optional[Dict[int, bytes]] = None) -> Iterator[Record]:
+    """
+    Parse records from a binary stream, one at a time.
+
+    Args:
+        stream: Opened in binary mode (a file, or sys.stdin.buffer)
+        fmt: One of FORMATS
+        dictionaries: Compression dictionaries by number, for native logs
+            written with a trained dictionary (kv_codec.load_dictionaries)
+
+    Yields:
+        (key, value, expires_at) tuples
+
+    Raises:
+        ValueError: On a malformed line or record (with its line number or offset)
+    """
+    if fmt == "native":
+        yield from _read_native(stream, dictionaries=dictionaries)
+        return
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format '{fmt}' (expected one of {', '.join(FORMATS)})")
+    for number, raw in enumerate(stream, 1):
+        line = raw.decode('utf-8').rstrip("\r\n")
+        if not line:
+            continue
+        if fmt == "tsv":
+            fields = line.split("\t")
+            if len(fields) == 2:
+                yield _unescape(fields[0]), _unescape(fields[1]), 0
+            elif len(fields) == 3 and fields[2].isdigit():
+                yield _unescape(fields[0]), _unescape(fields[1]), int(fields[2])
+            else:
+                raise ValueError(f"line {number}: expected key<TAB>value[<TAB>expires_at]")
+        else:
+            try:
+                item = json.loads(line)
+                yield item["key"], item["value"], int(item.get("expires_at") or 0)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                raise ValueError(f"line {number}: {e}") from None
+
+
+def _read_native(stream: BinaryIO, chunk_size: int = 4 * 1024 * 1024,
+                 dictionaries: Optional[Dict[int, bytes]] = None) -> Iterator[Record]:
+    """
+    Parse log records from a stream. Batch headers are checked and then
+    stepped over, so a log file imports exactly as recovery would replay it.
+
+    I parse straight out of a large buffer and only read more when the next
+    record doesn't fit in what is left. Chunk records are held until the
+    manifest after them turns them into one value; the chunks of a value
+    always come right before its manifest, so orphan chunks from a crashed
+    write are never mistaken for part of it.
+    """
+    unpack_header = RECORD_HEADER.unpack_from
+    unpack_expiry = EXPIRY.unpack_from
+    dictionaries = dictionaries or {}
+
+    def dictionary(number: int) -> bytes:
+        if number not in dictionaries:
+            raise ValueError(f"compression dictionary {number} is missing")
+        return dictionaries[number]
+
+    chunks = []
+    buffer = b""
+    position = 0  # next record in buffer
+    base = 0      # stream offset of buffer[0]
+    while True:
+        available = len(buffer)
+        if available - position < HEADER_SIZE:
+            needed = HEADER_SIZE
+        else:
+            key_len, val_len = unpack_header(buffer, position)
+            record_type = key_len >> RECORD_TYPE_SHIFT
+            key_len &= KEY_LENGTH_MASK
+            end = position + HEADER_SIZE + key_len + val_len
+            if record_type == RECORD_PUT and end <= available and val_len <= MAX_VALUE_LENGTH:
+                # The common case: a plain SET that is fully buffered
+                key_end = position + HEADER_SIZE + key_len
+                yield (buffer[position + HEADER_SIZE:key_end].decode('utf-8'),
+                       buffer[key_end:end].decode('utf-8'), 0)
+                position = end
+                continue
+
+            offset = base + position
+            flags = record_type & ~RECORD_TYPE_MASK
+            record_type &= RECORD_TYPE_MASK
+            # The same limits as recovery, so an import never takes a
+            # record that reopening the store would throw away
+            if (key_len > MAX_KEY_LENGTH or val_len > MAX_VALUE_LENGTH
+                    or flags & ~(RECORD_FLAG_TTL | RECORD_FLAG_COMPRESSED)
+                    or (flags & RECORD_FLAG_COMPRESSED and record_type != RECORD_PUT)
+                    or record_type not in (RECORD_PUT, RECORD_BATCH, RECORD_DELETE,
+                                           RECORD_CHUNK, RECORD_LARGE)
+                    or (flags & RECORD_FLAG_TTL and val_len < EXPIRY.size)
+                    or (record_type == RECORD_CHUNK and (key_len or flags))
+                    or (record_type == RECORD_LARGE
+                        and val_len != LARGE_INFO.size + (EXPIRY.size if flags else 0))):
+                raise ValueError(f"offset {offset}: not a valid record")
+            if record_type == RECORD_BATCH:
+                if key_len or val_len != BATCH_INFO.size:
+                    raise ValueError(f"offset {offset}: invalid batch header")
+                if end <= available:
+                    _, payload_len, payload_crc = BATCH_INFO.unpack_from(buffer, position + HEADER_SIZE)
+                    if end + payload_len <= available:
+                        if zlib.crc32(buffer[end:end + payload_len]) != payload_crc:
+                            raise ValueError(f"offset {offset}: batch is corrupted")
+                        position = end
+                        continue
+                    end += payload_len
+            elif end <= available:
+                key_start = position + HEADER_SIZE
+                value_start = key_start + key_len
+                position = end
+                if record_type == RECORD_CHUNK:
+                    chunks.append(buffer[value_start:end])
+                    continue
+                key = buffer[key_start:value_start].decode('utf-8')
+                if record_type == RECORD_DELETE:
+                    yield key, None, 0
+                    continue
+                expires_at = 0
+                if flags & RECORD_FLAG_TTL:
+                    expires_at = unpack_expiry(buffer, value_start)[0]
+                    value_start += EXPIRY.size
+                if record_type == RECORD_LARGE:
+                    length, _, chunk_size, crc = LARGE_INFO.unpack_from(buffer, value_start)
+                    count = -(-length // chunk_size) if chunk_size else 0
+                    value = b''.join(chunks[len(chunks) - count:]) if count else b''
+                    chunks = []
+                    if len(value) != length or zlib.crc32(value) != crc:
+                        raise ValueError(f"offset {offset}: large value is missing chunks or corrupted")
+                    yield key, value.decode('utf-8'), expires_at
+                elif flags & RECORD_FLAG_COMPRESSED:
+                    try:
+                        value = decompress(buffer[value_start:end], dictionary)
+                    except ValueError as e:
+                        raise ValueError(f"offset {offset}: {e}") from None
+                    yield key, value.decode('utf-8'), expires_at
+                else:
+                    yield key, buffer[value_start:end].decode('utf-8'), expires_at
+                continue
+            needed = end - position
+
+        # The next record isn't fully buffered: keep the rest and read more
+        chunk = stream.read(max(chunk_size, needed))
+        if not chunk:
+            if position < available:
+                raise ValueError(f"offset {base + position}: incomplete record")
+            return
+        base += position
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+def write_records(stream: BinaryIO, records: Iterable[Record], fmt: str,
+                  buffer_bytes: int = 1024 * 1024) -> int:
+    """
+    Write records to a binary stream, buffering about `buffer_bytes` per write.
+
+    Args:
+        stream: Opened in binary mode (a file, or sys.stdout.buffer)
+        records: (key, value, expires_at) tuples; deletes are not allowed
+        fmt: One of FORMATS
+
+    Returns:
+        How many records I wrote
+
+    Raises:
+        ValueError: If the format is unknown
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format '{fmt}' (expected one of {', '.join(FORMATS)})")
+    parts = []
+    size = 0
+    count = 0
+    for key, value, expires_at in records:
+        if fmt == "native":
+            key_bytes = key.encode('utf-8')
+            value_bytes = value.encode('utf-8')
+            if len(value_bytes) > (MAX_TTL_VALUE_LENGTH if expires_at else MAX_VALUE_LENGTH):
+                part = _encode_large(key_bytes, value_bytes, expires_at)
+            elif expires_at:
+                part = b''.join((RECORD_HEADER.pack(
+                                     len(key_bytes) | (RECORD_FLAG_TTL << RECORD_TYPE_SHIFT),
+                                     len(value_bytes) + EXPIRY.size),
+                                 key_bytes, EXPIRY.pack(expires_at), value_bytes))
+            else:
+                part = RECORD_HEADER.pack(len(key_bytes), len(value_bytes)) + key_bytes + value_bytes
+        elif fmt == "tsv":
+            line = key.translate(_ESCAPES) + "\t" + value.translate(_ESCAPES)
+            if expires_at:
+                line += f"\t{expires_at}"
+            part = (line + "\n").encode('utf-8')
+        else:
+            item = {"key": key, "value": value}
+            if expires_at:
+                item["expires_at"] = expires_at
+            part = (json.dumps(item, ensure_ascii=False) + "\n").encode('utf-8')
+        parts.append(part)
+        size += len(part)
+        count += 1
+        if size >= buffer_bytes:
+            stream.write(b''.join(parts))
+            parts = []
+            size = 0
+    if parts:
+        stream.write(b''.join(parts))
+    stream.flush()
+    return count
+
+
+def _encode_large(key_bytes: bytes, value_bytes: bytes, expires_at: int) -> bytes:
+    """
+    Chunk records plus a manifest for one value, in the layout
+    SimpleKVStore.set_stream() writes.
+    """
+    chunk_header = RECORD_CHUNK << RECORD_TYPE_SHIFT
+    parts = []
+    for start in range(0, len(value_bytes), LARGE_CHUNK_SIZE):
+        chunk = value_bytes[start:start + LARGE_CHUNK_SIZE]
+        parts.append(RECORD_HEADER.pack(chunk_header, len(chunk)))
+        parts.append(chunk)
+    chunks_length = sum(len(part) for part in parts)
+    record_type = RECORD_LARGE | (RECORD_FLAG_TTL if expires_at else 0)
+    prefix = EXPIRY.pack(expires_at) if expires_at else b''
+    parts.append(RECORD_HEADER.pack(len(key_bytes) | (record_type << RECORD_TYPE_SHIFT),
+                                    len(prefix) + LARGE_INFO.size))
+    parts.append(key_bytes)
+    parts.append(prefix)
+    parts.append(LARGE_INFO.pack(len(value_bytes),
+                                 chunks_length + HEADER_SIZE + len(key_bytes) + len(prefix),
+                                 LARGE_CHUNK_SIZE, zlib.crc32(value_bytes)))
+    return b''.join(parts)
+
+
+def open_input(path: str) -> BinaryIO:
+    """Open a file for read_records(), with "-" meaning stdin."""
+    return sys.stdin.buffer if path == "-" else open(path, 'rb')
+
+
+def open_output(path: str) -> BinaryIO:
+    """Open a file for write_records(), with "-" meaning stdout."""
+    return sys.stdout.buffer if path == "-" else open(path, 'wb')
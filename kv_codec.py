@@ -0,0 +1,263 @@
+"""
+Per-record value compression for the Simple Persistent Key-Value Store.
+
+A compressed record has RECORD_FLAG_COMPRESSED set and its value (after the
+expiry time, if any) is one of:
+
+- [CODEC_ZLIB: 1][raw deflate stream]
+- [CODEC_LZMA: 1][raw LZMA2 stream]
+- [CODEC_ZLIB_DICT: 1][dictionary number: 4][raw deflate stream that was
+  primed with that dictionary]
+
+The raw formats leave out the zlib/xz headers and checksums, which would
+cost 6 to 60 bytes on every record. A dictionary helps small values most:
+a 200-byte JSON document has too little repetition of its own, but its
+field names and common values are all in a dictionary trained from other
+values (train_dictionary). Dictionaries are never changed once written,
+as <data_file>.zdict.<number> next to the log, since old records keep
+referring to them.
+"""
+
+import os
+import lzma
+import zlib
+import heapq
+import struct
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_ZLIB_DICT = 3
+COMPRESSIONS = ("zlib", "lzma")
+
+DICTIONARY_NUMBER = struct.Struct(">I")
+
+# Deflate only looks back 32KB, so a bigger dictionary is never used
+MAX_DICTIONARY_BYTES = 32 * 1024
+
+# Values up to this size use the dictionary when there is one; longer ones
+# have enough repetition of their own and use the configured codec
+DICTIONARY_VALUE_BYTES = 16 * 1024
+
+# Dictionary file: [magic: 8][crc32 of the data: 4][data]
+DICTIONARY_MAGIC = b"KVZDICT1"
+DICTIONARY_HEADER = struct.Struct(">8sI")
+
+# Values are at most 1MB, so a bigger LZMA window only costs memory
+_LZMA_WINDOW = 1 << 20
+
+
+def _lzma_filters(preset: int = 6) -> List[Dict[str, int]]:
+    return [{"id": lzma.FILTER_LZMA2, "preset": preset, "dict_size": _LZMA_WINDOW}]
+
+
+def dictionary_path(data_file: str, number: int) -> str:
+    """
+    File name of compression dictionary `number` of a store.
+    """
+    return f"{data_file}.zdict.{number:06d}"
+
+
+def list_dictionaries(data_file: str) -> List[int]:
+    """
+    Numbers of the dictionaries stored next to a data file, in order.
+    """
+    directory = os.path.dirname(os.path.abspath(data_file))
+    prefix = os.path.basename(data_file) + ".zdict."
+    numbers = []
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and name[len(prefix):].isdigit():
+            numbers.append(int(name[len(prefix):]))
+    return sorted(numbers)
+
+
+def read_dictionary(path: str) -> bytes:
+    """
+    Read a dictionary file and check its CRC.
+
+    Raises:
+        OSError: If the file can't be read, or is torn or corrupted
+    """
+    with open(path, 'rb') as file_handle:
+        blob = file_handle.read()
+    if len(blob) < DICTIONARY_HEADER.size:
+        raise OSError(f"Compression dictionary {path} is incomplete")
+    magic, crc = DICTIONARY_HEADER.unpack_from(blob)
+    data = blob[DICTIONARY_HEADER.size:]
+    if magic != DICTIONARY_MAGIC or zlib.crc32(data) != crc:
+        raise OSError(f"Compression dictionary {path} is corrupted")
+    return data
+
+
+def load_dictionaries(data_file: str) -> Dict[int, bytes]:
+    """
+    Every dictionary stored next to a data file, by number.
+    """
+    return {number: read_dictionary(dictionary_path(data_file, number))
+            for number in list_dictionaries(data_file)}
+
+
+def write_dictionary(path: str, data: bytes) -> None:
+    """
+    Write a dictionary file durably: temp file, fsync, rename, fsync the
+    directory. A dictionary must be on disk before any record uses it.
+    """
+    temp_file = path + ".tmp"
+    with open(temp_file, 'wb') as file_handle:
+        file_handle.write(DICTIONARY_HEADER.pack(DICTIONARY_MAGIC, zlib.crc32(data)))
+        file_handle.write(data)
+        file_handle.flush()
+        os.fsync(file_handle.fileno())
+    os.replace(temp_file, path)
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def train_dictionary(samples: Iterable[bytes], size: int = MAX_DICTIONARY_BYTES,
+                     segment_bytes: int = 64, dmer_bytes: int = 8) -> bytes:
+    """
+    Build a deflate dictionary out of the pieces the samples share.
+
+    This is a simplified version of zstd's COVER trainer. Every 8-byte
+    substring ("dmer") is scored by how many samples contain it. Each
+    sample is cut into overlapping segments of segment_bytes, and I
+    greedily pick the segment whose not yet covered dmers score highest,
+    until the dictionary is full or nothing shared is left. Picking a
+    segment covers its dmers, so the next pick favors what is still missing.
+    The best segments go last, where deflate reaches them with the shortest
+    distances.
+
+    Args:
+        samples: Values typical of what will be stored
+        size: Dictionary size limit in bytes
+        segment_bytes: Length of the pieces the dictionary is made of
+        dmer_bytes: Length of the substrings I count
+
+    Returns:
+        The dictionary (empty if the samples share nothing)
+    """
+    samples = [bytes(sample) for sample in samples if len(sample) >= dmer_bytes]
+    frequency: Counter = Counter()
+    for sample in samples:
+        frequency.update({sample[i:i + dmer_bytes] for i in range(len(sample) - dmer_bytes + 1)})
+
+    # Identical segments are common in redundant data, so I score each once
+    step = max(1, segment_bytes // 2)
+    candidates = set()
+    for sample in samples:
+        for start in range(0, max(1, len(sample) - segment_bytes + step), step):
+            candidates.add(sample[start:start + segment_bytes])
+
+    def dmers(segment: bytes) -> set:
+        return {segment[i:i + dmer_bytes] for i in range(len(segment) - dmer_bytes + 1)}
+
+    def score(segment: bytes) -> int:
+        # A dmer only one sample has is no use to the others
+        return sum(count for count in map(frequency.__getitem__, dmers(segment)) if count > 1)
+
+    # Scores only go down as dmers get covered, so a popped candidate whose
+    # rescored value still beats the next one in the heap is the best one
+    heap = [(-score(segment), segment) for segment in candidates]
+    heapq.heapify(heap)
+    chosen: List[bytes] = []
+    total = 0
+    while heap and total < size:
+        _, segment = heapq.heappop(heap)
+        current = score(segment)
+        if heap and current < -heap[0][0]:
+            heapq.heappush(heap, (-current, segment))
+            continue
+        if current == 0:
+            break
+        chosen.append(segment)
+        total += len(segment)
+        for dmer in dmers(segment):
+            frequency[dmer] = 0
+    return b''.join(reversed(chosen))[-size:] if chosen else b''
+
+
+class Compressor:
+    """
+    Encodes values for new records: compress() returns the stored form, or
+    None when the value should be stored as is. Stateless and thread-safe.
+    """
+
+    def __init__(self, codec: str = "zlib", min_bytes: int = 64, level: Optional[int] = None,
+                 dictionary: Optional[Tuple[int, bytes]] = None) -> None:
+        """
+        Args:
+            codec: "zlib" or "lzma"
+            min_bytes: Values shorter than this are never compressed
+            level: Compression level (default: 6 for both codecs)
+            dictionary: (number, data) of the dictionary for small values
+
+        Raises:
+            ValueError: If the codec is unknown
+        """
+        if codec not in COMPRESSIONS:
+            raise ValueError(f"compression must be one of {', '.join(COMPRESSIONS)}")
+        self.codec = codec
+        self.min_bytes = min_bytes
+        self.level = 6 if level is None else level
+        self.dictionary = dictionary
+        self._lzma_filters = _lzma_filters(self.level)
+        self._primed = None
+        if dictionary is not None and dictionary[1]:
+            # Priming a compressor with the dictionary costs more than
+            # copying a primed one, so I keep one to copy from
+            self._primed = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=dictionary[1])
+            self._dictionary_prefix = bytes([CODEC_ZLIB_DICT]) + DICTIONARY_NUMBER.pack(dictionary[0])
+
+    def compress(self, data: bytes) -> Optional[bytes]:
+        """
+        The stored form of a value, or None if it is too short or doesn't
+        get any shorter.
+        """
+        if len(data) < self.min_bytes:
+            return None
+        if self._primed is not None and len(data) <= DICTIONARY_VALUE_BYTES:
+            compressor = self._primed.copy()
+            stored = self._dictionary_prefix + compressor.compress(data) + compressor.flush()
+        elif self.codec == "zlib":
+            stored = bytes([CODEC_ZLIB]) + zlib.compress(data, self.level, wbits=-15)
+        else:
+            stored = bytes([CODEC_LZMA]) + lzma.compress(data, format=lzma.FORMAT_RAW,
+                                                         filters=self._lzma_filters)
+        return stored if len(stored) < len(data) else None
+
+
+def decompress(stored, dictionary: Callable[[int], bytes]) -> bytes:
+    """
+    Decode the stored form of a compressed value.
+
+    Args:
+        stored: bytes or memoryview of the value as it is in the record
+        dictionary: Returns dictionary data by number
+
+    Raises:
+        ValueError: If the codec is unknown or the data is corrupted
+    """
+    view = memoryview(stored)
+    if not view:
+        raise ValueError("compressed value is empty")
+    codec = view[0]
+    try:
+        if codec == CODEC_ZLIB:
+            return zlib.decompress(view[1:], -15)
+        if codec == CODEC_LZMA:
+            return lzma.decompress(view[1:], format=lzma.FORMAT_RAW, filters=_lzma_filters())
+        if codec == CODEC_ZLIB_DICT:
+            number = DICTIONARY_NUMBER.unpack_from(view, 1)[0]
+            decompressor = zlib.decompressobj(-15, zdict=dictionary(number))
+            data = decompressor.decompress(view[1 + DICTIONARY_NUMBER.size:])
+            if not decompressor.eof:
+                raise ValueError("compressed value is truncated")
+            return data
+    except (zlib.error, lzma.LZMAError, struct.error) as e:
+        raise ValueError(f"compressed value is corrupted: {e}") from None
+    raise ValueError(f"unknown compression codec {codec}")
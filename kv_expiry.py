@@ -0,0 +1,134 @@
+"""
+Key expiry scheduling for the Simple Persistent Key-Value Store.
+
+TimingWheel is a hierarchical timing wheel (Varghese & Lauck), the same
+idea as the Linux kernel's timer wheel and Kafka's purgatory. Scheduling
+an expiry is O(1), and advancing the clock touches only the slots that
+come due, plus an occasional cascade that moves far-off entries one level
+closer. So the cost per expiring key is O(1) amortized, no matter how many
+keys have a TTL, and nothing ever scans the index.
+"""
+
+import time
+from typing import Hashable, List, Tuple
+
+
+def now_ms() -> int:
+    """
+    Wall clock time in milliseconds, the unit expiry times are stored in.
+
+    Expiry times go into the log, so they have to be absolute wall clock
+    times that still mean the same thing after a restart.
+    """
+    return int(time.time() * 1000)
+
+
+class TimingWheel:
+    """
+    A hierarchical timing wheel of (item, deadline) entries.
+
+    Level 0 has 256 slots of one tick each. Each level above has 64 slots,
+    each covering a whole turn of the level below (256, 16384, ... ticks).
+    An entry goes into the lowest level whose range covers its deadline.
+    When a lower level wraps around, the next level's current slot is
+    cascaded down. With a 10ms tick the five levels reach about 16 months;
+    anything further out waits in the top level and is re-placed each time
+    that level turns over.
+
+    I don't support removal. If an item is rescheduled or deleted, the
+    caller just ignores the stale entry when it fires (compare the deadline
+    with the current one). This keeps schedule() to one list append.
+
+    Not thread-safe: the caller serializes access.
+    """
+
+    LEVEL_BITS = (8, 6, 6, 6, 6)
+
+    def __init__(self, tick_ms: int = 10, start_ms: int = None) -> None:
+        """
+        Args:
+            tick_ms: Resolution of the wheel; entries fire at most one tick late
+            start_ms: The wheel's initial time (default: now)
+        """
+        self.tick_ms = tick_ms
+        self._tick = (now_ms() if start_ms is None else start_ms) // tick_ms
+        self._levels: List[List[List[Tuple[Hashable, int]]]] = [
+            [[] for _ in range(1 << bits)] for bits in self.LEVEL_BITS]
+        self._shifts = []
+        shift = 0
+        for bits in self.LEVEL_BITS:
+            self._shifts.append(shift)
+            shift += bits
+        self._size = 0
+
+    def __len__(self) -> int:
+        """Scheduled entries, including stale ones that haven't fired yet."""
+        return self._size
+
+    def schedule(self, item: Hashable, deadline_ms: int) -> None:
+        """
+        Fire `item` once the clock passes `deadline_ms`.
+        """
+        self._place(item, deadline_ms)
+        self._size += 1
+
+    def _place(self, item: Hashable, deadline_ms: int) -> None:
+        # Round up, so nothing fires before its deadline
+        tick = max(-(-deadline_ms // self.tick_ms), self._tick + 1)
+        delta = tick - self._tick
+        for level, bits in enumerate(self.LEVEL_BITS):
+            shift = self._shifts[level]
+            if delta < (1 << (shift + bits)) or level == len(self.LEVEL_BITS) - 1:
+                if level == len(self.LEVEL_BITS) - 1 and delta >= (1 << (shift + bits)):
+                    # Beyond the top level's range: park it in the slot that
+                    # turns over last, and it gets re-placed from there
+                    tick = self._tick + (1 << (shift + bits)) - (1 << shift)
+                slot = (tick >> shift) & ((1 << bits) - 1)
+                self._levels[level][slot].append((item, deadline_ms))
+                return
+
+    def advance(self, until_ms: int = None) -> List[Tuple[Hashable, int]]:
+        """
+        Move the clock forward and collect every entry that came due.
+
+        Args:
+            until_ms: The new time (default: now)
+
+        Returns:
+            (item, deadline_ms) for each entry whose deadline has passed
+        """
+        target = (now_ms() if until_ms is None else until_ms) // self.tick_ms
+        fired: List[Tuple[Hashable, int]] = []
+        level0 = self._levels[0]
+        mask0 = (1 << self.LEVEL_BITS[0]) - 1
+        while self._tick < target:
+            if not self._size:
+                # Nothing scheduled, so there is nothing to step through
+                self._tick = target
+                break
+            self._tick += 1
+            tick = self._tick
+            if tick & mask0 == 0:
+                self._cascade(tick)
+            slot = level0[tick & mask0]
+            if slot:
+                level0[tick & mask0] = []
+                self._size -= len(slot)
+                fired.extend(slot)
+        return fired
+
+    def _cascade(self, tick: int) -> None:
+        """
+        Level 0 just wrapped: pull the current slot of each level above
+        down into the levels below, as far up as the wrap reaches.
+        """
+        for level in range(1, len(self.LEVEL_BITS)):
+            shift = self._shifts[level]
+            bits = self.LEVEL_BITS[level]
+            slot_index = (tick >> shift) & ((1 << bits) - 1)
+            slot = self._levels[level][slot_index]
+            self._levels[level][slot_index] = []
+            for item, deadline_ms in slot:
+                self._place(item, deadline_ms)
+            if slot_index != 0:
+                break
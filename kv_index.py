@@ -0,0 +1,439 @@
+"""
+Index structures for the Simple Persistent Key-Value Store.
+
+SimpleKVStore maps every key to an IndexEntry (segment, value offset, value
+length). By default that map is a plain dict, which costs a str object, an
+IndexEntry object and a dict slot per key - well over 100 bytes before the
+key itself. CompactIndex keeps the same mapping in a handful of flat arrays
+instead, for keyspaces too large to hold as Python objects.
+
+OrderedKeys is a secondary structure that keeps the keys sorted, so range
+and prefix scans don't need a pass over the whole hash index.
+"""
+
+import bisect
+import threading
+from array import array
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+
+class IndexEntry:
+    """
+    Represents a single entry in the index.
+
+    I'm using a class instead of plain tuples because it provides better structure
+    and makes the code more maintainable.
+
+    I store where the value bytes start rather than where the record
+    header starts, so a GET can fetch the value with a single read and never
+    has to parse the header again.
+
+    Two entries are equal when they point at the same bytes. CompactIndex
+    hands out a fresh IndexEntry on every lookup, so code that asks "is this
+    key still where I saw it?" has to compare with == rather than `is`.
+
+    Attributes:
+        value_offset: File offset where the value bytes begin
+        value_length: Length of the value in bytes
+        segment: Id of the log segment that holds the record
+    """
+    __slots__ = ['value_offset', 'value_length', 'segment']  # I use __slots__ for memory optimization
+
+    def __init__(self, value_offset: int, value_length: int, segment: int = 0) -> None:
+        self.value_offset = value_offset
+        self.value_length = value_length
+        self.segment = segment
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, IndexEntry):
+            return NotImplemented
+        return (self.value_offset == other.value_offset
+                and self.segment == other.segment
+                and self.value_length == other.value_length)
+
+    __hash__ = None  # entries are mutable, so they can't be dict keys
+
+
+# Slot markers in CompactIndex's hash table
+_EMPTY = -1
+_DELETED = -2
+
+
+class _Tables:
+    """
+    The arrays behind one CompactIndex generation.
+
+    Row i describes one (key, entry) pair: its key bytes are
+    arena[key_offset[i]:key_offset[i] + key_length[i]]. slots is the open
+    addressing table and holds row numbers (or _EMPTY/_DELETED).
+    """
+    __slots__ = ['arena', 'key_offset', 'key_length', 'key_hash',
+                 'value_offset', 'value_length', 'segment', 'slots', 'used']
+
+    def __init__(self, capacity: int) -> None:
+        self.arena = bytearray()
+        self.key_offset = array('Q')
+        self.key_length = array('I')
+        self.key_hash = array('q')
+        self.value_offset = array('Q')
+        self.value_length = array('I')
+        self.segment = array('I')
+        self.slots = array('i', [_EMPTY]) * capacity
+        self.used = 0  # slots that are not _EMPTY (live rows plus _DELETED markers)
+
+
+class CompactIndex:
+    """
+    A key -> IndexEntry map stored in flat arrays instead of Python objects.
+
+    Layout:
+    - All key bytes live back to back in one bytearray (the arena)
+    - Each row's key position, key hash, value offset, value length and
+      segment live in typed array columns (8+4+8+8+4+4 bytes)
+    - An open addressing table with linear probing maps hash -> row, kept
+      at most 2/3 full so lookups stay O(1)
+
+    That is roughly 50 bytes plus the key per entry, against ~200 for a dict
+    of str -> IndexEntry.
+
+    It supports the parts of the dict interface SimpleKVStore uses (get,
+    [], in, len, del, pop, items, values, keys, clear). get() builds a new
+    IndexEntry on every call, so compare entries with ==, not `is`.
+
+    Concurrency: writers must be serialized by the caller (the store's write
+    lock), but lookups are safe from any thread without a lock. An update
+    never changes a row in place - I append a new row and then repoint the
+    slot, which is a single array store. A reader therefore sees either the
+    old entry or the new one, never half of each. Rows orphaned by updates
+    are reclaimed by rebuilding all the arrays into a new _Tables object and
+    swapping it in with one attribute assignment.
+    """
+
+    def __init__(self, capacity: int = 8) -> None:
+        """
+        Args:
+            capacity: Number of keys to make room for up front
+        """
+        self._tables = _Tables(self._slot_count(capacity))
+        self._live = 0
+
+    @staticmethod
+    def _slot_count(keys: int) -> int:
+        """
+        The power-of-two table size that holds `keys` at <= 2/3 load.
+        """
+        size = 8
+        while size * 2 < keys * 3:
+            size *= 2
+        return size
+
+    def _find(self, tables: _Tables, key_bytes: bytes, key_hash: int) -> Tuple[int, int]:
+        """
+        Probe for a key.
+
+        Returns:
+            (slot, row): the slot holding the key and its row, or, when the
+            key is absent, the slot an insert should use and -1
+        """
+        slots = tables.slots
+        hashes = tables.key_hash
+        lengths = tables.key_length
+        offsets = tables.key_offset
+        arena = tables.arena
+        mask = len(slots) - 1
+        size = len(key_bytes)
+        slot = key_hash & mask
+        free = -1
+        while True:
+            row = slots[slot]
+            if row == _EMPTY:
+                return (slot if free < 0 else free), -1
+            if row == _DELETED:
+                if free < 0:
+                    free = slot
+            elif hashes[row] == key_hash and lengths[row] == size:
+                start = offsets[row]
+                if arena[start:start + size] == key_bytes:
+                    return slot, row
+            slot = (slot + 1) & mask
+
+    def get(self, key: str, default: Optional[IndexEntry] = None) -> Optional[IndexEntry]:
+        tables = self._tables
+        key_bytes = key.encode('utf-8')
+        _, row = self._find(tables, key_bytes, hash(key_bytes))
+        if row < 0:
+            return default
+        return IndexEntry(tables.value_offset[row], tables.value_length[row], tables.segment[row])
+
+    def __getitem__(self, key: str) -> IndexEntry:
+        entry = self.get(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and self.get(key) is not None
+
+    def __len__(self) -> int:
+        return self._live
+
+    def __setitem__(self, key: str, entry: IndexEntry) -> None:
+        tables = self._tables
+        key_bytes = key.encode('utf-8')
+        key_hash = hash(key_bytes)
+        slot, row = self._find(tables, key_bytes, key_hash)
+
+        # I append the new row before publishing it in the slot, so a
+        # concurrent reader never sees a row that isn't fully written
+        new_row = len(tables.key_offset)
+        if row >= 0:
+            tables.key_offset.append(tables.key_offset[row])
+        else:
+            tables.key_offset.append(len(tables.arena))
+            tables.arena += key_bytes
+        tables.key_length.append(len(key_bytes))
+        tables.key_hash.append(key_hash)
+        tables.value_offset.append(entry.value_offset)
+        tables.value_length.append(entry.value_length)
+        tables.segment.append(entry.segment)
+
+        if row < 0:
+            self._live += 1
+            if tables.slots[slot] == _EMPTY:
+                tables.used += 1
+        tables.slots[slot] = new_row
+
+        # Every update orphans a row, so I rebuild once they outnumber the
+        # live ones; a fuller table just gets more slots
+        if new_row + 1 > 2 * self._live + 1024:
+            self._rebuild(self._live)
+        elif tables.used * 3 > len(tables.slots) * 2:
+            self._rebuild(self._live, keep_rows=True)
+
+    def __delitem__(self, key: str) -> None:
+        tables = self._tables
+        key_bytes = key.encode('utf-8')
+        slot, row = self._find(tables, key_bytes, hash(key_bytes))
+        if row < 0:
+            raise KeyError(key)
+        tables.slots[slot] = _DELETED
+        self._live -= 1
+
+    def pop(self, key: str, *default):
+        entry = self.get(key)
+        if entry is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        del self[key]
+        return entry
+
+    def clear(self) -> None:
+        self._tables = _Tables(self._slot_count(0))
+        self._live = 0
+
+    def reserve(self, keys: int) -> None:
+        """
+        Grow the hash table to hold `keys` entries without rehashing.
+
+        _rebuild_index calls this before a bulk load, so loading N keys
+        costs one table allocation instead of log(N) resizes.
+        """
+        if self._slot_count(keys) > len(self._tables.slots):
+            self._rebuild(keys, keep_rows=True)
+
+    def _rows(self, tables: _Tables) -> Iterator[int]:
+        """
+        The rows that the hash table currently points to.
+        """
+        for row in tables.slots:
+            if row >= 0:
+                yield row
+
+    def _rebuild(self, keys: int, keep_rows: bool = False) -> None:
+        """
+        Build a new hash table sized for `keys` and swap it in.
+
+        With keep_rows I only rehash into a bigger table and share the
+        columns with the old generation. Otherwise I also copy the live rows
+        (and their keys) into fresh columns, dropping orphaned rows and keys.
+        """
+        old = self._tables
+        size = self._slot_count(max(keys, self._live))
+        if keep_rows:
+            tables = _Tables(0)
+            for name in ('arena', 'key_offset', 'key_length', 'key_hash',
+                         'value_offset', 'value_length', 'segment'):
+                setattr(tables, name, getattr(old, name))
+            rows: List[int] = list(self._rows(old))
+            tables.slots = array('i', [_EMPTY]) * size
+        else:
+            tables = _Tables(size)
+            rows = []
+            for row in self._rows(old):
+                start = old.key_offset[row]
+                length = old.key_length[row]
+                tables.key_offset.append(len(tables.arena))
+                tables.arena += old.arena[start:start + length]
+                tables.key_length.append(length)
+                tables.key_hash.append(old.key_hash[row])
+                tables.value_offset.append(old.value_offset[row])
+                tables.value_length.append(old.value_length[row])
+                tables.segment.append(old.segment[row])
+                rows.append(len(rows))
+
+        slots = tables.slots
+        hashes = tables.key_hash
+        mask = size - 1
+        for row in rows:
+            slot = hashes[row] & mask
+            while slots[slot] != _EMPTY:
+                slot = (slot + 1) & mask
+            slots[slot] = row
+        tables.used = len(rows)
+        self._tables = tables
+
+    def items(self) -> Iterator[Tuple[str, IndexEntry]]:
+        tables = self._tables
+        for row in self._rows(tables):
+            start = tables.key_offset[row]
+            key = tables.arena[start:start + tables.key_length[row]].decode('utf-8')
+            yield key, IndexEntry(tables.value_offset[row], tables.value_length[row],
+                                  tables.segment[row])
+
+    def keys(self) -> Iterator[str]:
+        for key, _ in self.items():
+            yield key
+
+    __iter__ = keys
+
+    def values(self) -> Iterator[IndexEntry]:
+        tables = self._tables
+        for row in self._rows(tables):
+            yield IndexEntry(tables.value_offset[row], tables.value_length[row],
+                             tables.segment[row])
+
+    def memory_bytes(self) -> int:
+        """
+        Bytes held by my arrays (excluding unused array capacity).
+        """
+        tables = self._tables
+        return (len(tables.arena)
+                + sum(column.itemsize * len(column)
+                      for column in (tables.key_offset, tables.key_length, tables.key_hash,
+                                     tables.value_offset, tables.value_length,
+                                     tables.segment, tables.slots)))
+
+
+class OrderedKeys:
+    """
+    The store's keys in sorted order: a sorted list plus small buffers.
+
+    New keys go into an unsorted buffer and removed keys into a tombstone
+    set, so keeping the order costs O(1) per write. I merge both into the
+    sorted list only when a range query needs it; for a few keys that's a
+    handful of insort calls, for many it's one sort, which is close to
+    linear because Python's sort spots the two sorted runs.
+
+    Python compares strings by code point, which is also the order of their
+    UTF-8 bytes, so this matches byte order on disk.
+
+    The caller tells me about key set changes only: add() for a key that
+    isn't in the index yet and discard() for a key leaving it. I have my own
+    lock because queries (which merge) can run on reader threads while the
+    store's writer thread adds keys.
+    """
+
+    # Up to this many buffered keys I insert one by one instead of re-sorting
+    INSORT_LIMIT = 64
+
+    def __init__(self, keys: Iterable[str] = ()) -> None:
+        self._keys: List[str] = sorted(keys)
+        self._added = set()
+        self._removed = set()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._keys) + len(self._added) - len(self._removed)
+
+    def add(self, key: str) -> None:
+        with self._lock:
+            if key in self._removed:
+                # It never left the sorted list
+                self._removed.discard(key)
+            else:
+                self._added.add(key)
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            if key in self._added:
+                self._added.discard(key)
+            else:
+                self._removed.add(key)
+
+    def _merge(self) -> None:
+        """
+        Fold the buffers into the sorted list. The caller holds my lock.
+        """
+        keys = self._keys
+        if self._removed:
+            removed = self._removed
+            keys = self._keys = [key for key in keys if key not in removed]
+            self._removed = set()
+        if self._added:
+            if len(self._added) <= self.INSORT_LIMIT:
+                for key in self._added:
+                    bisect.insort(keys, key)
+            else:
+                keys.extend(self._added)
+                keys.sort()
+            self._added = set()
+
+    def slice(self, low: Optional[str] = None, high: Optional[str] = None,
+              limit: Optional[int] = None, after: bool = False) -> List[str]:
+        """
+        Sorted keys in [low, high), at most `limit` of them.
+
+        Args:
+            low: Smallest key to return (None: from the first key)
+            high: Stop before this key (None: to the last key)
+            limit: Maximum number of keys (None: no limit)
+            after: Exclude `low` itself - used to resume after a cursor
+        """
+        with self._lock:
+            self._merge()
+            keys = self._keys
+            if low is None:
+                start = 0
+            elif after:
+                start = bisect.bisect_right(keys, low)
+            else:
+                start = bisect.bisect_left(keys, low)
+            stop = len(keys) if high is None else bisect.bisect_left(keys, high, start)
+            if limit is not None:
+                stop = min(stop, start + limit)
+            return keys[start:stop]
+
+
+def prefix_end(prefix: str) -> Optional[str]:
+    """
+    The smallest string greater than every string that starts with `prefix`.
+
+    Returns:
+        The exclusive upper bound for a prefix scan, or None if there is
+        none (empty prefix, or one made only of the largest code point)
+    """
+    while prefix:
+        last = ord(prefix[-1])
+        if last < 0x10FFFF:
+            return prefix[:-1] + chr(last + 1)
+        prefix = prefix[:-1]
+    return None
+
+
+# Index engines selectable with SimpleKVStore(index_engine=...)
+INDEX_ENGINES = {
+    "dict": dict,
+    "compact": CompactIndex,
+}
@@ -0,0 +1,1261 @@
+"""
+Log-structured merge (LSM) engine for the Simple Persistent Key-Value Store.
+
+SimpleKVStore keeps every key in its in-memory index, so the key space is
+limited by RAM. LSMKVStore keeps only recent writes in memory and
+everything else in sorted files on disk:
+
+- A SET is appended to a write-ahead log (SimpleKVStore's record format,
+  one write and one fsync) and then put in the memtable, a dict of recent
+  writes.
+- Once the memtable reaches memtable_bytes it is frozen, a new log is
+  started, and a background thread writes the frozen memtable out as an
+  SSTable: an immutable file of records sorted by key. Only its sparse
+  index (the first key of every ~4KB block) and its bloom filter stay in
+  memory, a couple of bytes per key instead of an index entry per key.
+- GET checks the memtables, then the tables from newest to oldest. A
+  table's bloom filter rules out ~99% of the tables that don't hold the
+  key, so a GET usually reads one block, and a miss usually none.
+- Leveled compaction, as in LevelDB, merges tables in the background.
+  Level 0 holds whole flushed memtables, which may overlap. Every level
+  below is one sorted run of non-overlapping tables and may grow ten times
+  larger than the level above, so a GET probes at most one table there.
+  Tombstones and expired keys are dropped once nothing older is below them.
+
+LSMKVStore is a SimpleKVStore subclass: set(), mset(), delete(), scan() and
+the whole command layer (execute(), run(), kv_server) are inherited as
+they are. I only replace what touches the in-memory index.
+
+A store is a directory:
+    MANIFEST      JSON: the tables in each level, the live logs, the next file number
+    000007.log    write-ahead log of the memtable (or the one being flushed)
+    000012.sst    SSTable
+
+An SSTable is:
+    data blocks   Records in key order in the log record format (PUT, PUT
+                  with TTL, DELETE); a block is cut once it reaches block_bytes
+    block index   Per block: [key_length: 4][offset: 8][crc32: 4][first key]
+    bloom filter  [hash_count: 4][bits]
+    largest key
+    footer        TABLE_FOOTER
+"""
+
+import os
+import sys
+import json
+import heapq
+import bisect
+import struct
+import hashlib
+import threading
+import zlib
+from array import array
+from time import perf_counter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from kv_store import SimpleKVStore, _PendingWrite, scan_segment, RECORD_HEADER, HEADER_SIZE, \
+    RECORD_DELETE, RECORD_TYPE_MASK, RECORD_FLAG_TTL, RECORD_TYPE_SHIFT, KEY_LENGTH_MASK, \
+    EXPIRY, TOMBSTONE, CACHE_ENTRY_OVERHEAD, MAX_VALUE_LENGTH
+from kv_stats import Metrics, instrumented
+from kv_expiry import now_ms
+
+MANIFEST = "MANIFEST"
+MANIFEST_VERSION = 1
+MAX_LEVELS = 7
+
+TABLE_MAGIC = b"KVSST\x00\x00\x01"
+# [index_offset: 8][block_count: 4][bloom_offset: 8][largest_key_length: 4]
+# [entry_count: 8][crc32 of everything from index_offset to the footer: 4][magic: 8]
+TABLE_FOOTER = struct.Struct(">QIQIQI8s")
+BLOCK_ENTRY = struct.Struct(">IQI")
+BLOOM_HEADER = struct.Struct(">I")
+_HASH_PAIR = struct.Struct(">QQ")
+
+# (key, value, expires_at) in key order: value None is a tombstone,
+# expires_at 0 means no TTL. Memtable values are str, table values bytes.
+Entry = Tuple[bytes, Optional[bytes], int]
+
+
+class BloomFilter:
+    """
+    A bloom filter over keys. The k bit positions are h1 + i * h2 from one
+    128-bit blake2b digest (Kirsch & Mitzenmacher double hashing), which
+    works as well as k independent hashes. With 10 bits per key and 7
+    positions about 1% of absent keys get a false "maybe".
+    """
+
+    def __init__(self, bits: bytearray, hash_count: int) -> None:
+        self.bits = bits
+        self.hash_count = hash_count
+        self._size = len(bits) * 8
+
+    @staticmethod
+    def hash(key: bytes) -> Tuple[int, int]:
+        return _HASH_PAIR.unpack(hashlib.blake2b(key, digest_size=16).digest())
+
+    @classmethod
+    def build(cls, hashes: List[Tuple[int, int]], bits_per_key: int) -> "BloomFilter":
+        """
+        A filter holding the keys whose hash() values are `hashes`.
+        """
+        size = max(64, len(hashes) * bits_per_key)
+        bloom = cls(bytearray((size + 7) // 8), max(1, min(30, round(bits_per_key * 0.69))))
+        bits = bloom.bits
+        size = bloom._size
+        for h1, h2 in hashes:
+            for i in range(bloom.hash_count):
+                position = (h1 + i * h2) % size
+                bits[position >> 3] |= 1 << (position & 7)
+        return bloom
+
+    def might_contain(self, key: bytes) -> bool:
+        h1, h2 = self.hash(key)
+        bits = self.bits
+        size = self._size
+        for i in range(self.hash_count):
+            position = (h1 + i * h2) % size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+def _block_entries(data: bytes) -> Iterator[Entry]:
+    """
+    Parse the records of one or more consecutive data blocks.
+    """
+    unpack_header = RECORD_HEADER.unpack_from
+    position = 0
+    end = len(data)
+    while position < end:
+        key_len, val_len = unpack_header(data, position)
+        record_type = key_len >> RECORD_TYPE_SHIFT
+        key_start = position + HEADER_SIZE
+        value_start = key_start + (key_len & KEY_LENGTH_MASK)
+        position = value_start + val_len
+        key = data[key_start:value_start]
+        if record_type & RECORD_TYPE_MASK == RECORD_DELETE:
+            yield key, None, 0
+        elif record_type & RECORD_FLAG_TTL:
+            yield key, data[value_start + EXPIRY.size:position], EXPIRY.unpack_from(data, value_start)[0]
+        else:
+            yield key, data[value_start:position], 0
+
+
+class SSTable:
+    """
+    The read side of one SSTable.
+
+    I keep the block index (first key, offset and CRC of each block) and
+    the bloom filter in memory and pread data blocks on demand. Every
+    block is checked against its CRC when it is read.
+
+    A table object is shared by every version that lists it, and readers
+    may still hold an old version after compaction has deleted the file.
+    The descriptor stays valid until then (POSIX keeps an unlinked file
+    around while it is open), so I only close it when the object goes away.
+
+    Attributes:
+        number: File number (the table is <number>.sst)
+        size: File size in bytes
+        count: Entries in the table, tombstones included
+        smallest, largest: The first and last key (UTF-8 bytes)
+    """
+
+    def __init__(self, path: str, number: int, metrics: Optional[Metrics] = None) -> None:
+        self.path = path
+        self.number = number
+        self._metrics = metrics
+        self._fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            self.size = os.fstat(self._fd).st_size
+            if self.size < TABLE_FOOTER.size:
+                raise IOError(f"{path} is too short to be a table")
+            meta_end = self.size - TABLE_FOOTER.size
+            (index_offset, block_count, bloom_offset, largest_length, self.count, crc,
+             magic) = TABLE_FOOTER.unpack(SimpleKVStore._pread(self._fd, TABLE_FOOTER.size, meta_end))
+            if magic != TABLE_MAGIC or not index_offset <= bloom_offset <= meta_end:
+                raise IOError(f"{path} is not a table")
+            meta = SimpleKVStore._pread(self._fd, meta_end - index_offset, index_offset)
+            if len(meta) != meta_end - index_offset or zlib.crc32(meta) != crc:
+                raise IOError(f"{path}: the table index is corrupted")
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+        self._first_keys: List[bytes] = []
+        self._offsets = array('Q')
+        self._crcs = array('L')
+        position = 0
+        for _ in range(block_count):
+            key_length, offset, block_crc = BLOCK_ENTRY.unpack_from(meta, position)
+            position += BLOCK_ENTRY.size
+            self._first_keys.append(meta[position:position + key_length])
+            position += key_length
+            self._offsets.append(offset)
+            self._crcs.append(block_crc)
+        self._data_end = index_offset
+        bloom_start = bloom_offset - index_offset
+        hash_count = BLOOM_HEADER.unpack_from(meta, bloom_start)[0]
+        self.bloom = BloomFilter(bytearray(meta[bloom_start + BLOOM_HEADER.size:len(meta) - largest_length]),
+                                 hash_count)
+        self.largest = meta[len(meta) - largest_length:]
+        self.smallest = self._first_keys[0] if self._first_keys else b''
+        self.memory_bytes = (len(self.bloom.bits) + sum(len(key) for key in self._first_keys)
+                             + block_count * (self._offsets.itemsize + self._crcs.itemsize))
+
+    def get(self, key: bytes) -> Optional[Tuple[Optional[bytes], int]]:
+        """
+        Look a key up in this table.
+
+        Returns:
+            (value, expires_at) with value None for a tombstone, or None if
+            the table has no record for the key
+        """
+        if key < self.smallest or key > self.largest:
+            return None
+        metrics = self._metrics
+        if not self.bloom.might_contain(key):
+            if metrics is not None:
+                metrics.add("bloom_negatives")
+            return None
+        block = bisect.bisect_right(self._first_keys, key) - 1
+        for record_key, value, expires_at in _block_entries(self._read_blocks(block, block + 1)):
+            if record_key == key:
+                return value, expires_at
+            if record_key > key:
+                break
+        if metrics is not None:
+            metrics.add("bloom_false_positives")
+        return None
+
+    def iterate(self, start: Optional[bytes] = None, readahead: int = 64) -> Iterator[Entry]:
+        """
+        Entries from `start` (or the first key) on, in key order.
+
+        I read `readahead` blocks per pread, since iteration is sequential.
+        """
+        count = len(self._first_keys)
+        first = 0 if start is None else max(0, bisect.bisect_right(self._first_keys, start) - 1)
+        while first < count:
+            last = min(count, first + readahead)
+            for entry in _block_entries(self._read_blocks(first, last)):
+                if start is None or entry[0] >= start:
+                    yield entry
+            start = None
+            first = last
+
+    def _read_blocks(self, first: int, last: int) -> bytes:
+        """
+        Read blocks [first, last) with one pread and check their CRCs.
+
+        Raises:
+            IOError: If a block is short or corrupted
+        """
+        offsets = self._offsets
+        start = offsets[first]
+        end = offsets[last] if last < len(offsets) else self._data_end
+        data = SimpleKVStore._pread(self._fd, end - start, start)
+        view = memoryview(data)
+        for block in range(first, last):
+            block_end = (offsets[block + 1] if block + 1 < len(offsets) else self._data_end) - start
+            if zlib.crc32(view[offsets[block] - start:block_end]) != self._crcs[block]:
+                raise IOError(f"{self.path}: block {block} is corrupted")
+        if self._metrics is not None:
+            self._metrics.add("block_reads", last - first)
+        return data
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def __del__(self) -> None:
+        try:
+            self.close()
+        except OSError:
+            pass
+
+
+class TableWriter:
+    """
+    Write one SSTable from entries added in ascending key order.
+
+    I collect each key's bloom hashes as I go and size the filter for the
+    exact key count in finish(), so a table split off a long merge doesn't
+    get a filter sized for the whole merge.
+    """
+
+    def __init__(self, path: str, number: int, block_bytes: int = 4096,
+                 bloom_bits_per_key: int = 10, metrics: Optional[Metrics] = None) -> None:
+        self.path = path
+        self.number = number
+        self.block_bytes = block_bytes
+        self.bloom_bits_per_key = bloom_bits_per_key
+        self._metrics = metrics
+        self._file = open(path, 'wb', buffering=1024 * 1024)
+        self._block: List[bytes] = []
+        self._block_size = 0
+        self._block_first = b''
+        self._offset = 0
+        self._index: List[Tuple[bytes, int, int]] = []
+        self._hashes: List[Tuple[int, int]] = []
+        self._last: Optional[bytes] = None
+
+    @property
+    def size(self) -> int:
+        """Bytes written so far, including the block being built."""
+        return self._offset + self._block_size
+
+    def add(self, key: bytes, value: Optional[bytes], expires_at: int = 0) -> None:
+        """
+        Append one entry; value None writes a tombstone.
+
+        Raises:
+            ValueError: If the key doesn't sort after the previous one
+        """
+        if self._last is not None and key <= self._last:
+            raise ValueError("Table keys must be added in ascending order")
+        if value is None:
+            record = RECORD_HEADER.pack(len(key) | (RECORD_DELETE << RECORD_TYPE_SHIFT), 0) + key
+        elif expires_at:
+            record = b''.join((RECORD_HEADER.pack(len(key) | (RECORD_FLAG_TTL << RECORD_TYPE_SHIFT),
+                                                  len(value) + EXPIRY.size),
+                               key, EXPIRY.pack(expires_at), value))
+        else:
+            record = b''.join((RECORD_HEADER.pack(len(key), len(value)), key, value))
+        if not self._block:
+            self._block_first = key
+        self._block.append(record)
+        self._block_size += len(record)
+        self._hashes.append(BloomFilter.hash(key))
+        self._last = key
+        if self._block_size >= self.block_bytes:
+            self._finish_block()
+
+    def _finish_block(self) -> None:
+        data = b''.join(self._block)
+        self._index.append((self._block_first, self._offset, zlib.crc32(data)))
+        self._file.write(data)
+        self._offset += len(data)
+        self._block = []
+        self._block_size = 0
+
+    def finish(self) -> SSTable:
+        """
+        Write the index, bloom filter and footer, fsync and open the table.
+        """
+        if self._block:
+            self._finish_block()
+        if self._last is None:
+            raise ValueError("A table needs at least one entry")
+        parts = []
+        for key, offset, crc in self._index:
+            parts.append(BLOCK_ENTRY.pack(len(key), offset, crc))
+            parts.append(key)
+        index = b''.join(parts)
+        bloom = BloomFilter.build(self._hashes, self.bloom_bits_per_key)
+        meta = b''.join((index, BLOOM_HEADER.pack(bloom.hash_count), bytes(bloom.bits), self._last))
+        self._file.write(meta)
+        self._file.write(TABLE_FOOTER.pack(self._offset, len(self._index), self._offset + len(index),
+                                           len(self._last), len(self._hashes), zlib.crc32(meta),
+                                           TABLE_MAGIC))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        return SSTable(self.path, self.number, self._metrics)
+
+    def abandon(self) -> None:
+        """
+        Close and delete a table that won't be finished.
+        """
+        try:
+            self._file.close()
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def _ranked(entries: Iterable[Entry], rank: int) -> Iterator[Tuple[bytes, int, Optional[bytes], int]]:
+    for key, value, expires_at in entries:
+        yield key, rank, value, expires_at
+
+
+def merge_entries(sources: List[Iterable[Entry]]) -> Iterator[Entry]:
+    """
+    Merge sorted entry streams into one, keeping only the first stream's
+    entry for a key that several of them hold.
+
+    Args:
+        sources: Entry iterables in key order, newest first
+
+    Yields:
+        One entry per key, in key order (tombstones included)
+    """
+    previous = None
+    for key, _, value, expires_at in heapq.merge(*[_ranked(source, rank)
+                                                   for rank, source in enumerate(sources)]):
+        if key != previous:
+            previous = key
+            yield key, value, expires_at
+
+
+def _level_entries(tables: Tuple[SSTable, ...], start: Optional[bytes]) -> Iterator[Entry]:
+    """
+    Entries of a sorted run of non-overlapping tables, from `start` on.
+    """
+    for table in tables:
+        if start is None or table.largest >= start:
+            yield from table.iterate(start)
+
+
+def _memtable_entries(items: List[Tuple[str, Tuple[Optional[str], int]]],
+                      start: Optional[bytes]) -> List[Entry]:
+    """
+    A memtable snapshot as sorted entries, from `start` on.
+    """
+    entries = []
+    for key, (value, expires_at) in items:
+        key_bytes = key.encode('utf-8')
+        if start is None or key_bytes >= start:
+            entries.append((key_bytes, value, expires_at))
+    entries.sort(key=lambda entry: entry[0])
+    return entries
+
+
+def _overlapping(tables: Iterable[SSTable], smallest: bytes, largest: bytes) -> List[SSTable]:
+    return [table for table in tables if table.smallest <= largest and table.largest >= smallest]
+
+
+class _Version:
+    """
+    One immutable snapshot of the tables in each level.
+
+    Flushes and compactions build a new version and swap the reference, so
+    a reader just takes self._version once and never needs a lock. Level 0
+    is newest first; every other level is sorted by key.
+    """
+    __slots__ = ['levels', 'largest']
+
+    def __init__(self, levels: Tuple[Tuple[SSTable, ...], ...]) -> None:
+        self.levels = levels
+        # Per level, each table's largest key, for bisecting levels 1 and up
+        self.largest = tuple([table.largest for table in level] for level in levels)
+
+
+class _SortedView:
+    """
+    The OrderedKeys.slice() that SimpleKVStore.scan() and scan_page() use,
+    answered by merging the memtables and tables.
+    """
+
+    def __init__(self, store: "LSMKVStore") -> None:
+        self._store = store
+
+    def slice(self, low: Optional[str] = None, high: Optional[str] = None,
+              limit: Optional[int] = None, after: bool = False) -> List[str]:
+        keys: List[str] = []
+        if limit is not None and limit <= 0:
+            return keys
+        for key, _, _ in self._store._iterate(low):
+            if after and key == low:
+                continue
+            if high is not None and key >= high:
+                break
+            keys.append(key)
+            if limit is not None and len(keys) >= limit:
+                break
+        return keys
+
+
+class LSMKVStore(SimpleKVStore):
+    """
+    A key-value store for data sets larger than memory: a write-ahead log
+    and memtable in front of leveled SSTables.
+
+    Memory use is the memtable (up to two of them while one is flushing),
+    plus each table's block index and bloom filter: about
+    bloom_bits_per_key / 8 bytes per key and one key per block.
+
+    There is no background expiry thread: expired keys are hidden by GET
+    and dropped by compaction. There is no value cache either; the OS page
+    cache keeps hot blocks in memory.
+    """
+
+    def __init__(self, directory: str = "data.lsm", memtable_bytes: int = 4 * 1024 * 1024,
+                 table_bytes: int = 2 * 1024 * 1024, block_bytes: int = 4096,
+                 bloom_bits_per_key: int = 10, level0_tables: int = 4,
+                 level0_stop_tables: int = 12, level1_bytes: int = 10 * 1024 * 1024,
+                 level_ratio: int = 10, slowlog_threshold_ms: float = 10.0) -> None:
+        """
+        Open (or create) the store in `directory` and replay its logs.
+
+        Args:
+            directory: Holds the manifest, logs and tables
+            memtable_bytes: Freeze and flush the memtable at about this size
+            table_bytes: Compaction starts a new table at this size
+            block_bytes: Target data block size; one GET reads one block
+            bloom_bits_per_key: Bloom filter size (10: ~1% false positives)
+            level0_tables: Compact level 0 into level 1 at this many tables
+            level0_stop_tables: Block writers while level 0 has this many
+            level1_bytes: Size budget of level 1
+            level_ratio: Each level below level 1 gets this many times the budget of the one above
+            slowlog_threshold_ms: Operations at least this slow go to SLOWLOG
+
+        Raises:
+            ValueError: If an option is out of range or the manifest is unknown
+            IOError: If a table or log can't be read
+        """
+        if memtable_bytes < 1 or table_bytes < 1 or block_bytes < 1:
+            raise ValueError("memtable_bytes, table_bytes and block_bytes must be positive")
+        if bloom_bits_per_key < 1:
+            raise ValueError("bloom_bits_per_key must be at least 1")
+        if level0_tables < 1 or level0_stop_tables < level0_tables:
+            raise ValueError("level0_stop_tables must be at least level0_tables, which must be positive")
+        if level_ratio < 2:
+            raise ValueError("level_ratio must be at least 2")
+        self.directory = directory
+        self.data_file = directory
+        self.memtable_bytes = memtable_bytes
+        self.table_bytes = table_bytes
+        self.block_bytes = block_bytes
+        self.bloom_bits_per_key = bloom_bits_per_key
+        self.level0_tables = level0_tables
+        self.level0_stop_tables = level0_stop_tables
+        self.level1_bytes = level1_bytes
+        self.level_ratio = level_ratio
+        self.metrics = Metrics(slowlog_threshold_ms=slowlog_threshold_ms)
+        self._cache = None  # cache_stats() reports zeros
+        self._compressor = None  # _encode_put writes the WAL uncompressed
+
+        # self._lock serializes writers, memtable switches and version
+        # changes; self._changed wakes the flusher, the compactor and
+        # stalled writers
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._memtable: Dict[str, Tuple[Optional[str], int]] = {}
+        self._memtable_size = 0
+        self._immutable: Optional[Dict[str, Tuple[Optional[str], int]]] = None
+        self._immutable_logs: List[int] = []
+        self._logs: List[int] = []
+        self._wal_fd = -1
+        self._wal_end = 0
+        self._version = _Version(((),) * MAX_LEVELS)
+        self._next_number = 1
+        self._closing = False
+        self._compacting = False
+        self._manual_compaction = False
+        self._compact_pointer: Dict[int, bytes] = {}
+        self._compact_stats = {"runs": 0, "flushes": 0, "bytes_read": 0, "bytes_written": 0,
+                               "last_duration_s": 0.0, "failures": 0}
+
+        os.makedirs(directory, exist_ok=True)
+        started = perf_counter()
+        self._recover()
+        self._recovery_seconds = perf_counter() - started
+        self.metrics.observe("recovery", self._recovery_seconds)
+
+        self._flusher = threading.Thread(target=self._flush_loop, name="kv-lsm-flush", daemon=True)
+        self._flusher.start()
+        self._compactor = threading.Thread(target=self._compact_loop, name="kv-lsm-compact", daemon=True)
+        self._compactor.start()
+        with self._lock:
+            if self._memtable_size >= self.memtable_bytes:
+                self._rotate()
+
+    def close(self) -> None:
+        """
+        Flush the memtable, stop the background threads and close every file.
+
+        A clean shutdown leaves every write in a table, so the next start
+        has no log to replay.
+        """
+        with self._lock:
+            if self._closing:
+                return
+            if self._memtable:
+                try:
+                    self._rotate()
+                except OSError as e:
+                    # The log still has everything; it is replayed on the next start
+                    print(f"Warning: I couldn't flush the memtable: {e}", file=sys.stderr, flush=True)
+            self._closing = True
+            self._changed.notify_all()
+        self._flusher.join()
+        self._compactor.join()
+        with self._lock:
+            if self._wal_fd >= 0:
+                os.close(self._wal_fd)
+                self._wal_fd = -1
+            if self._immutable is None and not self._memtable:
+                # Nothing is left in the logs, so I drop them
+                logs, self._logs = self._logs, []
+                try:
+                    self._write_manifest()
+                    for number in logs:
+                        os.remove(self._path(number, "log"))
+                except OSError as e:
+                    print(f"Warning: I couldn't remove the empty log: {e}", file=sys.stderr, flush=True)
+            for level in self._version.levels:
+                for table in level:
+                    table.close()
+
+    def _path(self, number: int, kind: str) -> str:
+        return os.path.join(self.directory, f"{number:06d}.{kind}")
+
+    def _allocate(self) -> int:
+        """A new file number. Caller holds self._lock."""
+        number = self._next_number
+        self._next_number += 1
+        return number
+
+    def _recover(self) -> None:
+        """
+        Open the tables the manifest lists and replay its logs into the memtable.
+
+        Tables and logs the manifest doesn't list are leftovers of a flush
+        or compaction that crashed before it was committed, so I delete them.
+        """
+        manifest = None
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as handle:
+                manifest = json.load(handle)
+        except FileNotFoundError:
+            pass
+        logs: List[int] = []
+        if manifest is not None:
+            if manifest.get("version") != MANIFEST_VERSION:
+                raise ValueError(f"Unknown manifest version {manifest.get('version')} in {self.directory}")
+            self._next_number = manifest["next_number"]
+            levels = [tuple(SSTable(self._path(number, "sst"), number, self.metrics) for number in level)
+                      for level in manifest["levels"]]
+            levels += [()] * (MAX_LEVELS - len(levels))
+            self._version = _Version(tuple(levels))
+            logs = manifest["logs"]
+
+        live = {f"{number:06d}.log" for number in logs}
+        live.update(f"{table.number:06d}.sst" for level in self._version.levels for table in level)
+        for name in os.listdir(self.directory):
+            if name.endswith((".sst", ".log", ".tmp")) and name not in live:
+                os.remove(os.path.join(self.directory, name))
+
+        for number in logs:
+            path = self._path(number, "log")
+            records, _ = scan_segment(path)
+            fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            try:
+                for key, (value_offset, value_length, _, expires_at, _) in records.items():
+                    if value_offset == TOMBSTONE:
+                        self._put_memtable(key, None, 0)
+                    else:
+                        value = self._pread(fd, value_length, value_offset).decode('utf-8')
+                        self._put_memtable(key, value, expires_at)
+            finally:
+                os.close(fd)
+        self._logs = list(logs)
+        with self._lock:
+            self._new_log()
+
+    def _write_manifest(self) -> None:
+        """
+        Atomically replace the manifest (write a temp file, fsync, rename).
+        Caller holds self._lock.
+        """
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "next_number": self._next_number,
+            "logs": self._immutable_logs + self._logs,
+            "levels": [[table.number for table in level] for level in self._version.levels],
+        }
+        path = os.path.join(self.directory, MANIFEST)
+        temp = path + ".tmp"
+        with open(temp, 'w') as handle:
+            json.dump(manifest, handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temp, path)
+        # The directory fsync also makes new tables and logs durable by name
+        self._sync_directory()
+
+    def _sync_directory(self) -> None:
+        if os.name == 'nt':
+            return
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _new_log(self) -> None:
+        """
+        Start a new write-ahead log and list it in the manifest before any
+        write goes to it. Caller holds self._lock.
+        """
+        number = self._allocate()
+        fd = os.open(self._path(number, "log"),
+                     os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, 'O_BINARY', 0), 0o644)
+        if self._wal_fd >= 0:
+            os.close(self._wal_fd)
+        self._wal_fd = fd
+        self._wal_end = 0
+        self._logs.append(number)
+        self._write_manifest()
+
+    def _put_memtable(self, key: str, value: Optional[str], expires_at: int) -> None:
+        memtable = self._memtable
+        old = memtable.get(key)
+        if old is not None:
+            self._memtable_size -= len(key) + len(old[0] or "") + CACHE_ENTRY_OVERHEAD
+        memtable[key] = (value, expires_at)
+        self._memtable_size += len(key) + len(value or "") + CACHE_ENTRY_OVERHEAD
+
+    def _commit(self, pending: _PendingWrite) -> None:
+        """
+        Append one encoded write to the log, fsync it and apply it to the memtable.
+
+        SimpleKVStore's set(), mset() and delete() all end up here. Every
+        write is fsynced before it returns, as in "always" durability.
+
+        Raises:
+            OSError: If the write or fsync fails, or the store is closed
+        """
+        payload = pending.payload
+        with self._lock:
+            if self._closing:
+                raise OSError("The store is closed")
+            fd = self._wal_fd
+            try:
+                view = memoryview(payload)
+                written = 0
+                while written < len(payload):
+                    written += os.write(fd, view[written:])
+                fsync_started = perf_counter()
+                os.fsync(fd)
+                self.metrics.observe("fsync", perf_counter() - fsync_started)
+            except OSError:
+                # A torn record would end the replay early and hide every
+                # write after it, so I cut it off again
+                try:
+                    os.ftruncate(fd, self._wal_end)
+                except OSError:
+                    pass
+                raise
+            self._wal_end += len(payload)
+            for key, _, _, value_length, value, expires_at, _ in pending.records:
+                self._put_memtable(key, None if value_length == TOMBSTONE else value, expires_at)
+            self.metrics.add("bytes_appended", len(payload))
+            self.metrics.add("write_batches")
+            self.metrics.add("records_written", len(pending.records))
+            if self._memtable_size >= self.memtable_bytes:
+                self._rotate()
+
+    def _rotate(self) -> None:
+        """
+        Freeze the memtable for the flusher and start an empty one with a
+        new log. Caller holds self._lock.
+
+        Only one frozen memtable can wait for its flush, and level 0 may not
+        grow past level0_stop_tables. Until both hold, I block the writer
+        here; this back-pressure keeps reads from slowing down without
+        bound when writes outpace compaction.
+        """
+        if self._immutable is not None or len(self._version.levels[0]) >= self.level0_stop_tables:
+            self.metrics.add("write_stalls")
+            while self._immutable is not None or len(self._version.levels[0]) >= self.level0_stop_tables:
+                self._changed.wait()
+        if not self._memtable:
+            return
+        self._immutable = self._memtable
+        self._immutable_logs = self._logs
+        self._memtable = {}
+        self._memtable_size = 0
+        self._logs = []
+        self._new_log()
+        self._changed.notify_all()
+
+    def _set_large(self, key: str, fileobj, expires_at: int = 0,
+                   chunk_size: int = 0) -> int:
+        """Values have to fit in one record here; set() sends longer ones to me."""
+        raise ValueError(f"The LSM engine doesn't store values over {MAX_VALUE_LENGTH} bytes")
+
+    def _flush_loop(self) -> None:
+        """
+        Write each frozen memtable out as a level-0 table, until close().
+        """
+        while True:
+            with self._lock:
+                while self._immutable is None and not self._closing:
+                    self._changed.wait()
+                memtable = self._immutable
+                if memtable is None:
+                    return
+                number = self._allocate()
+            started = perf_counter()
+            writer = TableWriter(self._path(number, "sst"), number, self.block_bytes,
+                                 self.bloom_bits_per_key, self.metrics)
+            try:
+                for key in sorted(memtable):
+                    value, expires_at = memtable[key]
+                    writer.add(key.encode('utf-8'), None if value is None else value.encode('utf-8'),
+                               expires_at)
+                table = writer.finish()
+                with self._lock:
+                    levels = list(self._version.levels)
+                    levels[0] = (table,) + levels[0]
+                    # The new version goes in before the frozen memtable
+                    # goes away, so a reader always finds the data in one
+                    self._version = _Version(tuple(levels))
+                    logs = self._immutable_logs
+                    self._immutable = None
+                    self._immutable_logs = []
+                    self._compact_stats["flushes"] += 1
+                    self._write_manifest()
+                    self._changed.notify_all()
+                for number in logs:
+                    os.remove(self._path(number, "log"))
+            except Exception as e:
+                writer.abandon()
+                print(f"Warning: I couldn't flush the memtable: {e}", file=sys.stderr, flush=True)
+                with self._lock:
+                    self._compact_stats["failures"] += 1
+                    if self._closing:
+                        # The logs are still listed, so nothing is lost
+                        return
+                    self._changed.wait(1.0)
+                continue
+            self.metrics.observe("flush", perf_counter() - started)
+
+    def _pick_compaction(self) -> Optional[Tuple[int, List[SSTable], bool, bool]]:
+        """
+        Choose the next compaction. Caller holds self._lock.
+
+        compact() merges everything into the bottom level. Otherwise level 0
+        is merged into level 1 once it has level0_tables tables, and a level
+        over its size budget pushes one table down, taking turns through
+        the key space as LevelDB does.
+
+        Returns:
+            (target level, source tables newest first, whether the target
+            is the bottom for that key range, whether the single source can
+            simply move down), or None if nothing needs compacting
+        """
+        levels = self._version.levels
+        if self._manual_compaction:
+            self._manual_compaction = False
+            sources = [table for level in levels for table in level]
+            if not sources:
+                return None
+            target = max(1, max(level for level in range(MAX_LEVELS) if levels[level]))
+            return target, sources, True, False
+        if len(levels[0]) >= self.level0_tables:
+            sources = list(levels[0])
+            smallest = min(table.smallest for table in sources)
+            largest = max(table.largest for table in sources)
+            sources += _overlapping(levels[1], smallest, largest)
+            return 1, sources, self._is_bottom(1, smallest, largest), False
+        budget = self.level1_bytes
+        for level in range(1, MAX_LEVELS - 1):
+            tables = levels[level]
+            if sum(table.size for table in tables) > budget:
+                pointer = self._compact_pointer.get(level, b'')
+                table = next((table for table in tables if table.largest > pointer), tables[0])
+                self._compact_pointer[level] = table.largest
+                below = _overlapping(levels[level + 1], table.smallest, table.largest)
+                return (level + 1, [table] + below,
+                        self._is_bottom(level + 1, table.smallest, table.largest), not below)
+            budget *= self.level_ratio
+        return None
+
+    def _compaction_due(self) -> bool:
+        """
+        True if _pick_compaction() would find work. Caller holds self._lock.
+        """
+        levels = self._version.levels
+        if self._manual_compaction or len(levels[0]) >= self.level0_tables:
+            return True
+        budget = self.level1_bytes
+        for level in range(1, MAX_LEVELS - 1):
+            if sum(table.size for table in levels[level]) > budget:
+                return True
+            budget *= self.level_ratio
+        return False
+
+    def wait_idle(self) -> None:
+        """
+        Block until no flush or compaction is running or due, e.g. after a
+        bulk load, so that reads see the shape a long-running store settles in.
+        """
+        with self._lock:
+            while (self._immutable is not None or self._compacting
+                   or self._compaction_due()) and not self._closing:
+                self._changed.wait()
+
+    def _is_bottom(self, target: int, smallest: bytes, largest: bytes) -> bool:
+        """
+        True if no level below `target` has keys in [smallest, largest].
+        """
+        return not any(_overlapping(level, smallest, largest)
+                       for level in self._version.levels[target + 1:])
+
+    def _compact_loop(self) -> None:
+        """
+        Run compactions whenever a level needs one, until close().
+        """
+        while True:
+            with self._lock:
+                task = None
+                while not self._closing:
+                    task = self._pick_compaction()
+                    if task is not None:
+                        break
+                    self._changed.wait()
+                if task is None:
+                    return
+                self._compacting = True
+            try:
+                self._compact(*task)
+            except Exception as e:
+                with self._lock:
+                    if not self._closing:
+                        print(f"Warning: Compaction failed: {e}", file=sys.stderr, flush=True)
+                        self._compact_stats["failures"] += 1
+                        self._changed.wait(1.0)
+            finally:
+                with self._lock:
+                    self._compacting = False
+                    self._changed.notify_all()
+
+    def _compact(self, target: int, sources: List[SSTable], bottom: bool, move: bool) -> None:
+        """
+        Merge `sources` into new tables in level `target`.
+
+        I write a new table every table_bytes, so the output is a sorted run
+        of non-overlapping tables. An expired value becomes a tombstone, so
+        it keeps hiding older values below it, and at the bottom tombstones
+        are dropped altogether. A table with nothing to merge with in the
+        level below just moves down without being rewritten.
+        """
+        started = perf_counter()
+        outputs: List[SSTable] = []
+        if move:
+            outputs = sources
+        else:
+            writer = None
+            now = now_ms()
+            try:
+                for key, value, expires_at in merge_entries([table.iterate() for table in sources]):
+                    if expires_at and expires_at <= now:
+                        value, expires_at = None, 0
+                    if value is None and bottom:
+                        continue
+                    if writer is None:
+                        if self._closing:
+                            raise InterruptedError("The store is closing")
+                        with self._lock:
+                            number = self._allocate()
+                        writer = TableWriter(self._path(number, "sst"), number, self.block_bytes,
+                                             self.bloom_bits_per_key, self.metrics)
+                    writer.add(key, value, expires_at)
+                    if writer.size >= self.table_bytes:
+                        outputs.append(writer.finish())
+                        writer = None
+                if writer is not None:
+                    outputs.append(writer.finish())
+                    writer = None
+            except BaseException:
+                if writer is not None:
+                    writer.abandon()
+                for table in outputs:
+                    table.close()
+                    os.remove(table.path)
+                raise
+
+        with self._lock:
+            removed = {table.number for table in sources}
+            levels = [tuple(table for table in level if table.number not in removed)
+                      for level in self._version.levels]
+            levels[target] = tuple(sorted(levels[target] + tuple(outputs),
+                                          key=lambda table: table.smallest))
+            self._version = _Version(tuple(levels))
+            self._write_manifest()
+            stats = self._compact_stats
+            stats["runs"] += 1
+            if not move:
+                stats["bytes_read"] += sum(table.size for table in sources)
+                stats["bytes_written"] += sum(table.size for table in outputs)
+            stats["last_duration_s"] = perf_counter() - started
+            self._changed.notify_all()
+        if not move:
+            # Readers holding an older version keep their descriptors open
+            for table in sources:
+                os.remove(table.path)
+        self.metrics.observe("compaction", perf_counter() - started)
+
+    def compact(self, wait: bool = False) -> bool:
+        """
+        Flush the memtable and merge every table into one sorted run in the
+        bottom level, dropping overwritten values, tombstones and expired keys.
+
+        Args:
+            wait: Block until the compaction has finished
+
+        Returns:
+            True if I scheduled a compaction, False if one was already pending
+        """
+        with self._lock:
+            scheduled = not self._manual_compaction
+            if scheduled:
+                if self._memtable:
+                    self._rotate()
+                # The frozen memtable has to reach level 0 to be included
+                while self._immutable is not None and not self._closing:
+                    self._changed.wait()
+                self._manual_compaction = True
+                self._changed.notify_all()
+            if wait:
+                while (self._manual_compaction or self._compacting) and not self._closing:
+                    self._changed.wait()
+        return scheduled
+
+    def _lookup(self, key: str) -> Optional[Tuple[Optional[object], int]]:
+        """
+        The newest entry for a key: (value, expires_at) with value None for
+        a tombstone (str from a memtable, bytes from a table), or None if
+        no memtable or table has the key.
+        """
+        item = self._memtable.get(key)
+        if item is not None:
+            return item
+        immutable = self._immutable
+        if immutable is not None:
+            item = immutable.get(key)
+            if item is not None:
+                return item
+        key_bytes = key.encode('utf-8')
+        version = self._version
+        levels = version.levels
+        for table in levels[0]:
+            item = table.get(key_bytes)
+            if item is not None:
+                return item
+        for level in range(1, MAX_LEVELS):
+            tables = levels[level]
+            if tables:
+                position = bisect.bisect_left(version.largest[level], key_bytes)
+                if position < len(tables):
+                    item = tables[position].get(key_bytes)
+                    if item is not None:
+                        return item
+        return None
+
+    @instrumented("get")
+    def get(self, key: str) -> Optional[str]:
+        """
+        Get the value for a key. I return None if the key doesn't exist.
+
+        I look in the memtable, the frozen memtable, then the tables from
+        newest to oldest, and stop at the first record for the key: a value,
+        or a tombstone that hides any older one. Nothing takes a lock.
+
+        Args:
+            key: The key to retrieve (must not be empty)
+
+        Returns:
+            The value, or None if the key doesn't exist or has expired
+
+        Raises:
+            ValueError: If key is invalid
+        """
+        if not key:
+            raise ValueError("Key cannot be empty")
+        try:
+            item = self._lookup(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if value is None or (expires_at and expires_at <= now_ms()):
+                return None
+            return value if isinstance(value, str) else value.decode('utf-8')
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"Error: I cannot read value for key '{key}': {e}", file=sys.stderr, flush=True)
+            return None
+
+    @instrumented("mget")
+    def mget(self, keys: List[str]) -> List[Optional[str]]:
+        """
+        Get the values for many keys, in the order given.
+
+        Raises:
+            ValueError: If any key is invalid
+        """
+        for key in keys:
+            if not key:
+                raise ValueError("Key cannot be empty")
+        return [self.get(key) for key in keys]
+
+    def get_bytes(self, key: str):
+        """
+        Get the raw value bytes for a key, or None if it doesn't exist.
+        """
+        value = self.get(key)
+        return None if value is None else value.encode('utf-8')
+
+    def get_stream(self, key: str):
+        raise ValueError("The LSM engine doesn't stream values; use get()")
+
+    def _alive(self, key: str) -> bool:
+        item = self._lookup(key)
+        return item is not None and item[0] is not None and not (item[1] and item[1] <= now_ms())
+
+    def ttl(self, key: str) -> int:
+        """
+        Remaining time to live of a key, like Redis PTTL.
+
+        Returns:
+            Milliseconds until the key expires, -1 if it has no TTL, or -2
+            if it doesn't exist
+        """
+        item = self._lookup(key) if key else None
+        if item is None or item[0] is None:
+            return -2
+        expires_at = item[1]
+        if not expires_at:
+            return -1
+        remaining = expires_at - now_ms()
+        return remaining if remaining > 0 else -2
+
+    def _iterate(self, start: Optional[str] = None) -> Iterator[Tuple[str, str, int]]:
+        """
+        Every live (key, value, expires_at) from `start` on, in key order.
+
+        I merge sorted snapshots of the memtables with every table, newest
+        source first, so the newest record for a key wins and tombstones
+        hide what is below them.
+        """
+        low = None if start is None else start.encode('utf-8')
+        with self._lock:
+            sources: List[Iterable[Entry]] = [_memtable_entries(list(self._memtable.items()), low)]
+            if self._immutable is not None:
+                sources.append(_memtable_entries(list(self._immutable.items()), low))
+            version = self._version
+        sources.extend(table.iterate(low) for table in version.levels[0])
+        sources.extend(_level_entries(tables, low) for tables in version.levels[1:] if tables)
+        now = now_ms()
+        for key, value, expires_at in merge_entries(sources):
+            if value is not None and not (expires_at and expires_at <= now):
+                yield (key.decode('utf-8'), value if isinstance(value, str) else value.decode('utf-8'),
+                       expires_at)
+
+    def _ordered_keys(self) -> _SortedView:
+        return _SortedView(self)
+
+    def export_records(self, page_size: int = 1024) -> Iterator[Tuple[str, str, int]]:
+        """
+        Stream every live key with its value and expiry time, in key order.
+
+        Args:
+            page_size: Unused; the merge reads tables sequentially anyway
+        """
+        return self._iterate()
+
+    def import_records(self, records: Iterable[Tuple[str, Optional[str], int]],
+                       buffer_bytes: int = 4 * 1024 * 1024) -> int:
+        """
+        Bulk-load records with one log write and fsync per ~buffer_bytes.
+
+        Args:
+            records: (key, value, expires_at) tuples; value None deletes the
+                key and expired records are skipped
+            buffer_bytes: How much I encode before each write
+
+        Returns:
+            How many records I applied
+
+        Raises:
+            ValueError: If a key or value is invalid (records before it are kept)
+            IOError: If writing fails
+        """
+        count = 0
+        now = now_ms()
+        chunks = []
+        size = 0
+        for key, value, expires_at in records:
+            if value is None:
+                if not key:
+                    raise ValueError("Key cannot be empty")
+                chunk = self._encode_delete(key)
+            elif expires_at and expires_at <= now:
+                continue
+            else:
+                chunk = self._encode_put(key, value, expires_at)
+            chunks.append(chunk)
+            size += len(chunk[0])
+            count += 1
+            if size >= buffer_bytes:
+                self._commit(self._batch(chunks))
+                chunks = []
+                size = 0
+        if chunks:
+            self._commit(self._batch(chunks))
+        self.metrics.add("records_imported", count)
+        return count
+
+    def resize_cache(self, max_bytes: int) -> None:
+        raise ValueError("The LSM engine has no value cache")
+
+    def stats(self) -> Dict[str, object]:
+        """
+        Report everything I measure about myself.
+
+        Returns:
+            Dictionary with uptime_s, recovery_s, counters (including
+            bloom_negatives, bloom_false_positives, block_reads and
+            write_stalls), latency, slowlog_len, profiling, cache (always
+            zeros), log (see compaction_stats()) and lsm (see lsm_stats())
+        """
+        stats = self.metrics.snapshot()
+        stats["recovery_s"] = self._recovery_seconds
+        stats["cache"] = self.cache_stats()
+        stats["log"] = self.compaction_stats()
+        stats["lsm"] = self.lsm_stats()
+        return stats
+
+    def compaction_stats(self) -> Dict[str, float]:
+        """
+        Report flushes, compactions and how much they read and wrote.
+
+        Returns:
+            Dictionary with runs, flushes, bytes_read, bytes_written,
+            last_duration_s, failures, running, tables and log_bytes (the
+            size of every table and log on disk)
+        """
+        with self._lock:
+            stats = dict(self._compact_stats)
+            tables = [table for level in self._version.levels for table in level]
+            stats["running"] = self._compacting
+            stats["tables"] = len(tables)
+            stats["log_bytes"] = sum(table.size for table in tables) + self._wal_end
+        return stats
+
+    def lsm_stats(self) -> Dict[str, object]:
+        """
+        Report the memtables and every level.
+
+        Returns:
+            Dictionary with memtable_keys, memtable_bytes, flushing, the
+            memory held by table indexes and bloom filters (index_bytes),
+            and per level (L0, L1, ...) its tables, bytes and entries
+        """
+        with self._lock:
+            stats: Dict[str, object] = {
+                "memtable_keys": len(self._memtable),
+                "memtable_bytes": self._memtable_size,
+                "flushing": self._immutable is not None,
+            }
+            version = self._version
+        stats["index_bytes"] = sum(table.memory_bytes for level in version.levels for table in level)
+        for number, level in enumerate(version.levels):
+            if level or number == 0:
+                stats[f"L{number}"] = {"tables": len(level),
+                                       "bytes": sum(table.size for table in level),
+                                       "entries": sum(table.count for table in level)}
+        return stats
@@ -0,0 +1,538 @@
+#!/usr/bin/env python3
+"""
+Read replicas for the Simple Persistent Key-Value Store.
+
+Every GET lands on the one process that owns data.db. A replica is a
+read-only copy of that store in another process, kept up to date by
+shipping the primary's log to it:
+
+    replica = ReplicaKVStore("data.db", "replica1.db")
+    replica.get("user1")
+    replica.replication_stats()["lag_bytes"]
+
+How it works:
+- The replica follows the primary's log files on the same machine. A
+  background thread polls the segment it is copying, scans whatever was
+  appended since the last poll with the recovery parser (_scan_buffer, as
+  _rebuild_index does), appends the complete records to its own log at the
+  same offsets and applies them to its index with _apply_records. A record
+  the primary is still writing is left for the next poll.
+- The replica's log is a byte-for-byte prefix of the primary's, segment by
+  segment, so its own log is also its replication position: after a
+  restart it recovers like any store (hint file plus tail replay) and then
+  resumes from the end of its log instead of copying everything again. I
+  check a CRC of the last bytes it copied against the primary first.
+- Compaction rewrites the primary's files. A replica that was still
+  copying a rewritten file has to start over (a resync); reads wait while
+  it catches up. With segments (--segment-size) the primary only compacts
+  sealed segments, which replicas have usually finished copying already.
+- Compressed records are copied as they are. A record compressed against
+  a dictionary I don't have yet makes me copy that dictionary file from
+  the primary the first time I read it.
+- SET, MSET, DEL, COMPACT and IMPORT are rejected. Expired keys are hidden
+  by GET as on the primary, and go away when the primary's tombstones arrive.
+- replication_stats() (and STATS, as replication.*) report how far behind
+  the primary I am, in bytes and in seconds since I was last caught up.
+
+Run one from the command line, as a REPL or (with --port) a server:
+
+    python kv_replica.py --primary data.db --data-file replica1.db --port 6381
+"""
+
+import os
+import sys
+import mmap
+import time
+import threading
+from typing import Dict, List, Optional
+
+from kv_store import SimpleKVStore, CACHE_POLICIES, segment_path, list_segments, \
+    _scan_buffer, _arg_parser, now_ms
+from kv_codec import MAX_DICTIONARY_BYTES, dictionary_path, read_dictionary, write_dictionary
+
+# Commands a replica refuses, since only the primary may write the log
+WRITE_COMMANDS = frozenset({"SET", "DEL", "MSET", "COMPACT", "IMPORT"})
+
+READ_ONLY_MESSAGE = "This store is a read-only replica"
+
+
+class _Diverged(Exception):
+    """My copy no longer matches the primary's log, so I have to resync."""
+
+
+class ReplicaKVStore(SimpleKVStore):
+    """
+    A read-only SimpleKVStore that follows another store's log.
+
+    Everything on the read side (get, mget, scan, get_stream, export, the
+    value cache, mmap reads) is inherited. My own log, hint file and index
+    work exactly like the primary's; the only writer is my follower thread.
+
+    Attributes:
+        primary_file: The primary's data file (segment 0 of its log)
+        poll_interval: Seconds between polls once I'm caught up
+        batch_bytes: Most log bytes I copy and apply under one lock hold
+    """
+
+    def __init__(self, primary_file: str, data_file: str = "replica.db",
+                 poll_interval_ms: float = 10.0,
+                 batch_bytes: int = 16 * 1024 * 1024,
+                 **options) -> None:
+        """
+        Open (or create) a replica and start following the primary.
+
+        Args:
+            primary_file: The primary's data file
+            data_file: My own copy of the log
+            poll_interval_ms: How often I look for new records
+            batch_bytes: Most bytes I copy per step
+            options: SimpleKVStore options for the read side (read_mode,
+                cache_bytes, index_engine, use_hint, ...). Compaction and
+                lazy recovery are always off: my offsets and segment
+                numbers must stay the primary's.
+
+        Raises:
+            ValueError: If the replica would share the primary's data file
+        """
+        if os.path.abspath(primary_file) == os.path.abspath(data_file):
+            raise ValueError("A replica needs its own data file")
+        if poll_interval_ms <= 0 or batch_bytes <= 0:
+            raise ValueError("poll_interval_ms and batch_bytes must be positive")
+        self.primary_file: str = primary_file
+        self.poll_interval: float = poll_interval_ms / 1000.0
+        self.batch_bytes: int = batch_bytes
+
+        # The primary segment I'm copying: (segment, read descriptor, inode).
+        # The inode tells me when compaction renamed a new file over it.
+        self._source: Optional[tuple] = None
+        self._caught_up_at: float = time.monotonic()
+        self._replication: Dict[str, int] = {"bytes_copied": 0, "records_applied": 0,
+                                             "segments_followed": 0, "resyncs": 0}
+        self._follow_stop = threading.Event()
+        self._follower: Optional[threading.Thread] = None
+
+        options["compact_dead_ratio"] = None
+        options["lazy_recovery"] = False
+        options["compression"] = None
+        super().__init__(data_file, **options)
+
+        try:
+            reason = self._check_primary()
+            if reason is not None:
+                self._resync(reason)
+            self.catch_up()
+        except BaseException:
+            self.close()
+            raise
+        self._follower = threading.Thread(target=self._follow_loop,
+                                          name="kv-replica", daemon=True)
+        self._follower.start()
+
+    def close(self) -> None:
+        """
+        Stop following the primary, then close my log like any store.
+        """
+        self._follow_stop.set()
+        if self._follower is not None:
+            self._follower.join()
+            self._follower = None
+        with self._lock:
+            self._close_source()
+        super().close()
+
+    def catch_up(self) -> int:
+        """
+        Copy and apply everything the primary has written since my last poll.
+
+        My follower thread calls this every poll_interval; call it directly
+        to read your own writes on the primary (as the benchmark does).
+
+        Returns:
+            Log bytes copied (including any resync)
+        """
+        copied = self._replication["bytes_copied"]
+        while not self._follow_stop.is_set():
+            try:
+                with self._lock:
+                    if not self._step():
+                        break
+            except _Diverged as e:
+                self._resync(str(e))
+        return self._replication["bytes_copied"] - copied
+
+    def replication_stats(self) -> Dict[str, object]:
+        """
+        Report my position in the primary's log and how far behind I am.
+
+        Returns:
+            Dictionary with primary, segment, offset (my position),
+            lag_bytes (primary log bytes I haven't applied yet), lag_s
+            (0 when caught up, otherwise seconds since I last was),
+            bytes_copied, records_applied, segments_followed and resyncs
+        """
+        with self._lock:
+            segment = self._active_segment
+            offset = self._valid_end
+            stats: Dict[str, object] = dict(self._replication)
+            caught_up_at = self._caught_up_at
+        lag = 0
+        for primary_segment in list_segments(self.primary_file):
+            if primary_segment < segment:
+                continue
+            try:
+                size = os.path.getsize(segment_path(self.primary_file, primary_segment))
+            except FileNotFoundError:
+                continue
+            lag += max(0, size - offset) if primary_segment == segment else size
+        stats.update(primary=self.primary_file, segment=segment, offset=offset,
+                     lag_bytes=lag,
+                     lag_s=time.monotonic() - caught_up_at if lag else 0.0)
+        return stats
+
+    def stats(self) -> Dict[str, object]:
+        """
+        SimpleKVStore.stats() plus replication_stats() under "replication".
+        """
+        stats = super().stats()
+        stats["replication"] = self.replication_stats()
+        return stats
+
+    def execute(self, line: str) -> Optional[str]:
+        """
+        SimpleKVStore.execute(), refusing the commands that write.
+        """
+        parts = line.split(None, 1)
+        if parts and parts[0].upper() in WRITE_COMMANDS:
+            return f"Error: {READ_ONLY_MESSAGE}"
+        return super().execute(line)
+
+    # Only my follower thread writes to my log
+    def set(self, key: str, value: str, ttl_ms: Optional[int] = None) -> None:
+        raise OSError(READ_ONLY_MESSAGE)
+
+    def set_stream(self, key: str, fileobj, ttl_ms: Optional[int] = None, chunk_size: int = 0) -> int:
+        raise OSError(READ_ONLY_MESSAGE)
+
+    def mset(self, items) -> None:
+        raise OSError(READ_ONLY_MESSAGE)
+
+    def delete(self, *keys: str) -> int:
+        raise OSError(READ_ONLY_MESSAGE)
+
+    def import_records(self, records, buffer_bytes: int = 0) -> int:
+        raise OSError(READ_ONLY_MESSAGE)
+
+    def compact(self, wait: bool = False) -> bool:
+        raise OSError(READ_ONLY_MESSAGE)
+
+    def train_dictionary(self, samples: int = 1000, size: int = MAX_DICTIONARY_BYTES) -> Optional[int]:
+        raise OSError(READ_ONLY_MESSAGE)
+
+    def _dictionary(self, number: int) -> bytes:
+        """
+        The primary writes a dictionary before any record that uses it, so
+        one I don't have yet is next to the primary's log; I keep a copy
+        next to mine, where a restarted replica finds it.
+        """
+        data = self._dictionaries.get(number)
+        if data is None:
+            path = dictionary_path(self.data_file, number)
+            if not os.path.exists(path):
+                write_dictionary(path, read_dictionary(dictionary_path(self.primary_file, number)))
+            data = super()._dictionary(number)
+        return data
+
+    def _expire_due(self) -> int:
+        """
+        The primary writes the tombstones for expired keys and I copy them
+        (GET hides the keys until then), so I only drain my timing wheel.
+        """
+        with self._lock:
+            self._wheel.advance(now_ms())
+        return 0
+
+    def _follow_loop(self) -> None:
+        """
+        Poll the primary every poll_interval seconds until close().
+        """
+        while not self._follow_stop.wait(self.poll_interval):
+            try:
+                self.catch_up()
+            except Exception as e:
+                # I try again on the next poll; lag_s shows that I'm stuck
+                print(f"Warning: I couldn't follow {self.primary_file}: {e}",
+                      file=sys.stderr, flush=True)
+
+    def _check_primary(self) -> Optional[str]:
+        """
+        Check that the log I recovered is still a prefix of the primary's.
+
+        Returns:
+            None if I can resume from the end of my log, otherwise the
+            reason I can't
+        """
+        segment = self._active_segment
+        end = self._valid_end
+        if end == 0:
+            return None
+        path = segment_path(self.primary_file, segment)
+        if not os.path.exists(path):
+            # Compaction drops a sealed segment once nothing in it is live;
+            # everything that superseded it is in the segments after it
+            if any(later > segment for later in list_segments(self.primary_file)):
+                return None
+            return f"segment {segment} is missing on the primary"
+        if os.path.getsize(path) < end:
+            return f"segment {segment} is shorter on the primary than my copy"
+        if self._log_tail_crc(segment, end) != self._log_tail_crc(segment, end, self.primary_file):
+            return f"segment {segment} does not match the primary"
+        return None
+
+    def _step(self) -> bool:
+        """
+        Copy and apply one piece of the primary's log, or move on to its
+        next segment. The caller must hold self._lock.
+
+        Returns:
+            True if I made progress (call me again), False if I'm caught up
+            or the primary's next record isn't complete yet
+
+        Raises:
+            _Diverged: If the primary rewrote or lost bytes I already copied
+        """
+        segment = self._active_segment
+        start = self._valid_end
+        path = segment_path(self.primary_file, segment)
+        # I list the segments before looking at mine: once a later segment
+        # exists, mine is sealed and its size is final
+        later = [s for s in list_segments(self.primary_file) if s > segment]
+        try:
+            fd, inode = self._open_source(segment)
+            current = os.stat(path)
+        except FileNotFoundError:
+            if later:
+                self._advance(later[0])
+                return True
+            if start:
+                raise _Diverged(f"segment {segment} is missing on the primary")
+            self._caught_up_at = time.monotonic()
+            return False
+
+        size = os.fstat(fd).st_size
+        if current.st_ino != inode:
+            if later and size == start:
+                # Compacted after I had copied all of it
+                self._advance(later[0])
+                return True
+            raise _Diverged(f"segment {segment} was rewritten on the primary")
+        if size < start:
+            raise _Diverged(f"segment {segment} is shorter on the primary than my copy")
+
+        if size > start:
+            with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as mapping:
+                records: Dict[str, tuple] = {}
+                end = min(size, start + self.batch_bytes)
+                valid_end = _scan_buffer(mapping, start, end, records, path, floor=0, quiet=True)
+                if valid_end == start and end < size:
+                    # One record (an MSET batch) bigger than batch_bytes
+                    valid_end = _scan_buffer(mapping, start, size, records, path,
+                                             floor=0, quiet=True)
+                if valid_end > start:
+                    self._append(segment, mapping[start:valid_end], records)
+                    return True
+
+        if later:
+            if size > start:
+                print(f"Warning: Sealed segment {segment} of {self.primary_file} has a torn "
+                      f"tail at offset {start}", file=sys.stderr, flush=True)
+            self._advance(later[0])
+            return True
+        if size == start:
+            self._caught_up_at = time.monotonic()
+        return False
+
+    def _append(self, segment: int, data: bytes, records: Dict[str, tuple]) -> None:
+        """
+        Append complete records copied from the primary to my log, make them
+        durable and publish them in my index.
+        """
+        writer = self._open_writer()
+        writer.write(data)
+        writer.flush()
+        fsync_started = time.perf_counter()
+        os.fsync(writer.fileno())
+        self.metrics.observe("fsync", time.perf_counter() - fsync_started)
+
+        self._apply_records(segment, records, now_ms())
+        self._valid_end += len(data)
+        self._segment_sizes[segment] = self._valid_end
+        self._appended_since_hint += len(data)
+        self._replication["bytes_copied"] += len(data)
+        self._replication["records_applied"] += len(records)
+        self.metrics.add("bytes_replicated", len(data))
+        self._maybe_write_hint()
+
+    def _advance(self, segment: int) -> None:
+        """
+        Seal my active segment and start copying the primary's `segment`.
+
+        Segment ids are the primary's, which may skip numbers where its
+        compaction dropped a segment. A segment I never copied anything
+        into is simply forgotten. The caller must hold self._lock.
+        """
+        self._close_source()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        current = self._active_segment
+        if self._valid_end == 0:
+            self._segments.remove(current)
+            self._segment_sizes.pop(current, None)
+            self._segment_live.pop(current, None)
+            self._close_reader(current)
+            try:
+                os.remove(segment_path(self.data_file, current))
+            except FileNotFoundError:
+                pass
+        else:
+            self._sealed_bytes += self._valid_end
+
+        self._segments.append(segment)
+        self._active_segment = segment
+        self._segment_sizes[segment] = 0
+        self._segment_live[segment] = 0
+        self._valid_end = 0
+        self._open_writer()
+        self._sync_directory()
+        self._replication["segments_followed"] += 1
+
+    def _resync(self, reason: str) -> None:
+        """
+        Throw my copy away and copy the primary's log again from the start.
+
+        I keep _layout_version odd (and hold the write lock) until I've
+        caught up, so GETs wait for the new copy instead of seeing it half
+        built.
+        """
+        print(f"Warning: Replica {self.data_file} is resyncing from {self.primary_file} "
+              f"({reason})", file=sys.stderr, flush=True)
+        with self._lock:
+            self._layout_version += 1
+            try:
+                while True:
+                    self._replication["resyncs"] += 1
+                    self._reset()
+                    try:
+                        while self._step():
+                            pass
+                        return
+                    except _Diverged as e:
+                        print(f"Warning: Replica {self.data_file} is resyncing again ({e})",
+                              file=sys.stderr, flush=True)
+            finally:
+                self._layout_version += 1
+
+    def _reset(self) -> None:
+        """
+        Delete my log and hint file and empty my index. The caller must
+        hold self._lock.
+        """
+        self._close_source()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        for segment in list(self._segments):
+            self._close_reader(segment)
+        for segment in list_segments(self.data_file):
+            os.remove(segment_path(self.data_file, segment))
+        if os.path.exists(self.hint_file):
+            os.remove(self.hint_file)
+        if self._cache is not None:
+            self._cache = CACHE_POLICIES[self.cache_policy](self._cache.max_bytes)
+        self._ordered = None
+        self._appended_since_hint = 0
+        self._rebuild_index()
+
+    def _open_source(self, segment: int) -> tuple:
+        """
+        The (descriptor, inode) of the primary segment I'm copying.
+
+        Raises:
+            FileNotFoundError: If the primary has no such segment
+        """
+        if self._source is not None and self._source[0] == segment:
+            return self._source[1:]
+        self._close_source()
+        fd = os.open(segment_path(self.primary_file, segment),
+                     os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        self._source = (segment, fd, os.fstat(fd).st_ino)
+        return self._source[1:]
+
+    def _close_source(self) -> None:
+        if self._source is not None:
+            os.close(self._source[1])
+            self._source = None
+
+
+def _parse_args(argv: Optional[List[str]] = None):
+    """
+    Parse the store options plus my replication and network options.
+    """
+    parser = _arg_parser("Read-only replica of a Simple persistent key-value store")
+    parser.set_defaults(data_file="replica.db")
+    parser.add_argument("--primary", required=True,
+                        help="Data file of the store to follow")
+    parser.add_argument("--poll-interval-ms", type=float, default=10.0,
+                        help="How often I look for new records (default: 10)")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="Interface to listen on with --port (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=None,
+                        help="Serve over TCP instead of running the REPL")
+    parser.add_argument("--workers", type=int, default=32,
+                        help="Threads running store calls with --port (default: 32)")
+    return parser.parse_args(argv)
+
+
+def _open_replica(args) -> ReplicaKVStore:
+    """
+    Create a replica from parsed command line options. The write-side
+    options (durability, segment size) don't apply: I copy the primary's.
+    """
+    if args.engine != "log":
+        raise ValueError("Only the log engine can be replicated")
+    return ReplicaKVStore(args.primary, args.data_file,
+                          poll_interval_ms=args.poll_interval_ms,
+                          read_mode=args.read_mode,
+                          use_hint=not args.no_hint,
+                          cache_bytes=args.cache_bytes,
+                          cache_policy=args.cache_policy,
+                          index_engine=args.index_engine,
+                          slowlog_threshold_ms=args.slowlog_threshold_ms)
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    store = None
+    server = None
+    try:
+        store = _open_replica(args)
+        if args.port is None:
+            store.run()
+        else:
+            import asyncio
+            from kv_server import KVServer, _serve
+            server = KVServer(store, args.host, args.port, args.workers)
+            asyncio.run(_serve(server))
+
+    except KeyboardInterrupt:
+        pass
+
+    except Exception as e:
+        print(f"Fatal error: {e}", file=sys.stderr, flush=True)
+        sys.exit(1)
+
+    finally:
+        if server is not None:
+            server.close()
+        if store is not None:
+            store.close()
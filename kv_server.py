@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Network server for the Simple Persistent Key-Value Store.
+
+This serves the same line protocol as the stdin REPL (SET, GET, DEL, TTL,
+MSET, MGET, CACHE, COMPACT, EXIT - see SimpleKVStore.execute) over TCP, so many clients
+can share one store:
+
+    python kv_server.py --port 6380 --data-file data.db
+
+How requests flow:
+- I read whatever a connection has sent and split it into complete lines,
+  so a client that pipelines many commands gets them handled as one batch
+- Consecutive SETs in a batch become a single mset() (see
+  SimpleKVStore.execute_batch), and the store calls run on a thread pool;
+  with group durability (my default here) the flusher thread coalesces
+  writes from all connections into shared fsyncs
+- I send the responses for a whole batch with one write instead of one
+  flushed line per command
+"""
+
+import sys
+import asyncio
+import signal
+import concurrent.futures
+from typing import List, Optional
+
+from kv_store import SimpleKVStore, DURABILITY_GROUP, MAX_KEY_LENGTH, MAX_VALUE_LENGTH, \
+    _arg_parser, _open_store
+
+# The longest command line I accept by default: a SET of the longest
+# value that fits in one record. A longer SET is valid (the store chunks
+# the value), but I have to buffer the whole line first, so that takes a
+# higher --max-line-bytes. Anything longer is dropped with the connection
+# instead of buffering it forever.
+MAX_LINE_LENGTH = MAX_KEY_LENGTH + MAX_VALUE_LENGTH + 64
+
+
+class KVServer:
+    """
+    asyncio TCP front end for one SimpleKVStore.
+
+    The event loop only does socket I/O. Every batch of commands runs on my
+    thread pool, because SET blocks until its fsync and I don't want one
+    slow disk flush to stall every other connection.
+    """
+
+    def __init__(self, store: SimpleKVStore, host: str = "127.0.0.1", port: int = 6380,
+                 workers: int = 32, max_line_bytes: int = MAX_LINE_LENGTH) -> None:
+        """
+        Args:
+            store: The store to serve (I don't close it; the caller owns it)
+            host: Interface to listen on
+            port: TCP port (0 picks a free one; see self.port after start)
+            workers: Threads running store calls. This bounds how many
+                batches can wait on an fsync at once, and so how many
+                writes a single group commit can pick up.
+            max_line_bytes: Longest command line I buffer before I give up
+                on the connection. It caps the values SET takes over TCP;
+                raise it to send values over 1MB, which the store chunks.
+        """
+        self.store = store
+        self.host = host
+        self.port = port
+        self.max_line_bytes = max_line_bytes
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                           thread_name_prefix="kv-server")
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.connections = 0
+        self.commands = 0
+
+    async def start(self) -> None:
+        """
+        Start listening. After this returns, self.port is the bound port.
+        """
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self) -> None:
+        """
+        Serve until the task is cancelled.
+        """
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def close(self) -> None:
+        """
+        Stop accepting connections and wait for running batches to finish.
+        """
+        if self._server is not None:
+            self._server.close()
+        self._pool.shutdown(wait=True)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Serve one connection until EXIT, EOF or an oversized line.
+        """
+        loop = asyncio.get_running_loop()
+        self.connections += 1
+        # A bytearray grows in place, and I only search the new data for a
+        # newline, so a long SET line costs linear time to collect
+        pending = bytearray()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                pending += data
+
+                # Everything up to the last newline is a batch of complete
+                # commands; the rest waits for the next read
+                cut = pending.rfind(b"\n", len(pending) - len(data))
+                if cut < 0:
+                    if len(pending) > self.max_line_bytes:
+                        writer.write(b"Error: Command line too long\n")
+                        break
+                    continue
+                lines = pending[:cut].decode('utf-8', 'replace').split("\n")
+                del pending[:cut + 1]
+
+                # EXIT ends the session after the commands before it
+                exiting = False
+                for position, line in enumerate(lines):
+                    if line.strip().upper() == "EXIT":
+                        lines = lines[:position]
+                        exiting = True
+                        break
+
+                if lines:
+                    responses = await loop.run_in_executor(self._pool, self.store.execute_batch, lines)
+                    self.commands += len(lines)
+                    if responses:
+                        writer.write(("\n".join(responses) + "\n").encode('utf-8'))
+                        await writer.drain()
+                if exiting:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # The client went away; there's nobody left to answer
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+
+def _parse_args(argv: Optional[List[str]] = None):
+    """
+    Parse the store options plus my network options.
+
+    I default to group durability here: it's what lets writes from
+    different connections share an fsync.
+    """
+    parser = _arg_parser("Simple persistent key-value store server")
+    parser.set_defaults(durability=DURABILITY_GROUP)
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="Interface to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=6380,
+                        help="TCP port (default: 6380, 0 picks a free port)")
+    parser.add_argument("--workers", type=int, default=32,
+                        help="Threads running store calls (default: 32)")
+    parser.add_argument("--max-line-bytes", type=int, default=MAX_LINE_LENGTH,
+                        help="Longest command line accepted, which caps SET values "
+                             f"(default: {MAX_LINE_LENGTH}, enough for 1MB values)")
+    return parser.parse_args(argv)
+
+
+async def _serve(server: KVServer) -> None:
+    """
+    Run the server until SIGINT or SIGTERM.
+    """
+    await server.start()
+    print(f"Listening on {server.host}:{server.port}", file=sys.stderr, flush=True)
+
+    task = asyncio.ensure_future(server.serve_forever())
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, task.cancel)
+        except (NotImplementedError, RuntimeError):
+            # Windows event loops don't support signal handlers;
+            # Ctrl+C still raises KeyboardInterrupt there
+            pass
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    store = None
+    server = None
+    try:
+        store = _open_store(args)
+        server = KVServer(store, args.host, args.port, args.workers, args.max_line_bytes)
+        asyncio.run(_serve(server))
+
+    except KeyboardInterrupt:
+        pass
+
+    except Exception as e:
+        print(f"Fatal error: {e}", file=sys.stderr, flush=True)
+        sys.exit(1)
+
+    finally:
+        # I finish in-flight batches before closing the log
+        if server is not None:
+            server.close()
+        if store is not None:
+            store.close()
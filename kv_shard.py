@@ -0,0 +1,561 @@
+#!/usr/bin/env python3
+"""
+Hash-partitioned, multi-process front end for the Simple Persistent Key-Value Store.
+
+One SimpleKVStore is one process behind the GIL and one log file. To use
+more cores (and more fsyncs in flight) I split the keyspace over K shard
+processes:
+
+    with ShardedKVStore("shards", shards=8) as store:
+        store.mset([("user1", "Alice"), ("user2", "Bob")])
+        store.mget(["user1", "user2"])
+
+How it works:
+- Each shard is a SimpleKVStore in its own worker process, with its own log
+  (<directory>/shard-NNN.db) and index
+- A key's shard is jump_hash(key, K) (Lamping & Veach's jump consistent
+  hash), so changing K only moves the keys that have to move: growing from
+  K to K+1 shards moves 1/(K+1) of the keys and leaves the rest in place
+- The front end talks to each worker over a pipe. Every message is a batch
+  of (operation, arguments) requests and gets one batch of replies back,
+  so MSET/MGET cost one round trip per shard, and all shards work on their
+  part at the same time (scatter/gather)
+- <directory>/shards.json records K, so a directory can't be opened with
+  the wrong shard count by accident
+
+The front end itself is one process (hashing keys and pickling requests),
+so throughput only keeps growing with K while the front end isn't the
+bottleneck: send keys in batches (mset/mget) rather than one at a time,
+from several threads. A directory must have exactly one front end, since
+each shard's log is owned by its worker process.
+
+Resharding is offline (no front end may have the directory open):
+
+    python kv_shard.py split --data-file data.db --directory shards --shards 8
+    python kv_shard.py reshard --directory shards --shards 16
+"""
+
+import os
+import io
+import sys
+import json
+import hashlib
+import argparse
+import threading
+import multiprocessing
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from kv_store import SimpleKVStore, LARGE_VALUE, _arg_parser
+
+MANIFEST = "shards.json"
+
+# The store methods a worker will run for the front end
+SHARD_OPERATIONS = frozenset({"get", "set", "mset", "mget", "delete", "ttl",
+                              "stats", "compact", "write_hint"})
+
+
+def key_hash(key: str) -> int:
+    """
+    A stable 64-bit hash of a key. Python's hash() is salted per process,
+    so it can't decide where a key lives on disk.
+    """
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """
+    Jump consistent hash (Lamping & Veach, 2014): map a 64-bit key to one
+    of `buckets` buckets so that going from n to n+1 buckets moves exactly
+    the keys that land in the new bucket, and nothing else.
+    """
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+def shard_of(key: str, shards: int) -> int:
+    """
+    The shard that owns `key` when there are `shards` shards.
+    """
+    return jump_hash(key_hash(key), shards)
+
+
+def shard_path(directory: str, shard: int) -> str:
+    """
+    The log file of one shard.
+    """
+    return os.path.join(directory, f"shard-{shard:03d}.db")
+
+
+def read_manifest(directory: str) -> Optional[Dict[str, int]]:
+    """
+    Load <directory>/shards.json, or None if the directory isn't sharded yet.
+    """
+    try:
+        with open(os.path.join(directory, MANIFEST)) as handle:
+            return json.load(handle)
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(directory: str, manifest: Dict[str, int]) -> None:
+    """
+    Atomically replace the manifest (write a temp file, fsync, rename).
+    """
+    path = os.path.join(directory, MANIFEST)
+    temp = path + ".tmp"
+    with open(temp, 'w') as handle:
+        json.dump(manifest, handle)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(temp, path)
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _serve_shard(conn, data_file: str, options: Dict[str, object]) -> None:
+    """
+    Worker process main loop: open one shard and answer request batches.
+
+    Every message is a list of (operation, args) tuples and gets a list of
+    (ok, result) replies in the same order, where result is the exception
+    if the operation failed. None (or a closed pipe) shuts the worker down.
+    """
+    try:
+        store = SimpleKVStore(data_file, **options)
+    except Exception as e:
+        conn.send(e)
+        return
+    conn.send(None)
+    try:
+        while True:
+            try:
+                batch = conn.recv()
+            except EOFError:
+                break
+            if batch is None:
+                break
+            replies = []
+            for operation, args in batch:
+                try:
+                    if operation not in SHARD_OPERATIONS:
+                        raise ValueError(f"Unknown shard operation '{operation}'")
+                    replies.append((True, getattr(store, operation)(*args)))
+                except Exception as e:
+                    replies.append((False, e))
+            conn.send(replies)
+    finally:
+        store.close()
+        conn.close()
+
+
+class ShardedKVStore:
+    """
+    The front end: routes each key to its shard process.
+
+    Safe to share between threads. Each shard's pipe has its own lock, so
+    calls for different shards run in parallel; a scatter/gather call
+    takes the locks of the shards it needs in shard order.
+
+    MSET and multi-key DEL are atomic per shard (each shard writes its part
+    as one batch record), not across shards.
+
+    Attributes:
+        directory: Directory holding the shard logs and the manifest
+        shards: Number of shards (K)
+    """
+
+    def __init__(self, directory: str, shards: Optional[int] = None,
+                 start_method: Optional[str] = None, **store_options) -> None:
+        """
+        Open (or create) a sharded store and start one worker per shard.
+
+        Args:
+            directory: Where the shards live (created if missing)
+            shards: Shard count for a new directory. For an existing one it
+                must be None or match the manifest; use reshard() to change it.
+            start_method: multiprocessing start method (default: the
+                platform default)
+            store_options: Passed to every shard's SimpleKVStore
+
+        Raises:
+            ValueError: If shards doesn't match the directory
+            RuntimeError: If a worker fails to open its shard
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        manifest = read_manifest(directory)
+        if manifest is not None and manifest.get("target") is not None:
+            # A reshard was interrupted; finish it before serving anything
+            reshard(directory, manifest["target"], **store_options)
+            manifest = read_manifest(directory)
+        if manifest is None:
+            if shards is None or shards < 1:
+                raise ValueError("A new sharded store needs a shard count of at least 1")
+            write_manifest(directory, {"shards": shards})
+        elif shards is not None and shards != manifest["shards"]:
+            raise ValueError(f"{directory} has {manifest['shards']} shards, not {shards}; "
+                             f"use reshard() to change it")
+        self.shards: int = manifest["shards"] if manifest is not None else shards
+
+        context = multiprocessing.get_context(start_method)
+        self._conns = []
+        self._processes = []
+        self._locks = [threading.Lock() for _ in range(self.shards)]
+        try:
+            for shard in range(self.shards):
+                parent, child = context.Pipe()
+                process = context.Process(target=_serve_shard, name=f"kv-shard-{shard}",
+                                          args=(child, shard_path(directory, shard), store_options),
+                                          daemon=True)
+                process.start()
+                child.close()
+                self._conns.append(parent)
+                self._processes.append(process)
+            # Every worker reports once its shard is open (recovery included)
+            for shard, conn in enumerate(self._conns):
+                error = conn.recv()
+                if error is not None:
+                    raise RuntimeError(f"Shard {shard} failed to open: {error}")
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self) -> "ShardedKVStore":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Stop the workers; each one closes (and flushes) its shard.
+        """
+        for conn in self._conns:
+            try:
+                conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for process in self._processes:
+            process.join()
+        for conn in self._conns:
+            conn.close()
+        self._conns = []
+        self._processes = []
+
+    def shard_of(self, key: str) -> int:
+        """The shard that owns `key`."""
+        return shard_of(key, self.shards)
+
+    def _call(self, shard: int, operation: str, *args):
+        """
+        Run one operation on one shard and return its result.
+        """
+        with self._locks[shard]:
+            conn = self._conns[shard]
+            conn.send([(operation, args)])
+            ok, result = conn.recv()[0]
+        if not ok:
+            raise result
+        return result
+
+    def _scatter(self, requests: Dict[int, Tuple[str, tuple]]) -> Dict[int, object]:
+        """
+        Send one request to each of several shards, then collect the replies.
+
+        All requests are sent before I wait for the first reply, so the
+        shards work on them at the same time.
+
+        Args:
+            requests: shard -> (operation, args)
+
+        Returns:
+            shard -> result
+
+        Raises:
+            The first shard's exception, after every reply has been read
+        """
+        order = sorted(requests)
+        locks = [self._locks[shard] for shard in order]
+        for lock in locks:
+            lock.acquire()
+        try:
+            for shard in order:
+                self._conns[shard].send([requests[shard]])
+            replies = {shard: self._conns[shard].recv()[0] for shard in order}
+        finally:
+            for lock in locks:
+                lock.release()
+        results = {}
+        for shard in order:
+            ok, result = replies[shard]
+            if not ok:
+                raise result
+            results[shard] = result
+        return results
+
+    def get(self, key: str) -> Optional[str]:
+        """Get the value for a key (None if it doesn't exist)."""
+        return self._call(self.shard_of(key), "get", key)
+
+    def set(self, key: str, value: str, ttl_ms: Optional[int] = None) -> None:
+        """Set a key on its shard. See SimpleKVStore.set."""
+        self._call(self.shard_of(key), "set", key, value, ttl_ms)
+
+    def ttl(self, key: str) -> int:
+        """Remaining TTL of a key. See SimpleKVStore.ttl."""
+        return self._call(self.shard_of(key), "ttl", key)
+
+    def mset(self, items: Iterable[Tuple[str, str]]) -> None:
+        """
+        Store many pairs: one mset() per shard, all shards in parallel.
+        """
+        parts: Dict[int, List[Tuple[str, str]]] = {}
+        for key, value in items:
+            parts.setdefault(self.shard_of(key), []).append((key, value))
+        if parts:
+            self._scatter({shard: ("mset", (pairs,)) for shard, pairs in parts.items()})
+
+    def mget(self, keys: List[str]) -> List[Optional[str]]:
+        """
+        Get many keys: one mget() per shard, all shards in parallel, with
+        the results put back in the caller's order.
+        """
+        positions: Dict[int, List[int]] = {}
+        for position, key in enumerate(keys):
+            positions.setdefault(self.shard_of(key), []).append(position)
+        results = self._scatter({shard: ("mget", ([keys[p] for p in part],))
+                                 for shard, part in positions.items()})
+        values: List[Optional[str]] = [None] * len(keys)
+        for shard, part in positions.items():
+            for position, value in zip(part, results[shard]):
+                values[position] = value
+        return values
+
+    def delete(self, *keys: str) -> int:
+        """
+        Delete keys and return how many existed.
+        """
+        parts: Dict[int, List[str]] = {}
+        for key in keys:
+            parts.setdefault(self.shard_of(key), []).append(key)
+        results = self._scatter({shard: ("delete", tuple(part)) for shard, part in parts.items()})
+        return sum(results.values())
+
+    def compact(self, wait: bool = False) -> None:
+        """Start (or with wait, run) a compaction on every shard."""
+        self._scatter({shard: ("compact", (wait,)) for shard in range(self.shards)})
+
+    def stats(self) -> Dict[str, object]:
+        """
+        Every shard's stats() plus the total key count.
+        """
+        results = self._scatter({shard: ("stats", ()) for shard in range(self.shards)})
+        per_shard = [results[shard] for shard in range(self.shards)]
+        return {"shards": self.shards,
+                "keys": sum(stats["keys"] for stats in per_shard),
+                "per_shard": per_shard}
+
+
+def _copy_keys(source: SimpleKVStore, keys: List[str], targets: Dict[int, SimpleKVStore],
+               owner, batch: int = 1000) -> List[str]:
+    """
+    Copy keys (with their TTLs) from one open store into the shards that
+    own them.
+
+    I read every value as raw bytes. UTF-8 values without a TTL go out as
+    one mset() per target per `batch` keys; those with a TTL get their own
+    set(). A binary value (written with set_stream) can't be a string, so
+    it goes through set_stream() as bytes. A value too long for one record
+    is streamed from get_stream() into set_stream(), one key at a time and
+    without holding it in memory.
+
+    Returns:
+        The keys I copied: all of `keys` except the ones that expired (or
+        never existed), so the caller may delete exactly these
+
+    Raises:
+        IOError: If the value of a key that exists can't be read
+    """
+    copied: List[str] = []
+    for first in range(0, len(keys), batch):
+        plain: Dict[int, List[Tuple[str, str]]] = {}
+        for key in keys[first:first + batch]:
+            remaining = source.ttl(key)
+            if remaining == -2:
+                continue
+            ttl_ms = None if remaining == -1 else max(1, remaining)
+            entry = source.index.get(key)
+            large = entry is not None and entry.value_length & LARGE_VALUE
+            value = source.get_stream(key) if large else source.get_bytes(key)
+            if value is None:
+                if source.ttl(key) == -2:
+                    continue  # it expired between the two calls
+                raise IOError(f"I can't read the value of key '{key}' to copy it")
+            if large:
+                with value:
+                    targets[owner(key)].set_stream(key, value, ttl_ms=ttl_ms)
+                copied.append(key)
+                continue
+            try:
+                text = str(value, 'utf-8')
+            except UnicodeDecodeError:
+                targets[owner(key)].set_stream(key, io.BytesIO(value), ttl_ms=ttl_ms)
+            else:
+                if ttl_ms is None:
+                    plain.setdefault(owner(key), []).append((key, text))
+                else:
+                    targets[owner(key)].set(key, text, ttl_ms=ttl_ms)
+            copied.append(key)
+        for shard, pairs in plain.items():
+            targets[shard].mset(pairs)
+    return copied
+
+
+def split_store(data_file: str, directory: str, shards: int, **store_options) -> int:
+    """
+    Distribute an existing single-file store (data.db) over `shards` shards.
+
+    The source is only read. The manifest is written last, so an
+    interrupted split leaves a directory that ShardedKVStore won't open;
+    just run the split again.
+
+    Returns:
+        How many keys I copied
+
+    Raises:
+        ValueError: If the directory already holds a sharded store
+    """
+    if shards < 1:
+        raise ValueError("Shard count must be at least 1")
+    if read_manifest(directory) is not None:
+        raise ValueError(f"{directory} already holds a sharded store")
+    os.makedirs(directory, exist_ok=True)
+    for shard in range(shards):
+        _remove_shard(directory, shard)
+
+    source = SimpleKVStore(data_file, **store_options)
+    targets = {shard: SimpleKVStore(shard_path(directory, shard), **store_options)
+               for shard in range(shards)}
+    try:
+        copied = len(_copy_keys(source, list(source.index.keys()), targets,
+                                lambda key: shard_of(key, shards)))
+    finally:
+        for target in targets.values():
+            target.close()
+        source.close()
+    write_manifest(directory, {"shards": shards})
+    return copied
+
+
+def reshard(directory: str, shards: int, **store_options) -> int:
+    """
+    Change the shard count of a sharded store in place.
+
+    Jump hashing means only keys whose shard changes are touched: when
+    growing, keys move from the old shards into the new ones; when
+    shrinking, the keys of the removed shards move into the survivors.
+
+    The reshard is crash safe. I first record the target in the manifest,
+    copy the moving keys (each write is durable before it returns), and
+    only then delete from its old shard each key that was copied, and
+    switch the manifest over. A key that still exists but can't be copied
+    stops the reshard before anything is deleted. If I'm interrupted,
+    ShardedKVStore finishes the job on the next open: every key is still
+    in its old shard until its copy is on disk, and copying a key again
+    just rewrites the same value.
+
+    Returns:
+        How many keys moved
+
+    Raises:
+        ValueError: If the directory isn't a sharded store or shards < 1
+    """
+    if shards < 1:
+        raise ValueError("Shard count must be at least 1")
+    manifest = read_manifest(directory)
+    if manifest is None:
+        raise ValueError(f"{directory} doesn't hold a sharded store")
+    old = manifest["shards"]
+    if old == shards and manifest.get("target") is None:
+        return 0
+    write_manifest(directory, {"shards": old, "target": shards})
+
+    if shards > old:
+        # A fresh start for the new shards, unless I'm resuming
+        if manifest.get("target") != shards:
+            for shard in range(old, shards):
+                _remove_shard(directory, shard)
+
+    stores = {shard: SimpleKVStore(shard_path(directory, shard), **store_options)
+              for shard in range(max(old, shards))}
+    moved = 0
+    try:
+        for shard in range(old):
+            source = stores[shard]
+            moving = [key for key in source.index.keys() if shard_of(key, shards) != shard]
+            if not moving:
+                continue
+            # Only keys that are safely in their new shard may go; a key
+            # I couldn't copy made _copy_keys raise before this point
+            copied = _copy_keys(source, moving, stores, lambda key: shard_of(key, shards))
+            moved += len(copied)
+            if shard < shards:
+                for first in range(0, len(copied), 1000):
+                    source.delete(*copied[first:first + 1000])
+    finally:
+        for store in stores.values():
+            store.close()
+
+    write_manifest(directory, {"shards": shards})
+    for shard in range(shards, old):
+        _remove_shard(directory, shard)
+    return moved
+
+
+def _remove_shard(directory: str, shard: int) -> None:
+    """
+    Delete every file (segments, hint) that belongs to one shard.
+    """
+    prefix = os.path.basename(shard_path(directory, shard))
+    for name in os.listdir(directory):
+        if name == prefix or name.startswith(prefix + "."):
+            os.remove(os.path.join(directory, name))
+
+
+def _parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse the split/reshard command line plus the usual store options.
+    """
+    parser = _arg_parser("Split or reshard a sharded key-value store")
+    parser.add_argument("command", choices=["split", "reshard"],
+                        help="split: distribute --data-file over new shards; "
+                             "reshard: change the shard count of --directory")
+    parser.add_argument("--directory", required=True, help="Directory of the sharded store")
+    parser.add_argument("--shards", type=int, required=True, help="Shard count to end up with")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    options = {"durability": args.durability, "read_mode": args.read_mode,
+               "use_hint": not args.no_hint, "segment_max_bytes": args.segment_size,
+               "index_engine": args.index_engine}
+    try:
+        if args.command == "split":
+            count = split_store(args.data_file, args.directory, args.shards, **options)
+            print(f"Copied {count} keys into {args.shards} shards", file=sys.stderr, flush=True)
+        else:
+            count = reshard(args.directory, args.shards, **options)
+            print(f"Moved {count} keys; {args.directory} now has {args.shards} shards",
+                  file=sys.stderr, flush=True)
+    except Exception as e:
+        print(f"Fatal error: {e}", file=sys.stderr, flush=True)
+        sys.exit(1)
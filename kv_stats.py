@@ -0,0 +1,257 @@
+"""
+Instrumentation for the Simple Persistent Key-Value Store.
+
+Everything here is cheap enough to leave on: an operation costs two
+perf_counter() calls, a few integer operations to pick a histogram bucket
+and an add. Nothing takes a lock, so under heavy concurrency a counter can
+occasionally miss an increment - these are operational numbers, not an
+audit log.
+
+- LatencyHistogram: HDR-style log-linear histogram of microseconds
+- Metrics: named counters and histograms, plus a Redis-style slow log
+- SamplingProfiler: cProfile for one call in N, switched on at runtime
+- instrumented: method decorator that feeds a Metrics object
+"""
+
+import io
+import time
+import cProfile
+import pstats
+import functools
+import threading
+from collections import deque
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+
+class LatencyHistogram:
+    """
+    Log-linear latency histogram in the style of HdrHistogram.
+
+    Values below 32us get a bucket each. Above that every power of two is
+    split into 16 buckets, so any recorded value is reported within ~6% of
+    its true value, from microseconds to hours, in a few hundred counters.
+    """
+
+    SUB_BUCKETS = 16
+    EXACT_BELOW = 2 * SUB_BUCKETS
+
+    def __init__(self) -> None:
+        self.counts: List[int] = [0] * (self.EXACT_BELOW + 64 * self.SUB_BUCKETS)
+        self.count = 0
+        self.total_us = 0
+        self.max_us = 0
+
+    @classmethod
+    def _index(cls, micros: int) -> int:
+        if micros < cls.EXACT_BELOW:
+            return micros
+        shift = micros.bit_length() - 5
+        return cls.EXACT_BELOW + (shift - 1) * cls.SUB_BUCKETS + (micros >> shift) - cls.SUB_BUCKETS
+
+    @classmethod
+    def _upper_bound(cls, index: int) -> int:
+        """
+        The largest value that lands in bucket `index`.
+        """
+        if index < cls.EXACT_BELOW:
+            return index
+        shift, top = divmod(index - cls.EXACT_BELOW, cls.SUB_BUCKETS)
+        shift += 1
+        return ((top + cls.SUB_BUCKETS + 1) << shift) - 1
+
+    def record(self, micros: int) -> None:
+        # _index() inlined: this runs on every GET and SET
+        if micros < 32:
+            self.counts[micros] += 1
+        else:
+            shift = micros.bit_length() - 5
+            self.counts[(shift << 4) + (micros >> shift)] += 1
+        self.count += 1
+        self.total_us += micros
+        if micros > self.max_us:
+            self.max_us = micros
+
+    def percentile(self, fraction: float) -> int:
+        """
+        The value (in microseconds) at `fraction` (0..1) of the recorded values.
+        """
+        if not self.count:
+            return 0
+        target = max(1, int(fraction * self.count + 0.999999))
+        seen = 0
+        for index, bucket in enumerate(self.counts):
+            seen += bucket
+            if seen >= target:
+                return min(self._upper_bound(index), self.max_us)
+        return self.max_us
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "mean_us": self.total_us / self.count if self.count else 0.0,
+            "p50_us": self.percentile(0.50),
+            "p99_us": self.percentile(0.99),
+            "p999_us": self.percentile(0.999),
+            "max_us": self.max_us,
+        }
+
+
+class SamplingProfiler:
+    """
+    Profile one in every `every` instrumented calls with cProfile.
+
+    Only one call is profiled at a time: cProfile can't run twice at once
+    (and on Python 3.12+ it watches every thread), so a sampled call that
+    finds the profiler busy just runs unprofiled.
+    """
+
+    def __init__(self, every: int = 100) -> None:
+        if every < 1:
+            raise ValueError("Profile sample rate must be at least 1")
+        self.every = every
+        self.sampled = 0
+        self._calls = 0
+        self._profile = cProfile.Profile()
+        self._busy = threading.Lock()
+
+    def call(self, method, *args, **kwargs):
+        self._calls += 1
+        if self._calls % self.every or not self._busy.acquire(blocking=False):
+            return method(*args, **kwargs)
+        try:
+            self.sampled += 1
+            return self._profile.runcall(method, *args, **kwargs)
+        finally:
+            self._busy.release()
+
+    def report(self, limit: int = 20, path: Optional[str] = None) -> str:
+        """
+        The top `limit` functions by cumulative time, as text.
+
+        Args:
+            limit: Number of functions to list
+            path: Also write the raw profile here (for pstats/snakeviz)
+        """
+        with self._busy:
+            if path:
+                self._profile.dump_stats(path)
+            if not self.sampled:
+                return "No samples yet"
+            out = io.StringIO()
+            stats = pstats.Stats(self._profile, stream=out)
+            stats.sort_stats("cumulative").print_stats(limit)
+        return f"{self.sampled} sampled calls\n" + out.getvalue().strip()
+
+
+class Metrics:
+    """
+    Counters, latency histograms and the slow log for one store.
+
+    Attributes:
+        counters: name -> running total (ops, bytes appended, fsyncs, ...)
+        histograms: name -> LatencyHistogram, created on first use
+        slowlog_threshold_us: Operations at least this slow go to the slow log
+        profiler: The active SamplingProfiler, or None
+    """
+
+    def __init__(self, slowlog_threshold_ms: float = 10.0, slowlog_max_len: int = 128) -> None:
+        self.started = time.time()
+        self.counters: Dict[str, int] = {}
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.slowlog_threshold_us = int(slowlog_threshold_ms * 1000)
+        self._slowlog: deque = deque(maxlen=slowlog_max_len)
+        self._slowlog_id = 0
+        self.profiler: Optional[SamplingProfiler] = None
+        self.last_profiler: Optional[SamplingProfiler] = None
+
+    def add(self, name: str, amount: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name: str, seconds: float, args: Tuple = ()) -> None:
+        """
+        Record one timed operation.
+
+        Args:
+            name: Operation name ("get", "set", "fsync", ...)
+            seconds: How long it took
+            args: The call's arguments, summarized in the slow log
+        """
+        micros = int(seconds * 1_000_000)
+        try:
+            self.histograms[name].record(micros)
+        except KeyError:
+            self.histograms[name] = LatencyHistogram()
+            self.histograms[name].record(micros)
+        if micros >= self.slowlog_threshold_us:
+            self._slowlog_id += 1
+            self._slowlog.append((self._slowlog_id, int(time.time()), micros,
+                                  name, _describe(args)))
+
+    def slowlog(self, count: int = 10) -> List[Tuple[int, int, int, str, str]]:
+        """
+        The `count` most recent slow operations, newest first.
+
+        Returns:
+            (id, unix time, duration in us, operation, arguments) tuples
+        """
+        return list(reversed(self._slowlog))[:count]
+
+    def slowlog_len(self) -> int:
+        return len(self._slowlog)
+
+    def slowlog_reset(self) -> None:
+        self._slowlog.clear()
+
+    def start_profiling(self, every: int = 100) -> None:
+        self.profiler = self.last_profiler = SamplingProfiler(every)
+
+    def stop_profiling(self) -> None:
+        self.profiler = None
+
+    def snapshot(self) -> Dict[str, object]:
+        return {
+            "uptime_s": time.time() - self.started,
+            "counters": dict(self.counters),
+            "latency": {name: histogram.summary()
+                        for name, histogram in sorted(self.histograms.items())},
+            "slowlog_len": len(self._slowlog),
+            "profiling": self.profiler is not None,
+        }
+
+
+def _describe(args: Tuple) -> str:
+    """
+    Short text for a call's arguments: strings (truncated) as they are,
+    anything else by type and size. I never iterate an argument here, since
+    it may be a one-shot generator the operation already consumed.
+    """
+    parts = []
+    for arg in args:
+        if isinstance(arg, str):
+            parts.append(arg if len(arg) <= 64 else f"{arg[:61]}...")
+        elif hasattr(arg, "__len__"):
+            parts.append(f"<{type(arg).__name__} of {len(arg)}>")
+        else:
+            parts.append(f"<{type(arg).__name__}>")
+    return " ".join(parts)
+
+
+def instrumented(name: str):
+    """
+    Decorator for SimpleKVStore methods: time every call into
+    self.metrics and route it through the sampling profiler when one is on.
+    """
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            metrics = self.metrics
+            started = perf_counter()
+            try:
+                if metrics.profiler is None:
+                    return method(self, *args, **kwargs)
+                return metrics.profiler.call(method, self, *args, **kwargs)
+            finally:
+                metrics.observe(name, perf_counter() - started, args)
+        return wrapper
+    return decorate
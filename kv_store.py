@@ -16,25 +16,866 @@ Date: October 18, 2025
 
 import sys
 import os
-from typing import Optional, Tuple, List, Dict
+import io
+import time
+import select
+import argparse
+import threading
+import mmap
+import struct
+import zlib
+import tempfile
+import itertools
+import concurrent.futures
+from collections import OrderedDict
+from typing import Optional, Tuple, List, Dict, Iterable, Iterator
 
+from kv_index import IndexEntry, CompactIndex, OrderedKeys, INDEX_ENGINES, prefix_end
+from kv_stats import Metrics, instrumented
+from kv_expiry import TimingWheel, now_ms
+from kv_codec import (Compressor, COMPRESSIONS, DICTIONARY_VALUE_BYTES, MAX_DICTIONARY_BYTES,
+                      decompress, dictionary_path, load_dictionaries, read_dictionary,
+                      train_dictionary, write_dictionary)
 
-class IndexEntry:
+
+# Durability modes for SET. I keep them as plain strings so they can be
+# passed straight through from the command line.
+# - "always":   I fsync after every single write (the original behavior)
+# - "group":    I batch concurrent writers into one write + one fsync
+# - "periodic": I fsync on a fixed timer and release every writer it covered
+DURABILITY_ALWAYS = "always"
+DURABILITY_GROUP = "group"
+DURABILITY_PERIODIC = "periodic"
+DURABILITY_MODES = (DURABILITY_ALWAYS, DURABILITY_GROUP, DURABILITY_PERIODIC)
+
+# Read modes for GET.
+# - "pread": one positional read per GET on a log handle I keep open
+# - "mmap":  I map the log and slice values straight out of the mapping
+READ_MODE_PREAD = "pread"
+READ_MODE_MMAP = "mmap"
+READ_MODES = (READ_MODE_PREAD, READ_MODE_MMAP)
+
+# Every record starts with [key_length: 4 bytes][value_length: 4 bytes]
+RECORD_HEADER = struct.Struct(">II")
+HEADER_SIZE = RECORD_HEADER.size
+
+# Record types. Keys are capped at 64KB, so the top byte of the key length
+# word was always 0 in logs written before record types existed. I use that
+# byte for the type, which keeps those old logs readable as plain SETs.
+# - RECORD_PUT:   [key_length][value_length][key][value] (a normal SET)
+# - RECORD_BATCH: header for an MSET; no key, and the value is
+#                 [count: 4][payload_length: 8][payload_crc: 4]. The next
+#                 payload_length bytes are the batch's PUT records, and
+#                 recovery only applies them if all of them are present and
+#                 their CRC32 matches.
+# - RECORD_DELETE: a tombstone, [key_length][0][key]; the key is gone
+# - RECORD_CHUNK: [0][chunk_length][data], one piece of a large value. Chunks
+#                 have no key and are never indexed themselves; they only
+#                 mean something to the RECORD_LARGE record that follows them.
+# - RECORD_LARGE: the manifest of a large value, [key_length][value_length]
+#                 [key][LARGE_INFO]. LARGE_INFO is [total_length: 8]
+#                 [chunks_back: 8][chunk_size: 4][crc32: 4]: the value is in
+#                 the chunk records right in front of this record, starting
+#                 chunks_back bytes before LARGE_INFO, with chunk_size data
+#                 bytes each (the last may be shorter). The distance is
+#                 relative, so the chunks and the manifest can be moved
+#                 together verbatim. A crash before the manifest is written
+#                 leaves orphan chunks, which recovery skips and compaction drops.
+# The low 4 bits of the byte are the type and the high 4 bits are flags:
+# - RECORD_FLAG_TTL: the value starts with an 8-byte expiry time (unix
+#                    milliseconds); value_length includes those 8 bytes
+# - RECORD_FLAG_COMPRESSED: PUT only; the value (after the expiry time) is
+#                    compressed, starting with a codec byte (see kv_codec.py)
+RECORD_PUT = 0
+RECORD_BATCH = 1
+RECORD_DELETE = 2
+RECORD_CHUNK = 3
+RECORD_LARGE = 4
+RECORD_TYPE_MASK = 0x0F
+RECORD_FLAG_TTL = 0x10
+RECORD_FLAG_COMPRESSED = 0x20
+RECORD_TYPE_SHIFT = 24
+KEY_LENGTH_MASK = (1 << RECORD_TYPE_SHIFT) - 1
+BATCH_INFO = struct.Struct(">IQI")
+EXPIRY = struct.Struct(">Q")
+LARGE_INFO = struct.Struct(">QQII")
+
+# value_length of a tombstone in _PendingWrite.records and the value_offset
+# scan_segment reports for one
+TOMBSTONE = -1
+
+# Rough Python object overhead per cached value, counted against the cache size
+CACHE_ENTRY_OVERHEAD = 96
+
+# Recovery treats anything larger than these as corruption
+MAX_KEY_LENGTH = 65536  # 64KB limit
+MAX_VALUE_LENGTH = 1048576  # 1MB limit
+# The limit covers the whole value field, so a value with a TTL has to
+# leave room for its 8-byte expiry time
+MAX_TTL_VALUE_LENGTH = MAX_VALUE_LENGTH - EXPIRY.size
+
+# Values longer than MAX_VALUE_LENGTH are stored as RECORD_CHUNK records of
+# LARGE_CHUNK_SIZE bytes. The index entry of a large value points at its
+# LARGE_INFO and has LARGE_VALUE set in value_length, so a reader can tell
+# the two kinds apart from the entry alone.
+LARGE_CHUNK_SIZE = 1048576
+LARGE_VALUE = 1 << 31
+
+# The index entry of a compressed value has COMPRESSED_VALUE set in
+# value_length, which then holds the stored (compressed) length
+COMPRESSED_VALUE = 1 << 30
+VALUE_LENGTH_MASK = COMPRESSED_VALUE - 1
+
+# Hint file (index snapshot) format, stored next to the log as <data_file>.hint
+# Header:   [magic: 8][version: 4][covered_segment: 4][covered_end: 8]
+#           [segment_count: 4][entry_count: 8][body_crc: 4]
+# Segments: segment_count rows [segment_id: 4][size: 8][tail_crc: 4]
+# Entries:  entry_count fixed rows [key_length: 4][segment_id: 4]
+#           [value_offset: 8][value_length: 4][expires_at: 8, 0 for none]
+#           [chunks_length: 8, 0 unless value_length has LARGE_VALUE set]
+#           (value_length includes the LARGE_VALUE and COMPRESSED_VALUE bits)
+#           followed by all keys concatenated in the same order
+# Keeping the fixed part separate lets me unpack it with struct.iter_unpack and
+# decode all keys with a single UTF-8 decode instead of one per entry.
+# (covered_segment, covered_end) is the log position the snapshot describes;
+# I only replay the log after it. Each segment row records the size and a
+# CRC32 of the last bytes the snapshot saw, which tells me whether the
+# segments on disk are still the ones the snapshot was taken of.
+HINT_MAGIC = b"KVHINT\x00\x01"
+HINT_VERSION = 5
+HINT_HEADER = struct.Struct(">8sIIQIQI")
+HINT_SEGMENT = struct.Struct(">IQI")
+HINT_ENTRY = struct.Struct(">IIQIQQ")
+HINT_TAIL_BYTES = 4096
+
+# With lazy_recovery, my background recovery scans the log in pieces of this
+# size and applies each under the write lock, so SETs never wait on more
+# than one piece
+RECOVERY_PIECE_BYTES = 1024 * 1024
+
+
+def segment_path(data_file: str, segment: int) -> str:
+    """
+    Path of a log segment.
+    
+    Segment 0 is the data file itself, so a store that never rolls over
+    keeps using a single data.db exactly like before. Later segments are
+    numbered files next to it: data.db.000001, data.db.000002, ...
+    """
+    if segment == 0:
+        return data_file
+    return f"{data_file}.{segment:06d}"
+
+
+def list_segments(data_file: str) -> List[int]:
+    """
+    Find the segment ids that exist on disk for a data file, in order.
+    """
+    directory = os.path.dirname(os.path.abspath(data_file))
+    prefix = os.path.basename(data_file) + "."
+    segments = []
+    if os.path.exists(data_file):
+        segments.append(0)
+    for name in os.listdir(directory):
+        suffix = name[len(prefix):]
+        if name.startswith(prefix) and len(suffix) == 6 and suffix.isdigit():
+            segments.append(int(suffix))
+    segments.sort()
+    return segments
+
+
+def scan_segment(path: str, start: int = 0) -> Tuple[Dict[str, Tuple[int, int, int, int, int]], int]:
+    """
+    Replay one log segment and return the latest record for each key in it.
+    
+    This is a module-level function (not a method) so that it can run in a
+    worker process during a parallel index rebuild.
+    
+    I map the whole segment instead of reading it record by record, so a
+    record never straddles a buffer boundary and nothing is copied except
+    the key bytes. Per record I do one struct.unpack_from for the header and
+    one UTF-8 decode of the key; values are never touched.
+    
+    Process:
+    1. I start at `start` (0, or where a hint snapshot left off)
+    2. I parse each entry (key_len, val_len, key) and skip over the value
+    3. I keep the latest (value_offset, value_length, key_length, expires_at,
+       chunks_length) for each key; a tombstone has value_offset TOMBSTONE,
+       a record without a TTL has expires_at 0, and chunks_length is only
+       set for a large value (whose value_offset points at its LARGE_INFO)
+    4. I implement "last write wins" - newer entries overwrite older ones
+    
+    Error Handling:
+    - I handle corrupted entries gracefully
+    - I stop at the first corrupted entry (fail-fast)
+    - I log warnings but continue operation
+    
+    Args:
+        path: The segment file to scan
+        start: File offset of the first record to read
+        
+    Returns:
+        (records, valid_end): records maps key -> (value_offset, value_length,
+        key_length, expires_at, chunks_length); valid_end is the end of the last complete record
+        
+    Raises:
+        IOError: If the file cannot be opened
+        OSError: If there are disk read errors
+    """
+    records: Dict[str, Tuple[int, int, int, int, int]] = {}
+    try:
+        with open(path, 'rb') as file_handle:
+            file_size = os.fstat(file_handle.fileno()).st_size
+            if file_size <= start:
+                # Nothing to scan (and an empty file can't be mapped)
+                return records, min(start, file_size)
+            with mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+                valid_end = _scan_buffer(mapping, start, file_size, records, path)
+    except IOError as e:
+        # File open/read errors and disk errors - critical failure
+        print(f"Error: I cannot read data file {path}: {e}", 
+              file=sys.stderr, flush=True)
+        raise
+    return records, valid_end
+
+
+def _scan_buffer(buffer, start: int, end: int,
+                 records: Dict[str, Tuple[int, int, int, int, int]], path: str,
+                 floor: Optional[int] = None, quiet: bool = False) -> int:
+    """
+    Parse the records in buffer[start:end] into `records`.
+    
+    Args:
+        buffer: An mmap or bytes-like object holding the segment
+        start: Offset of the first record
+        end: Offset just past the last byte I may read
+        records: key -> (value_offset, value_length, key_length, expires_at,
+            chunks_length), updated in place
+        path: Segment name, only used in warnings
+        floor: Lowest offset the chunks of a large value may start at
+            (default: start). A replica tailing a log passes 0, since the
+            chunks may have arrived in an earlier piece.
+        quiet: Don't warn about a record that ends past `end`, or a batch
+            that fails its checksum. A replica reading a live log sees
+            half-written records all the time.
+        
+    Returns:
+        The offset just past the last complete record
+    """
+    unpack_header = RECORD_HEADER.unpack_from
+    if floor is None:
+        floor = start
+    offset = start
+    while offset < end:
+        # Corruption check: a partial header indicates a torn write
+        if end - offset < HEADER_SIZE:
+            if not quiet:
+                print(f"Warning: Incomplete entry at offset {offset} in {path}, I'm stopping rebuild", 
+                      file=sys.stderr, flush=True)
+            break
+        
+        # I read both lengths with a single unpack (big-endian format)
+        key_len, val_len = unpack_header(buffer, offset)
+        record_type = key_len >> RECORD_TYPE_SHIFT
+        key_len &= KEY_LENGTH_MASK
+        
+        if record_type == RECORD_BATCH:
+            # An MSET is all or nothing: I only step into its records if
+            # the whole payload made it to disk intact
+            batch_end = offset + HEADER_SIZE + BATCH_INFO.size
+            if key_len != 0 or val_len != BATCH_INFO.size or batch_end > end:
+                if not (quiet and key_len == 0 and val_len == BATCH_INFO.size):
+                    print(f"Warning: Incomplete batch header at offset {offset} in {path}", 
+                          file=sys.stderr, flush=True)
+                break
+            _, payload_len, payload_crc = BATCH_INFO.unpack_from(buffer, offset + HEADER_SIZE)
+            if batch_end + payload_len > end:
+                if not quiet:
+                    print(f"Warning: Incomplete batch at offset {offset} in {path}, "
+                          f"I'm discarding it", file=sys.stderr, flush=True)
+                break
+            if zlib.crc32(buffer[batch_end:batch_end + payload_len]) != payload_crc:
+                if not quiet:
+                    print(f"Warning: Batch at offset {offset} in {path} fails its checksum "
+                          f"(CRC mismatch), I'm discarding it", file=sys.stderr, flush=True)
+                break
+            offset = batch_end
+            continue
+        
+        if record_type == RECORD_CHUNK:
+            # Part of a large value: the manifest after it says whether it
+            # belongs to anything, so all I check here is that it is whole
+            chunk_end = offset + HEADER_SIZE + val_len
+            if key_len != 0 or val_len > LARGE_CHUNK_SIZE or chunk_end > end:
+                if not (quiet and key_len == 0 and val_len <= LARGE_CHUNK_SIZE):
+                    print(f"Warning: Incomplete chunk at offset {offset} in {path}", 
+                          file=sys.stderr, flush=True)
+                break
+            offset = chunk_end
+            continue
+        
+        flags = record_type & ~RECORD_TYPE_MASK
+        record_type &= RECORD_TYPE_MASK
+        # Same checks as _valid_record, inline since this loop is recovery
+        if (record_type not in (RECORD_PUT, RECORD_DELETE, RECORD_LARGE)
+                or flags & ~(RECORD_FLAG_TTL | RECORD_FLAG_COMPRESSED)
+                or (flags & RECORD_FLAG_COMPRESSED and record_type != RECORD_PUT)
+                or (record_type == RECORD_DELETE and (flags or val_len))
+                or (flags & RECORD_FLAG_TTL and val_len < EXPIRY.size)
+                or (record_type == RECORD_LARGE
+                    and val_len != LARGE_INFO.size + (EXPIRY.size if flags else 0))):
+            print(f"Warning: Unknown record type {record_type} (flags {flags:#x}) "
+                  f"at offset {offset} in {path}", file=sys.stderr, flush=True)
+            break
+        
+        # Sanity check: I reject unreasonably large keys (prevents memory attacks)
+        if key_len > MAX_KEY_LENGTH:
+            print(f"Warning: Suspiciously large key length {key_len} at offset {offset} in {path}", 
+                  file=sys.stderr, flush=True)
+            break
+        
+        # Sanity check: I reject unreasonably large values
+        if val_len > MAX_VALUE_LENGTH:
+            print(f"Warning: Suspiciously large value length {val_len} at offset {offset} in {path}", 
+                  file=sys.stderr, flush=True)
+            break
+        
+        key_start = offset + HEADER_SIZE
+        value_start = key_start + key_len
+        record_end = value_start + val_len
+        
+        # Truncation check: the key and value must both be in the file
+        if record_end > end:
+            if not quiet:
+                print(f"Warning: Incomplete record at offset {offset} in {path}", 
+                      file=sys.stderr, flush=True)
+            break
+        
+        # I decode the key (the only bytes I copy out of the buffer)
+        try:
+            key = buffer[key_start:value_start].decode('utf-8')
+        except UnicodeDecodeError as e:
+            print(f"Warning: Invalid UTF-8 in key at offset {offset} in {path}: {e}", 
+                  file=sys.stderr, flush=True)
+            break
+        
+        # The dictionary automatically handles "last write wins" for me
+        if record_type == RECORD_DELETE:
+            records[key] = (TOMBSTONE, 0, key_len, 0, 0)
+            offset = record_end
+            continue
+        expires_at = 0
+        if flags & RECORD_FLAG_TTL:
+            expires_at = EXPIRY.unpack_from(buffer, value_start)[0]
+            value_start += EXPIRY.size
+        value_length = record_end - value_start
+        if flags & RECORD_FLAG_COMPRESSED:
+            value_length |= COMPRESSED_VALUE
+        chunks_length = 0
+        if record_type == RECORD_LARGE:
+            # The chunks sit right in front of the manifest, and always after
+            # `floor`: a snapshot never ends between them
+            chunks_length = LARGE_INFO.unpack_from(buffer, value_start)[1] - (value_start - offset)
+            if chunks_length < 0 or offset - chunks_length < floor:
+                print(f"Warning: Large value at offset {offset} in {path} "
+                      f"points outside the log", file=sys.stderr, flush=True)
+                break
+        records[key] = (value_start, value_length, key_len, expires_at, chunks_length)
+        offset = record_end
+    return offset
+
+
+def _valid_record(record_type: int, flags: int, val_len: int) -> bool:
+    """
+    Whether a PUT, DELETE or LARGE header has flags and a value length
+    that go together.
+    """
+    return not (record_type not in (RECORD_PUT, RECORD_DELETE, RECORD_LARGE)
+                or flags & ~(RECORD_FLAG_TTL | RECORD_FLAG_COMPRESSED)
+                or (flags & RECORD_FLAG_COMPRESSED and record_type != RECORD_PUT)
+                or (record_type == RECORD_DELETE and (flags or val_len))
+                or (flags & RECORD_FLAG_TTL and val_len < EXPIRY.size)
+                or (record_type == RECORD_LARGE
+                    and val_len != LARGE_INFO.size + (EXPIRY.size if flags else 0)))
+
+
+def _record_at(buffer, offset: int, key_length: int,
+               end: int) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Check whether a PUT, DELETE or LARGE record for a key of key_length
+    bytes starts at `offset`, as far as its header and the next one tell.
+    
+    Used when searching a log backwards, where I can't parse my way to a
+    record from the start of the segment.
+    
+    Args:
+        buffer: An mmap or bytes-like object holding the segment
+        offset: Where the header would be
+        key_length: Length of the encoded key I'm looking for
+        end: Offset just past the last byte I may read
+        
+    Returns:
+        (record type, flags, value offset, record end), or None if the bytes
+        don't look like such a record
+    """
+    if offset < 0:
+        return None
+    key_len, val_len = RECORD_HEADER.unpack_from(buffer, offset)
+    record_type = key_len >> RECORD_TYPE_SHIFT
+    flags = record_type & ~RECORD_TYPE_MASK
+    record_type &= RECORD_TYPE_MASK
+    if (key_len & KEY_LENGTH_MASK != key_length
+            or not _valid_record(record_type, flags, val_len)
+            or val_len > MAX_VALUE_LENGTH):
+        return None
+    value_start = offset + HEADER_SIZE + key_length
+    record_end = value_start + val_len
+    if record_end > end:
+        return None
+    
+    # Fewer bytes than a header after it is the end of the range or a torn
+    # tail; anything else must start like a record
+    if end - record_end >= HEADER_SIZE:
+        key_len, val_len = RECORD_HEADER.unpack_from(buffer, record_end)
+        next_type = key_len >> RECORD_TYPE_SHIFT
+        key_len &= KEY_LENGTH_MASK
+        if next_type == RECORD_BATCH:
+            plausible = key_len == 0 and val_len == BATCH_INFO.size
+        elif next_type == RECORD_CHUNK:
+            plausible = key_len == 0 and val_len <= LARGE_CHUNK_SIZE
+        else:
+            plausible = (_valid_record(next_type & RECORD_TYPE_MASK, next_type & ~RECORD_TYPE_MASK,
+                                       val_len)
+                         and 0 < key_len <= MAX_KEY_LENGTH and val_len <= MAX_VALUE_LENGTH)
+        if not plausible:
+            return None
+    return record_type, flags, value_start, record_end
+
+
+def _is_torn_tail(path: str, start: int, size: int) -> bool:
+    """
+    Whether the bytes from `start` to the end of a log file are one record
+    cut short by a crash, rather than a damaged record with more log
+    behind it.
+    
+    A torn tail is a plausible record header (or less than a header) whose
+    record would end past the end of the file. A crash can only leave
+    that: I write every record (or batch) with one write and fsync it
+    before writing the next.
+    """
+    if size - start < HEADER_SIZE:
+        return True
+    with open(path, 'rb') as file_handle:
+        file_handle.seek(start)
+        head = file_handle.read(HEADER_SIZE + BATCH_INFO.size)
+    key_len, val_len = RECORD_HEADER.unpack_from(head)
+    record_type = key_len >> RECORD_TYPE_SHIFT
+    key_len &= KEY_LENGTH_MASK
+    record_end = start + HEADER_SIZE + key_len + val_len
+    if record_type == RECORD_BATCH:
+        if key_len or val_len != BATCH_INFO.size:
+            return False
+        if len(head) == HEADER_SIZE + BATCH_INFO.size:
+            record_end += BATCH_INFO.unpack_from(head, HEADER_SIZE)[1]
+    elif record_type == RECORD_CHUNK:
+        if key_len or val_len > LARGE_CHUNK_SIZE:
+            return False
+    elif (not _valid_record(record_type & RECORD_TYPE_MASK, record_type & ~RECORD_TYPE_MASK, val_len)
+          or key_len > MAX_KEY_LENGTH or val_len > MAX_VALUE_LENGTH):
+        return False
+    return record_end > size
+
+
+def _scan_segment_task(task: Tuple[str, int]) -> Tuple[Dict[str, Tuple[int, int, int, int, int]], int]:
+    """Unpack a (path, start) task for ProcessPoolExecutor.map."""
+    return scan_segment(*task)
+
+
+class _PendingWrite:
+    """
+    One encoded write (a single SET or a whole MSET batch) waiting in the
+    group commit queue.
+    
+    The writer thread that created it blocks until the flusher marks it done.
+    I only acknowledge the caller after the fsync that covers this write.
+    
+    Attributes:
+        payload: The fully encoded record bytes
+        records: One (key, key_length, value_end, value_length, value,
+            expires_at, chunks_length) tuple per key in the payload, where
+            value_end is relative to the start of the payload, value is the
+            decoded value for write-through to the value cache, expires_at is
+            the expiry time in unix ms (0 for none) and chunks_length is the
+            size of a large value's chunk records (0 for a normal value). A
+            tombstone has value_length TOMBSTONE.
+        enqueued_at: time.monotonic() when I queued the write
+        done: True once the write is durable (or failed)
+        error: The exception raised while flushing, if any
+    """
+    __slots__ = ['payload', 'records', 'enqueued_at', 'done', 'error']
+    
+    def __init__(self, payload: bytes,
+                 records: List[Tuple[str, int, int, int, Optional[str], int, int]]) -> None:
+        self.payload = payload
+        self.records = records
+        self.enqueued_at = time.monotonic()
+        self.done = False
+        self.error: Optional[BaseException] = None
+
+
+def _read_full(fileobj, view: memoryview) -> int:
+    """
+    Fill `view` from a binary file object, stopping early only at EOF.
+    
+    Pipes and sockets return short reads, but every chunk of a large value
+    except the last must be full, so I keep reading until it is. I use
+    readinto() when the object has it, so the data lands in my buffer
+    without an intermediate bytes object.
+    
+    Returns:
+        Number of bytes read (less than len(view) only at EOF)
+    """
+    readinto = getattr(fileobj, 'readinto', None)
+    filled = 0
+    while filled < len(view):
+        if readinto is not None:
+            count = readinto(view[filled:])
+        else:
+            data = fileobj.read(len(view) - filled)
+            count = len(data)
+            view[filled:filled + count] = data
+        if not count:
+            break
+        filled += count
+    return filled
+
+
+class ValueReader(io.RawIOBase):
+    """
+    A read-only binary stream over one stored value, as returned by
+    SimpleKVStore.get_stream().
+    
+    The value is read straight from the log on demand: readinto() fills the
+    caller's buffer with one positional read (os.preadv where available)
+    and sendfile() has the kernel copy it to a socket, so the value is never
+    held in memory. A large value is a run of equally spaced chunks, a
+    normal value a single one.
+    
+    I own a descriptor of the segment file, opened when the stream was
+    created. Compaction renames a new file over the segment rather than
+    changing it, so the stream keeps reading the bytes it was opened on.
+    
+    Attributes:
+        length: Size of the value in bytes
+    """
+    
+    def __init__(self, fd: int, first: int, stride: int, chunk_size: int,
+                 length: int, crc: Optional[int] = None) -> None:
+        """
+        Args:
+            fd: Descriptor to read from; I close it in close()
+            first: File offset of the first value byte
+            stride: Distance between the starts of consecutive chunks
+            chunk_size: Value bytes per chunk
+            length: Total value length
+            crc: Expected CRC32 of the value, checked when it is read
+                front to back with readinto() (None: no check)
+        """
+        super().__init__()
+        self._fd = fd
+        self._first = first
+        self._stride = stride
+        self._chunk_size = max(chunk_size, 1)
+        self.length = length
+        self._position = 0
+        self._crc = crc
+        self._crc_seen = 0
+        self._crc_end = 0
+    
+    def readable(self) -> bool:
+        return True
+    
+    def seekable(self) -> bool:
+        return True
+    
+    def tell(self) -> int:
+        return self._position
+    
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self._position = offset
+        return offset
+    
+    def _span(self) -> Tuple[int, int]:
+        """File offset and length of the contiguous bytes at my position."""
+        chunk, within = divmod(self._position, self._chunk_size)
+        count = min(self._chunk_size - within, self.length - self._position)
+        return self._first + chunk * self._stride + within, count
+    
+    def readinto(self, buffer) -> int:
+        """
+        Read up to len(buffer) bytes into `buffer`, at most one chunk.
+        
+        Returns:
+            Bytes read, 0 at the end of the value
+            
+        Raises:
+            IOError: If the log ends early or the value fails its CRC check
+        """
+        if self._position >= self.length:
+            return 0
+        offset, count = self._span()
+        view = memoryview(buffer).cast('B')
+        count = min(count, len(view))
+        view = view[:count]
+        if hasattr(os, 'preadv'):
+            read = os.preadv(self._fd, [view], offset)
+        else:
+            data = SimpleKVStore._pread(self._fd, count, offset)
+            read = len(data)
+            view[:read] = data
+        if read < count:
+            raise IOError(f"Corrupted entry: value ends early at offset {offset + read}")
+        
+        # I check the CRC as long as the value is read front to back
+        if self._crc is not None and self._position == self._crc_end:
+            self._crc_seen = zlib.crc32(view, self._crc_seen)
+            self._crc_end += count
+            if self._crc_end == self.length and self._crc_seen != self._crc:
+                raise IOError("Corrupted entry: large value fails its CRC check")
+        self._position += count
+        return count
+    
+    def sendfile(self, out) -> int:
+        """
+        Send the rest of the value to a socket or descriptor with
+        os.sendfile(), so the bytes go from the page cache to the socket
+        without passing through Python. Where sendfile() doesn't exist I
+        copy through one reusable buffer instead.
+        
+        Args:
+            out: A socket, file object or descriptor
+            
+        Returns:
+            Bytes sent
+        """
+        out_fd = out if isinstance(out, int) else out.fileno()
+        sent = 0
+        if not hasattr(os, 'sendfile'):
+            buffer = memoryview(bytearray(min(self._chunk_size, 1024 * 1024)))
+            while True:
+                count = self.readinto(buffer)
+                if not count:
+                    return sent
+                written = 0
+                while written < count:
+                    written += os.write(out_fd, buffer[written:count])
+                sent += count
+        while self._position < self.length:
+            offset, count = self._span()
+            try:
+                done = os.sendfile(out_fd, self._fd, offset, count)
+            except BlockingIOError:
+                # A non-blocking socket is full; wait until it drains
+                select.select([], [out_fd], [])
+                continue
+            if not done:
+                raise IOError(f"Corrupted entry: value ends early at offset {offset}")
+            self._position += done
+            sent += done
+        return sent
+    
+    def close(self) -> None:
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
+
+
+class LRUCache:
     """
-    Represents a single entry in the index.
+    Byte-bounded least-recently-used value cache.
     
-    I'm using a class instead of plain tuples because it provides better structure
-    and makes the code more maintainable.
+    I size the cache in bytes (key + value + a fixed per-entry overhead)
+    rather than in entries, because values can be anywhere from a few bytes
+    to a megabyte. All methods are thread-safe.
     
     Attributes:
-        offset: File offset where the entry begins
-        value_length: Length of the value in bytes
+        max_bytes: Capacity in bytes
+        used_bytes: Bytes currently held
+        hits, misses, evictions: Counters since creation
+    """
+    
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # key -> (value, size); the order is the recency order, oldest first
+        self._entries: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached value (and mark it recently used), or None."""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return item[0]
+    
+    def put(self, key: str, value: str, size: int, check=None) -> None:
+        """
+        Insert or replace a value.
+        
+        Args:
+            key: The key
+            value: The decoded value
+            size: Value size in bytes
+            check: Optional callable; if given, I only insert when it returns
+                True while I hold the cache lock (used by GET to avoid
+                caching a value that a concurrent SET just replaced)
+        """
+        size += len(key) + CACHE_ENTRY_OVERHEAD
+        with self._lock:
+            if check is not None and not check():
+                return
+            self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.used_bytes += size
+            self._evict()
+    
+    def invalidate(self, key: str) -> None:
+        """Drop a key from the cache if it is there."""
+        with self._lock:
+            self._remove(key)
+    
+    def resize(self, max_bytes: int) -> None:
+        """Change the capacity, evicting entries if the cache shrank."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+    
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "entries": len(self._entries),
+                    "used_bytes": self.used_bytes, "max_bytes": self.max_bytes}
+    
+    def _remove(self, key: str) -> None:
+        item = self._entries.pop(key, None)
+        if item is not None:
+            self.used_bytes -= item[1]
+    
+    def _evict(self) -> None:
+        while self.used_bytes > self.max_bytes:
+            _, (_, size) = self._entries.popitem(last=False)
+            self.used_bytes -= size
+            self.evictions += 1
+
+
+class TwoQueueCache(LRUCache):
+    """
+    Byte-bounded, scan-resistant value cache using the 2Q policy.
+    
+    A plain LRU is flushed by a single scan over many cold keys. 2Q keeps
+    keys seen once in a small FIFO (A1in, a quarter of the capacity). When
+    they fall out of it, I remember only the key in a ghost list (A1out).
+    A key that is requested again while in A1out has proven it is hot and
+    goes into the main LRU (Am). One-off keys therefore never push hot keys
+    out of Am.
     """
-    __slots__ = ['offset', 'value_length']  # I use __slots__ for memory optimization
     
-    def __init__(self, offset: int, value_length: int) -> None:
-        self.offset = offset
-        self.value_length = value_length
+    def __init__(self, max_bytes: int) -> None:
+        super().__init__(max_bytes)
+        # self._entries is Am; A1in is a FIFO of first-time keys; A1out
+        # only remembers keys (no values) that were evicted from A1in
+        self._a1in: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        self._a1in_bytes = 0
+        self._a1out: "OrderedDict[str, None]" = OrderedDict()
+    
+    def __len__(self) -> int:
+        return len(self._entries) + len(self._a1in)
+    
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None:
+                self._entries.move_to_end(key)
+            else:
+                # A hit in A1in doesn't promote: one re-read right after the
+                # first is typical of scans, not of hot keys
+                item = self._a1in.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return item[0]
+    
+    def put(self, key: str, value: str, size: int, check=None) -> None:
+        size += len(key) + CACHE_ENTRY_OVERHEAD
+        with self._lock:
+            if check is not None and not check():
+                return
+            in_main = key in self._entries or key in self._a1out
+            self._remove(key)
+            if size > self.max_bytes:
+                return
+            if in_main:
+                self._a1out.pop(key, None)
+                self._entries[key] = (value, size)
+            else:
+                self._a1in[key] = (value, size)
+                self._a1in_bytes += size
+            self.used_bytes += size
+            self._evict()
+    
+    def stats(self) -> Dict[str, int]:
+        stats = super().stats()
+        with self._lock:
+            stats["entries"] = len(self._entries) + len(self._a1in)
+            stats["a1in_entries"] = len(self._a1in)
+            stats["ghost_entries"] = len(self._a1out)
+        return stats
+    
+    def _remove(self, key: str) -> None:
+        super()._remove(key)
+        item = self._a1in.pop(key, None)
+        if item is not None:
+            self._a1in_bytes -= item[1]
+            self.used_bytes -= item[1]
+    
+    def _evict(self) -> None:
+        a1in_max = self.max_bytes // 4
+        while self.used_bytes > self.max_bytes:
+            if self._a1in and (self._a1in_bytes > a1in_max or not self._entries):
+                key, (_, size) = self._a1in.popitem(last=False)
+                self._a1in_bytes -= size
+                self._a1out[key] = None
+            else:
+                _, (_, size) = self._entries.popitem(last=False)
+            self.used_bytes -= size
+            self.evictions += 1
+        
+        # I remember about as many ghost keys as I hold real entries
+        ghost_max = max(len(self._entries) + len(self._a1in), 1)
+        while len(self._a1out) > ghost_max:
+            self._a1out.popitem(last=False)
+
+
+CACHE_POLICIES = {"lru": LRUCache, "2q": TwoQueueCache}
 
 
 class SimpleKVStore:
@@ -58,12 +899,105 @@ class SimpleKVStore:
     3. I get O(1) lookup performance vs O(n) for linear search
     4. Production databases (PostgreSQL, MySQL) use hash tables for indexes
     
+    Durability Modes:
+    - "always": one write + one fsync per SET (the original behavior)
+    - "group": concurrent SETs share a commit queue; one flush writes the
+      whole batch with a single fsync before any of those callers returns
+    - "periodic": a background timer fsyncs every N ms; each SET waits for
+      the fsync that covers its record
+    In every mode a caller is only acknowledged once its record is durable.
+    
+    Read Modes:
+    - "pread": I keep a read handle open and fetch each value with one
+      os.pread() at the value offset stored in the index
+    - "mmap": I map the log once and return values as slices of the
+      mapping, remapping only when the log has grown past the mapped size
+    
+    Value Cache:
+    With cache_bytes > 0 I keep decoded values of recently read keys in
+    memory ("lru", or the scan-resistant "2q" policy), so hot keys are
+    served without any file I/O. SET writes through to the cache after its
+    record is durable, so a GET never sees a stale value.
+    
+    Segments:
+    With segment_max_bytes set, the log is split into numbered, size-capped
+    segment files (data.db, data.db.000001, ...). Only the newest segment
+    is written to; older ones are immutable, which lets me compact them one
+    at a time and scan them in parallel on startup. Without it, data.db is
+    the one and only segment, exactly like before.
+    
+    Large Values:
+    A value over MAX_VALUE_LENGTH is stored as RECORD_CHUNK records plus a
+    RECORD_LARGE manifest written after them (see set_stream). get_stream()
+    reads one back through a ValueReader without loading it into memory.
+    
+    Lazy Recovery:
+    With lazy_recovery I load the hint snapshot, start a new segment for
+    writes and replay the rest of the log in a background thread, so SET and
+    GET are served right away. Anything written during recovery is in the
+    new segment, and I remember its keys so the replay never overwrites
+    them. A GET for a key the replay hasn't reached yet searches the
+    unreplayed part of the log backwards from the tail (see _unrecovered).
+    SCAN, RANGE, EXPORT and COMPACT wait until recovery is done;
+    recovery_progress() reports how far it got.
+    
+    Compression:
+    With compression set, SET stores values of at least
+    compression_min_bytes compressed with zlib or lzma (see kv_codec) when
+    that makes them shorter, and marks the record with
+    RECORD_FLAG_COMPRESSED. train_dictionary() builds a shared dictionary
+    from a sample of the stored values; from then on small values are
+    compressed against it. Reads decompress any flagged record whatever
+    the current setting, so logs written with and without compression mix
+    freely. Chunked large values are never compressed.
+    
+    Thread Safety:
+    One store can be shared by any number of threads (a threaded web
+    server, kv_server.py's pool, ...):
+    - Readers never take the write lock. GET looks up the index and reads
+      the value with os.pread(), which has no shared file position, so any
+      number of GETs run in parallel (and the GIL is released during the
+      read). In mmap mode they slice a shared read-only mapping instead.
+    - Writers are serialized through a single appender: _write_batch runs
+      under self._lock, either in the calling thread ("always") or in the
+      flusher thread, which also merges concurrent writers into one batch.
+    - I publish a record in the index only after it is written and fsynced,
+      and the index update itself is a single dict store (or, with
+      CompactIndex, a row appended before its slot is repointed). A reader
+      therefore sees either the old entry or the new one, and both point
+      at bytes that are already on disk.
+    - Compaction is the only thing that moves existing bytes. It bumps
+      _layout_version (a seqlock) around the file swap; a GET that overlaps
+      it retries, so it never pairs an old offset with the new file.
+    See `python kv_bench.py stress` for a torn-read check under load.
+    
     Attributes:
         data_file: Path to the persistent storage file
-        index: Dictionary mapping keys to IndexEntry objects (offset, length)
+        index: Dictionary mapping keys to IndexEntry objects (value offset, length)
+        durability: One of DURABILITY_MODES
+        read_mode: One of READ_MODES
     """
     
-    def __init__(self, data_file: str = "data.db") -> None:
+    def __init__(self, data_file: str = "data.db",
+                 durability: str = DURABILITY_ALWAYS,
+                 group_commit_max_wait_ms: float = 0.0,
+                 group_commit_max_batch: int = 256,
+                 fsync_interval_ms: float = 10.0,
+                 read_mode: str = READ_MODE_PREAD,
+                 use_hint: bool = True,
+                 hint_interval_bytes: int = 64 * 1024 * 1024,
+                 compact_dead_ratio: Optional[float] = 0.5,
+                 compact_min_bytes: int = 16 * 1024 * 1024,
+                 segment_max_bytes: Optional[int] = None,
+                 recovery_workers: Optional[int] = None,
+                 cache_bytes: int = 0,
+                 cache_policy: str = "lru",
+                 index_engine: str = "dict",
+                 slowlog_threshold_ms: float = 10.0,
+                 expiry_interval_ms: float = 100.0,
+                 lazy_recovery: bool = False,
+                 compression: Optional[str] = None,
+                 compression_min_bytes: int = 64) -> None:
         """
         Initialize the key-value store.
         
@@ -72,16 +1006,191 @@ class SimpleKVStore:
         
         Args:
             data_file: Path to the persistent storage file (default: "data.db")
+            durability: "always", "group" or "periodic" (default: "always")
+            group_commit_max_wait_ms: How long the group flusher waits for a
+                batch to fill after the first record arrives. With 0 I flush
+                as soon as the flusher is free; writers that arrive while an
+                fsync is running still form the next batch.
+            group_commit_max_batch: Maximum records per group commit
+            fsync_interval_ms: Timer period for "periodic" durability
+            read_mode: "pread" or "mmap" (default: "pread")
+            use_hint: Load/write the <data_file>.hint index snapshot
+            hint_interval_bytes: Write a new snapshot in the background
+                after this many bytes have been appended since the last one
+            compact_dead_ratio: Start a background compaction when this
+                fraction of the log is superseded records (None disables it)
+            compact_min_bytes: Never auto-compact logs smaller than this
+            segment_max_bytes: Roll over to a new segment once the active
+                one reaches this size (None keeps a single data file)
+            recovery_workers: Processes used to scan segments on startup
+                (default: one per CPU)
+            cache_bytes: Size of the value cache in bytes (0 disables it)
+            cache_policy: "lru" or "2q" (default: "lru")
+            index_engine: "dict" or "compact" (default: "dict"). The compact
+                index (kv_index.CompactIndex) keeps keys and offsets in flat
+                arrays, for keyspaces too large for one Python object per key.
+            slowlog_threshold_ms: Operations at least this slow are kept in
+                the slow log (see stats() and the SLOWLOG command)
+            expiry_interval_ms: How often my expiry thread deletes keys
+                whose TTL ran out (GET never returns them either way)
+            lazy_recovery: Replay the log in the background instead of
+                before returning (see "Lazy Recovery" above). Writes made
+                meanwhile start a new segment file.
+            compression: "zlib" or "lzma" to compress new values, None
+                (default) to store them as they are
+            compression_min_bytes: Values shorter than this are never
+                compressed; the codec header would eat the savings
             
         Raises:
             OSError: If there are permission issues with the data directory
+            ValueError: If the durability settings are invalid
         """
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode '{durability}', "
+                             f"expected one of {', '.join(DURABILITY_MODES)}")
+        if read_mode not in READ_MODES:
+            raise ValueError(f"Unknown read mode '{read_mode}', "
+                             f"expected one of {', '.join(READ_MODES)}")
+        if group_commit_max_batch < 1:
+            raise ValueError("group_commit_max_batch must be at least 1")
+        if group_commit_max_wait_ms < 0 or fsync_interval_ms <= 0:
+            raise ValueError("Commit wait times must be positive")
+        if segment_max_bytes is not None and segment_max_bytes <= 0:
+            raise ValueError("segment_max_bytes must be positive")
+        if cache_policy not in CACHE_POLICIES:
+            raise ValueError(f"Unknown cache policy '{cache_policy}', "
+                             f"expected one of {', '.join(CACHE_POLICIES)}")
+        if index_engine not in INDEX_ENGINES:
+            raise ValueError(f"Unknown index engine '{index_engine}', "
+                             f"expected one of {', '.join(INDEX_ENGINES)}")
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression '{compression}', "
+                             f"expected one of {', '.join(COMPRESSIONS)}")
+        if compression_min_bytes < 0:
+            raise ValueError("compression_min_bytes must not be negative")
+        
         self.data_file: str = data_file
+        self.durability: str = durability
+        self.group_commit_max_wait: float = group_commit_max_wait_ms / 1000.0
+        self.group_commit_max_batch: int = group_commit_max_batch
+        self.fsync_interval: float = fsync_interval_ms / 1000.0
+        self.read_mode: str = read_mode
+        self.hint_file: str = data_file + ".hint"
+        self.use_hint: bool = use_hint
+        self.hint_interval_bytes: int = hint_interval_bytes
+        self.compact_dead_ratio: Optional[float] = compact_dead_ratio
+        self.compact_min_bytes: int = compact_min_bytes
+        self.segment_max_bytes: Optional[int] = segment_max_bytes
+        self.recovery_workers: int = recovery_workers or os.cpu_count() or 1
+        self.cache_policy: str = cache_policy
+        self.index_engine: str = index_engine
         
-        # I use a dictionary (hash table) for O(1) index lookups
-        # This maps key (str) -> IndexEntry(offset, value_length)
+        # Counters, latency histograms and the slow log behind stats()
+        self.metrics = Metrics(slowlog_threshold_ms)
+        self.expiry_interval: float = expiry_interval_ms / 1000.0
+        
+        # The value cache sits in front of the log; None when disabled
+        self._cache: Optional[LRUCache] = None
+        if cache_bytes > 0:
+            self._cache = CACHE_POLICIES[cache_policy](cache_bytes)
+        
+        # I use a hash table for O(1) index lookups: a dict by default, or
+        # a CompactIndex with the same interface for very large keyspaces
+        # This maps key (str) -> IndexEntry(value_offset, value_length, segment)
         # This is a best practice for index structures in databases
-        self.index: Dict[str, IndexEntry] = {}
+        self.index: Dict[str, IndexEntry] = INDEX_ENGINES[index_engine]()
+        
+        # The sorted key list behind SCAN/RANGE. I only build it on the
+        # first range query, so stores that never scan don't pay for it.
+        self._ordered: Optional[OrderedKeys] = None
+        
+        # TTL state: expiry time (unix ms) of every key that has one, and the
+        # timing wheel that tells my expiry thread which keys are due.
+        # _segment_tombstones counts tombstone bytes I keep in each segment
+        # because they may hide a record in an older segment; I count them as
+        # live so compaction doesn't keep rewriting them.
+        self._expires: Dict[str, int] = {}
+        self._wheel = TimingWheel()
+        self._segment_tombstones: Dict[int, int] = {}
+        self._expiry_stop = threading.Event()
+        self._expiry_thread: Optional[threading.Thread] = None
+        
+        # Large values: key -> bytes of chunk records in front of its
+        # manifest. The index entry alone tells readers a value is large
+        # (LARGE_VALUE); I only need this for live byte accounting and to
+        # copy the chunks along when compacting. Guarded by _lock.
+        self._large: Dict[str, int] = {}
+        
+        # Write path state. I keep the log open for appends for the life of
+        # the store instead of reopening it on every SET.
+        # _lock serializes appends and index updates; _valid_end is the end
+        # of the last complete record in the active segment (anything after
+        # it is a torn tail).
+        self._lock = threading.RLock()
+        self._writer = None
+        self._valid_end: int = 0
+        
+        # Segment state: ids on disk in order, the one I append to, and the
+        # size and live bytes of each. _sealed_bytes is the total size of all
+        # segments except the active one.
+        self._segments: List[int] = [0]
+        self._active_segment: int = 0
+        self._segment_sizes: Dict[int, int] = {0: 0}
+        self._segment_live: Dict[int, int] = {0: 0}
+        self._sealed_bytes: int = 0
+        
+        # Group commit state: writers append _PendingWrite objects to the
+        # queue and wait on the condition until the flusher marks them done
+        self._commit_cond = threading.Condition(threading.Lock())
+        self._commit_queue: List[_PendingWrite] = []
+        self._flusher: Optional[threading.Thread] = None
+        self._closing = False
+        
+        # Read path state. I keep one read descriptor per segment open for
+        # the life of the store. In mmap mode _maps[segment] covers the first
+        # len() bytes of that segment and _map_lock guards (re)mapping.
+        self._reader_fds: Dict[int, int] = {}
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._map_lock = threading.Lock()
+        
+        # Hint snapshot state: bytes appended since my last snapshot and the
+        # background thread writing the next one (at most one at a time)
+        self._appended_since_hint: int = 0
+        self._hint_thread: Optional[threading.Thread] = None
+        
+        # Compaction state. _live_bytes is the size of all records the index
+        # still points to; everything else in the log is dead. _layout_version
+        # is odd while I'm swapping in a compacted log, and readers retry if
+        # it changed underneath them (a seqlock, so GETs never take a lock).
+        self._live_bytes: int = 0
+        self._layout_version: int = 0
+        self._compact_thread: Optional[threading.Thread] = None
+        self._compact_stats: Dict[str, float] = {
+            "runs": 0,
+            "bytes_reclaimed": 0,
+            "last_bytes_reclaimed": 0,
+            "last_duration_s": 0.0,
+            "failures": 0,
+        }
+        
+        # Lazy recovery state. _recovering is True until the background
+        # replay has applied the whole log; _recovery_written holds every key
+        # written since I started serving, which the replay must leave alone.
+        # _recovery_ranges is (segment, replayed up to, end) for each segment
+        # not fully replayed yet, replaced as a whole after every piece.
+        # _recovery_found remembers what _unrecovered found per key.
+        self._recovering: bool = False
+        self._recovery_written: set = set()
+        self._recovery_ranges: Tuple[Tuple[int, int, int], ...] = ()
+        self._recovery_found: Dict[str, Optional[Tuple[Optional[IndexEntry], int]]] = {}
+        self._recovery_total: int = 0
+        self._recovery_scanned: int = 0
+        self._recovery_fallbacks: int = 0
+        self._recovery_keys_written: int = 0
+        self._recovery_started: float = 0.0
+        self._recovery_done = threading.Event()
+        self._recovery_stop = threading.Event()
+        self._recovery_thread: Optional[threading.Thread] = None
         
         # I verify that I can access the data directory
         try:
@@ -91,376 +1200,2991 @@ class SimpleKVStore:
         except OSError as e:
             raise OSError(f"Cannot access data directory: {e}") from e
         
-        # I load existing data on startup if the file exists
+        # Compression state. _dictionaries holds every dictionary on disk by
+        # number (records may refer to any of them); _compressor encodes new
+        # values with the newest one, and is None with compression off.
+        self.compression: Optional[str] = compression
+        self.compression_min_bytes: int = compression_min_bytes
+        self._dictionaries: Dict[int, bytes] = load_dictionaries(data_file)
+        self._compressor: Optional[Compressor] = None
+        if compression is not None:
+            self._compressor = Compressor(compression, compression_min_bytes,
+                                          dictionary=self._latest_dictionary())
+        
+        # I load existing data on startup if any segment exists
         # This is my crash recovery mechanism
-        if os.path.exists(self.data_file):
+        started = time.perf_counter()
+        self._recovery_started = started
+        self._recovery_seconds: float = 0.0
+        if lazy_recovery:
+            self._start_lazy_recovery()
+        else:
             self._rebuild_index()
+        if not self._recovering:
+            self._recovery_seconds = time.perf_counter() - started
+            self.metrics.observe("recovery", self._recovery_seconds)
+            self._recovery_done.set()
+        
+        # I only need the background flusher when writes are batched
+        if self.durability != DURABILITY_ALWAYS:
+            self._flusher = threading.Thread(target=self._flusher_loop,
+                                             name="kv-flusher", daemon=True)
+            self._flusher.start()
+        
+        self._expiry_thread = threading.Thread(target=self._expiry_loop,
+                                               name="kv-expiry", daemon=True)
+        self._expiry_thread.start()
+    
+    def __enter__(self) -> "SimpleKVStore":
+        return self
+    
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+    
+    def close(self) -> None:
+        """
+        Flush any queued writes, stop the flusher and close the log.
+        
+        Pending writers are still acknowledged (or failed) before I return,
+        so calling close() never drops a write that a caller is waiting on.
+        A lazy recovery still running is abandoned (the next start replays
+        the log again).
+        """
+        self._recovery_stop.set()
+        if self._recovery_thread is not None:
+            self._recovery_thread.join()
+            self._recovery_thread = None
+        self._expiry_stop.set()
+        if self._expiry_thread is not None:
+            self._expiry_thread.join()
+            self._expiry_thread = None
+        with self._commit_cond:
+            self._closing = True
+            self._commit_cond.notify_all()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        compact_thread = self._compact_thread
+        if compact_thread is not None:
+            compact_thread.join()
+        hint_thread = self._hint_thread
+        if hint_thread is not None:
+            hint_thread.join()
+        
+        # A clean shutdown leaves a snapshot that covers the whole log, so the
+        # next start doesn't have to replay anything
+        if self.use_hint and self._appended_since_hint and not self._recovering:
+            try:
+                self.write_hint()
+            except OSError as e:
+                print(f"Warning: I could not write hint file {self.hint_file}: {e}",
+                      file=sys.stderr, flush=True)
+        with self._lock:
+            if self._writer is not None:
+                try:
+                    self._writer.close()
+                except Exception as e:
+                    print(f"Warning: Error closing file: {e}",
+                          file=sys.stderr, flush=True)
+                self._writer = None
+        with self._map_lock:
+            # I don't call mmap.close() here: values handed out as memoryviews
+            # may still reference the mapping. Dropping my reference lets it
+            # unmap once the last view is released.
+            self._maps.clear()
+            for fd in self._reader_fds.values():
+                os.close(fd)
+            self._reader_fds.clear()
     
     def _rebuild_index(self) -> None:
         """
-        Rebuild in-memory index from the append-only log.
+        Rebuild in-memory index from the append-only log segments.
         
         This method is how I implement crash recovery by replaying the transaction log.
-        I read through the entire data.db file sequentially and reconstruct
-        the index in memory.
+        I scan every segment and reconstruct the index in memory.
         
-        Process:
-        1. I start at the beginning of the file
-        2. I read each entry (key_len, val_len, key, value)
-        3. I update the index with the latest offset for each key
-        4. I implement "last write wins" - newer entries overwrite older ones
+        If a valid hint file exists I load the index snapshot from it in bulk
+        and only replay the part of the log written after the snapshot.
         
-        Error Handling:
-        - I handle corrupted entries gracefully
-        - I stop at the first corrupted entry (fail-fast)
-        - I log warnings but continue operation
+        Process:
+        1. I load the hint snapshot (if any) and work out which segments,
+           or which tail of a segment, it doesn't cover
+        2. I scan each of those segments with scan_segment(). With more than
+           one segment to scan I use a process pool, one segment per worker
+        3. I merge the per-segment results in segment order, so a record in
+           a later segment always overwrites an earlier one ("last write wins")
         
-        Time Complexity: O(n) where n = entries in file
+        Time Complexity: O(n) where n = entries in the unscanned segments
         Space Complexity: O(k) where k = number of unique keys
         
         Raises:
-            IOError: If the file cannot be opened
+            IOError: If a segment cannot be opened
             OSError: If there are disk read errors
         """
-        # I clear any existing index data
-        self.index.clear()
+        tasks = self._plan_recovery()
         
-        # Safety check: I ensure the file exists before attempting to read
-        if not os.path.exists(self.data_file):
-            return
+        # Sealed segments are independent, so I scan them in parallel and
+        # only keep the merge (which must happen in order) on this process
+        paths = [(segment_path(self.data_file, segment), start) for segment, start in tasks]
+        workers = min(self.recovery_workers, len(tasks))
+        if workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_scan_segment_task, paths))
+        else:
+            results = [scan_segment(path, start) for path, start in paths]
         
-        file_handle = None
-        try:
-            # I open the file in binary read mode ('rb')
-            # Binary mode is crucial for reading my custom binary format
-            file_handle = open(self.data_file, 'rb')
-            
-            entry_count = 0
-            
-            # I continue reading until I reach the end of the file
-            while True:
-                # I get the current position in the file - this is my offset
-                # I'll store this to know where to seek when reading the value later
-                offset = file_handle.tell()
-                
-                # I read the key length (4 bytes, big-endian format)
-                # Big-endian is standard network byte order
-                key_len_bytes = file_handle.read(4)
-                
-                # EOF check: if I can't read 4 bytes, I've reached the end
-                if not key_len_bytes:
-                    break
-                
-                # Corruption check: partial reads indicate a corrupted file
-                if len(key_len_bytes) < 4:
-                    print(f"Warning: Incomplete entry at offset {offset}, I'm stopping rebuild", 
-                          file=sys.stderr, flush=True)
-                    break
-                
-                # I convert bytes to integer (big-endian format)
-                key_len = int.from_bytes(key_len_bytes, 'big')
-                
-                # Sanity check: I reject unreasonably large keys (prevents memory attacks)
-                if key_len > 65536:  # 64KB limit
-                    print(f"Warning: Suspiciously large key length {key_len} at offset {offset}", 
-                          file=sys.stderr, flush=True)
-                    break
-                
-                # I read the value length (4 bytes, big-endian)
-                val_len_bytes = file_handle.read(4)
-                if len(val_len_bytes) < 4:
-                    print(f"Warning: Incomplete value length at offset {offset}", 
-                          file=sys.stderr, flush=True)
-                    break
-                
-                val_len = int.from_bytes(val_len_bytes, 'big')
-                
-                # Sanity check: I reject unreasonably large values
-                if val_len > 1048576:  # 1MB limit
-                    print(f"Warning: Suspiciously large value length {val_len} at offset {offset}", 
-                          file=sys.stderr, flush=True)
-                    break
-                
-                # I read the actual key bytes
-                key_bytes = file_handle.read(key_len)
-                if len(key_bytes) < key_len:
-                    print(f"Warning: Incomplete key at offset {offset}", 
-                          file=sys.stderr, flush=True)
-                    break
-                
-                # I decode the key from UTF-8 bytes to string
-                try:
-                    key = key_bytes.decode('utf-8')
-                except UnicodeDecodeError as e:
-                    print(f"Warning: Invalid UTF-8 in key at offset {offset}: {e}", 
-                          file=sys.stderr, flush=True)
-                    break
-                
-                # I skip over the value - I don't need to read it during index rebuild
-                # I only need to know WHERE it is (offset) and HOW LONG it is (val_len)
-                try:
-                    file_handle.seek(val_len, 1)  # I seek relative to current position
-                except OSError as e:
-                    print(f"Warning: Cannot seek to next entry: {e}", 
-                          file=sys.stderr, flush=True)
-                    break
-                
-                # I update the index with this entry
-                # The dictionary automatically handles "last write wins" for me
-                self.index[key] = IndexEntry(offset, val_len)
-                entry_count += 1
+        index = self.index
+        if isinstance(index, CompactIndex):
+            # I size the table once for the worst case (no key repeats)
+            index.reserve(len(index) + sum(len(records) for records, _ in results))
+        now = now_ms()
+        for (segment, start), (records, valid_end) in zip(tasks, results):
+            self._segment_sizes[segment] = valid_end
+            self._apply_records(segment, records, now)
+        self._finish_recovery()
+    
+    def _plan_recovery(self) -> List[Tuple[int, int]]:
+        """
+        Reset my index, load the hint snapshot and list what is left to replay.
         
-        except IOError as e:
-            # File open/read errors - critical failure
-            print(f"Error: I cannot read data file {self.data_file}: {e}", 
-                  file=sys.stderr, flush=True)
-            raise
+        Returns:
+            (segment, start offset) of every piece of log the snapshot
+            doesn't cover, oldest first
+        """
+        # I clear any existing index data
+        self.index.clear()
+        self._expires.clear()
+        self._large.clear()
+        self._segment_tombstones = {}
+        self._valid_end = 0
+        self._live_bytes = 0
+        self._segment_sizes = {}
+        self._segment_live = {}
         
-        except OSError as e:
-            # Disk errors during reading
-            print(f"Error: Disk error while I'm reading {self.data_file}: {e}", 
-                  file=sys.stderr, flush=True)
-            raise
+        self._segments = list_segments(self.data_file)
+        if not self._segments:
+            self._segments = [0]
+            self._segment_sizes[0] = 0
+            self._segment_live[0] = 0
+            return []
         
-        except Exception as e:
-            # Unexpected errors - I log and re-raise
-            print(f"Error: Unexpected error during my index rebuild: {e}", 
-                  file=sys.stderr, flush=True)
-            raise
+        # I start from the snapshot if I have a trustworthy one
+        covered_segment, covered_end = self._load_hint() if self.use_hint else (-1, 0)
+        tasks = []
+        for segment in self._segments:
+            if segment < covered_segment:
+                continue
+            start = covered_end if segment == covered_segment else 0
+            tasks.append((segment, start))
+        return tasks
+    
+    def _finish_recovery(self) -> None:
+        """
+        Derive the log totals and the append position once every segment
+        size is known, and schedule the TTLs I found.
+        """
+        self._live_bytes = sum(self._segment_live.values())
+        self._active_segment = self._segments[-1]
+        for key, expires_at in self._expires.items():
+            self._wheel.schedule(key, expires_at)
+        self._valid_end = self._segment_sizes[self._active_segment]
+        self._sealed_bytes = sum(self._segment_sizes.values()) - self._valid_end
         
-        finally:
-            # I ensure the file is always closed, even if an error occurred
-            # This prevents file descriptor leaks
-            if file_handle is not None:
-                try:
-                    file_handle.close()
-                except Exception as e:
-                    print(f"Warning: Error closing file: {e}", 
-                          file=sys.stderr, flush=True)
+        # Sealed segments never get another write, so a torn tail there only
+        # costs the records after the tear. The active one is truncated by
+        # my writer before the next append.
+        for segment in self._segments[:-1]:
+            if os.path.getsize(segment_path(self.data_file, segment)) > self._segment_sizes[segment]:
+                print(f"Warning: Sealed segment {segment} has a torn tail at offset "
+                      f"{self._segment_sizes[segment]}", file=sys.stderr, flush=True)
     
-    def set(self, key: str, value: str) -> None:
+    def _start_lazy_recovery(self) -> None:
         """
-        Set a key-value pair. I append to the log file and update the index.
+        Get ready to serve before the log is replayed (lazy_recovery).
+        
+        I load the hint snapshot as usual, which is a bulk load and far
+        faster than a replay, and work out which pieces of log it doesn't
+        cover. If there are any, I roll over to a fresh segment (unless the
+        last one is empty) for the writes I take meanwhile, so they are
+        newer than anything the replay can find, and hand the pieces to
+        _recover_in_background.
+        """
+        pending = []
+        for segment, start in self._plan_recovery():
+            size = os.path.getsize(segment_path(self.data_file, segment))
+            self._segment_sizes[segment] = size
+            self._segment_live.setdefault(segment, 0)
+            if size > start:
+                pending.append((segment, start, size))
+        if not pending:
+            self._finish_recovery()
+            return
+        
+        # Until a segment is replayed I count all of it as sealed log bytes
+        self._live_bytes = sum(self._segment_live.values())
+        for key, expires_at in self._expires.items():
+            self._wheel.schedule(key, expires_at)
+        self._sealed_bytes = sum(self._segment_sizes.values())
+        self._active_segment = self._segments[-1]
+        self._valid_end = 0
+        if self._segment_sizes[self._active_segment]:
+            self._roll_segment()
+        
+        self._recovery_ranges = tuple(pending)
+        self._recovery_total = sum(size - start for _, start, size in pending)
+        self._recovering = True
+        self._recovery_thread = threading.Thread(target=self._recover_in_background,
+                                                 name="kv-recovery", daemon=True)
+        self._recovery_thread.start()
+    
+    def _recover_in_background(self) -> None:
+        """
+        Replay the log the hint snapshot doesn't cover, oldest piece first.
+        
+        I parse RECOVERY_PIECE_BYTES at a time without the lock and apply
+        each piece under it, minus the keys written since I started serving
+        (those records are newer than anything in the old log). If close()
+        stops me half way, I stay "recovering" so no hint is written from
+        the partial index.
+        """
+        finished = False
+        try:
+            for segment, start, size in self._recovery_ranges:
+                path = segment_path(self.data_file, segment)
+                with open(path, 'rb') as file_handle, \
+                        mmap.mmap(file_handle.fileno(), size, access=mmap.ACCESS_READ) as mapping:
+                    offset = start
+                    while offset < size:
+                        if self._recovery_stop.is_set():
+                            return
+                        end = min(size, offset + RECOVERY_PIECE_BYTES)
+                        records: Dict[str, Tuple[int, int, int, int, int]] = {}
+                        valid_end = _scan_buffer(mapping, offset, end, records, path,
+                                                 floor=start, quiet=end < size)
+                        while valid_end == offset and end < size:
+                            # A record (a big MSET or chunk) longer than the piece
+                            end = min(size, offset + 2 * (end - offset))
+                            valid_end = _scan_buffer(mapping, offset, end, records, path,
+                                                     floor=start, quiet=end < size)
+                        # Past the last piece, anything left is a torn tail
+                        done = end == size
+                        
+                        with self._lock:
+                            written = self._recovery_written
+                            if written:
+                                records = {key: record for key, record in records.items()
+                                           if key not in written}
+                            self._apply_records(segment, records, now_ms())
+                            expires = self._expires
+                            for key, record in records.items():
+                                if record[3] and expires.get(key) == record[3]:
+                                    self._wheel.schedule(key, record[3])
+                            if done:
+                                self._sealed_bytes -= size - valid_end
+                                self._segment_sizes[segment] = valid_end
+                                self._recovery_scanned += size - offset
+                                self._recovery_ranges = tuple(
+                                    piece for piece in self._recovery_ranges if piece[0] != segment)
+                            else:
+                                self._recovery_scanned += valid_end - offset
+                                self._recovery_ranges = tuple(
+                                    (segment, valid_end, size) if piece[0] == segment else piece
+                                    for piece in self._recovery_ranges)
+                        if done:
+                            break
+                        offset = valid_end
+            finished = True
+        except Exception as e:
+            print(f"Error: Background recovery of {self.data_file} failed: {e}",
+                  file=sys.stderr, flush=True)
+        finally:
+            if finished:
+                with self._lock:
+                    self._recovering = False
+                    self._recovery_keys_written = len(self._recovery_written)
+                    self._recovery_written = set()
+                    self._recovery_found = {}
+                    self._recovery_seconds = time.perf_counter() - self._recovery_started
+                    self.metrics.observe("recovery", self._recovery_seconds)
+                    self._maybe_write_hint()
+                    self._maybe_compact()
+            self._recovery_done.set()
+    
+    def _wait_recovered(self) -> None:
+        """
+        Block until lazy recovery has applied the whole log.
+        
+        Raises:
+            OSError: If recovery failed or was abandoned by close()
+        """
+        self._recovery_done.wait()
+        if self._recovering:
+            raise OSError(f"Recovery of {self.data_file} did not finish")
+    
+    def _unrecovered(self, key: str) -> Optional[Tuple[Optional[IndexEntry], int]]:
+        """
+        Look a key up in the part of the log lazy recovery hasn't replayed yet.
+        
+        Whatever is there is newer than my index entry for the key, so
+        every read of a key not written since startup asks me first. I
+        search each unreplayed range backwards from its end with
+        mmap.rfind() (newest segment first) and take the first hit that sits
+        right behind a record header for a key of that length, with a
+        plausible header (or the end of the range) right after the record.
+        This is a heuristic, but a false match needs the key bytes to appear
+        inside another value behind a header-shaped 8 bytes.
+        
+        The old log never changes, so I remember the answer per key; it
+        stays correct after the replay passes the record. Nothing I find
+        goes into the index, the replay does that.
+        
+        Returns:
+            None if the key isn't in the unreplayed log (my index is then
+            up to date for it), (None, 0) if it was deleted there or has
+            expired, else (entry, expires_at)
+        """
+        found = self._recovery_found.get(key, self._recovery_found)
+        if found is self._recovery_found:
+            found = self._search_unrecovered(key)
+            self._recovery_found[key] = found
+        if found is not None and found[1] and found[1] <= now_ms():
+            return None, 0
+        return found
+    
+    def _search_unrecovered(self, key: str) -> Optional[Tuple[Optional[IndexEntry], int]]:
+        """
+        The rfind() search behind _unrecovered.
+        """
+        self._recovery_fallbacks += 1
+        key_bytes = key.encode('utf-8')
+        key_length = len(key_bytes)
+        for segment, low, high in reversed(self._recovery_ranges):
+            mapping = self._remap(segment, high)
+            end = high
+            while True:
+                position = mapping.rfind(key_bytes, low + HEADER_SIZE, end)
+                if position < 0:
+                    break
+                end = position + key_length - 1
+                record = _record_at(mapping, position - HEADER_SIZE, key_length, high)
+                if record is None:
+                    continue
+                record_type, flags, value_start, record_end = record
+                if record_type == RECORD_DELETE:
+                    return None, 0
+                expires_at = 0
+                if flags & RECORD_FLAG_TTL:
+                    expires_at = EXPIRY.unpack_from(mapping, value_start)[0]
+                    value_start += EXPIRY.size
+                value_length = record_end - value_start
+                if record_type == RECORD_LARGE:
+                    value_length |= LARGE_VALUE
+                elif flags & RECORD_FLAG_COMPRESSED:
+                    value_length |= COMPRESSED_VALUE
+                return IndexEntry(value_start, value_length, segment), expires_at
+        return None
+    
+    def recovery_progress(self) -> Dict[str, object]:
+        """
+        How far lazy recovery got (all done after an eager start).
+        
+        Returns:
+            recovering, bytes_scanned and bytes_total of the replay, the
+            fraction done, elapsed_s and an eta_s extrapolated from the scan
+            rate so far, keys_written meanwhile and fallback_lookups (reads
+            that had to search the unreplayed log)
+        """
+        recovering = self._recovering
+        scanned = self._recovery_scanned
+        total = self._recovery_total
+        if recovering:
+            elapsed = time.perf_counter() - self._recovery_started
+            eta = (total - scanned) * elapsed / scanned if scanned else None
+        else:
+            elapsed = self._recovery_seconds
+            eta = 0.0
+        return {
+            "recovering": recovering,
+            "bytes_scanned": scanned,
+            "bytes_total": total,
+            "progress": round(scanned / total, 4) if total else 1.0,
+            "elapsed_s": round(elapsed, 3),
+            "eta_s": round(eta, 3) if eta is not None else None,
+            "keys_written": len(self._recovery_written) if recovering else self._recovery_keys_written,
+            "fallback_lookups": self._recovery_fallbacks,
+        }
+    
+    def _apply_records(self, segment: int,
+                       records: Dict[str, Tuple[int, int, int, int, int]], now: int) -> None:
+        """
+        Merge what scan_segment() found in one segment into my index.
+        
+        Pieces of the log must be applied in log order, so a later record
+        always overwrites an earlier one ("last write wins"). _rebuild_index
+        applies whole segments this way; a replica (kv_replica.py) applies
+        each piece of log it copies from its primary.
+        
+        The caller must hold self._lock (or still be constructing the store).
+        
+        Args:
+            segment: The segment the records are in
+            records: key -> (value_offset, value_length, key_length,
+                expires_at, chunks_length), as returned by scan_segment()
+            now: Current time in unix ms; records that expired by then are
+                treated as deleted
+        """
+        index = self.index
+        segment_live = self._segment_live
+        expires = self._expires
+        large = self._large
+        cache = self._cache
+        ordered = self._ordered
+        oldest = self._segments[0]
+        segment_live.setdefault(segment, 0)
+        added = removed = tombstone_bytes = 0
+        for key, (value_offset, value_length, key_len, expires_at, chunks_length) in records.items():
+            old_entry = index.get(key)
+            if old_entry is not None:
+                old_size = HEADER_SIZE + key_len + (old_entry.value_length & VALUE_LENGTH_MASK)
+                if expires.pop(key, None):
+                    old_size += EXPIRY.size
+                if old_entry.value_length & LARGE_VALUE:
+                    old_size += large.pop(key)
+                segment_live[old_entry.segment] -= old_size
+                removed += old_size
+            if value_offset == TOMBSTONE or (expires_at and expires_at <= now):
+                # Deleted, or expired while I was down
+                if old_entry is not None:
+                    del index[key]
+                    if ordered is not None:
+                        ordered.discard(key)
+                    if cache is not None:
+                        cache.invalidate(key)
+                if value_offset == TOMBSTONE and segment != oldest:
+                    # It may be hiding a record in an older segment
+                    tombstone_bytes += HEADER_SIZE + key_len
+                continue
+            record_size = HEADER_SIZE + key_len + (value_length & VALUE_LENGTH_MASK)
+            if chunks_length:
+                large[key] = chunks_length
+                record_size += chunks_length
+                value_length |= LARGE_VALUE
+            index[key] = IndexEntry(value_offset, value_length, segment)
+            if expires_at:
+                expires[key] = expires_at
+                record_size += EXPIRY.size
+            added += record_size
+            if old_entry is None:
+                if ordered is not None:
+                    ordered.add(key)
+            elif cache is not None:
+                # After the index update, so a GET can't cache the old value again
+                cache.invalidate(key)
+        if tombstone_bytes:
+            self._segment_tombstones[segment] = (
+                self._segment_tombstones.get(segment, 0) + tombstone_bytes)
+            added += tombstone_bytes
+        segment_live[segment] += added
+        self._live_bytes += added - removed
+    
+    def _load_hint(self) -> Tuple[int, int]:
+        """
+        Load the index snapshot from the hint file.
+        
+        I reject the snapshot (and fall back to a full replay) if:
+        - the file is missing, torn (short read) or has a bad body CRC
+        - it was written by a different format version
+        - a segment it describes is missing, or an older segment exists
+          that it doesn't know about
+        - a sealed segment changed size, or the active segment is now
+          shorter than the position the snapshot covers
+        - the bytes just before the recorded sizes don't match the CRCs in
+          the snapshot (a segment was replaced or rewritten)
+        
+        On success I also fill in the segment sizes and live byte counts
+        for every segment the snapshot covers.
+        
+        Returns:
+            (covered_segment, covered_end): the log position the loaded
+            snapshot covers, or (-1, 0) if none was loaded
+        """
+        try:
+            with open(self.hint_file, 'rb') as hint_handle:
+                data = hint_handle.read()
+        except FileNotFoundError:
+            return -1, 0
+        except OSError as e:
+            print(f"Warning: I cannot read hint file {self.hint_file}: {e}",
+                  file=sys.stderr, flush=True)
+            return -1, 0
+        
+        reason = None
+        segments_start = HINT_HEADER.size
+        if len(data) < HINT_HEADER.size:
+            reason = "torn header"
+        else:
+            (magic, version, covered_segment, covered_end,
+             segment_count, entry_count, body_crc) = HINT_HEADER.unpack_from(data, 0)
+            if magic != HINT_MAGIC or version != HINT_VERSION:
+                reason = "unknown format"
+            elif zlib.crc32(memoryview(data)[HINT_HEADER.size:]) != body_crc:
+                reason = "body checksum mismatch"
+            else:
+                reason = self._check_hint_segments(data, segments_start, segment_count,
+                                                   covered_segment)
+        
+        if reason is not None:
+            print(f"Warning: I'm ignoring hint file {self.hint_file} ({reason}), "
+                  f"doing a full replay", file=sys.stderr, flush=True)
+            return -1, 0
+        
+        # The snapshot checks out, so I parse the body in bulk
+        index = self.index
+        if isinstance(index, CompactIndex):
+            index.reserve(entry_count)
+        segment_live = self._segment_live
+        entries_start = segments_start + segment_count * HINT_SEGMENT.size
+        keys_start = entries_start + entry_count * HINT_ENTRY.size
+        try:
+            for segment, size, _ in HINT_SEGMENT.iter_unpack(data[segments_start:entries_start]):
+                self._segment_sizes[segment] = size
+                segment_live[segment] = 0
+            
+            fixed = memoryview(data)[entries_start:keys_start]
+            key_blob = data[keys_start:]
+            keys_text = key_blob.decode('utf-8')
+            
+            # With pure ASCII keys (the usual case) byte offsets and string
+            # offsets are the same, so I can slice the decoded text directly
+            ascii_keys = len(keys_text) == len(key_blob)
+            pos = 0
+            expires = self._expires
+            now = now_ms()
+            large = self._large
+            for (key_len, segment, value_offset, value_length, expires_at,
+                 chunks_length) in HINT_ENTRY.iter_unpack(fixed):
+                if ascii_keys:
+                    key = keys_text[pos:pos + key_len]
+                else:
+                    key = key_blob[pos:pos + key_len].decode('utf-8')
+                pos += key_len
+                record_size = HEADER_SIZE + key_len + (value_length & VALUE_LENGTH_MASK)
+                if expires_at:
+                    if expires_at <= now:
+                        continue  # expired while I was down
+                    expires[key] = expires_at
+                    record_size += EXPIRY.size
+                if chunks_length:
+                    large[key] = chunks_length
+                    record_size += chunks_length
+                index[key] = IndexEntry(value_offset, value_length, segment)
+                segment_live[segment] += record_size
+            if pos != len(key_blob):
+                raise ValueError("key data does not match the entry table")
+        except (struct.error, ValueError, KeyError) as e:
+            print(f"Warning: I'm ignoring hint file {self.hint_file} ({e}), "
+                  f"doing a full replay", file=sys.stderr, flush=True)
+            index.clear()
+            self._expires.clear()
+            self._large.clear()
+            self._segment_sizes.clear()
+            segment_live.clear()
+            return -1, 0
+        return covered_segment, covered_end
+    
+    def _check_hint_segments(self, data: bytes, start: int, count: int,
+                             covered_segment: int) -> Optional[str]:
+        """
+        Compare the segment table of a hint file with the segments on disk.
+        
+        Returns:
+            None if the snapshot still matches, otherwise the reason it doesn't
+        """
+        table = {}
+        try:
+            for segment, size, tail_crc in HINT_SEGMENT.iter_unpack(
+                    data[start:start + count * HINT_SEGMENT.size]):
+                table[segment] = (size, tail_crc)
+        except struct.error:
+            return "torn segment table"
+        
+        for segment in self._segments:
+            if segment <= covered_segment and segment not in table:
+                return f"segment {segment} is not in the snapshot"
+        for segment, (size, tail_crc) in table.items():
+            path = segment_path(self.data_file, segment)
+            if not os.path.exists(path):
+                return f"segment {segment} is missing"
+            actual = os.path.getsize(path)
+            if actual < size or (segment != covered_segment and actual != size):
+                return f"segment {segment} changed size"
+            if self._log_tail_crc(segment, size) != tail_crc:
+                return f"segment {segment} does not match the snapshot"
+        return None
+    
+    def _log_tail_crc(self, segment: int, end: int, data_file: Optional[str] = None) -> int:
+        """
+        CRC32 of the (up to) HINT_TAIL_BYTES segment bytes that end at `end`.
+        
+        data_file defaults to my own log; a replica passes its primary's.
+        """
+        start = max(0, end - HINT_TAIL_BYTES)
+        with open(segment_path(data_file or self.data_file, segment), 'rb') as file_handle:
+            file_handle.seek(start)
+            return zlib.crc32(file_handle.read(end - start))
+    
+    def write_hint(self) -> None:
+        """
+        Write an index snapshot that covers everything durable so far.
+        
+        I copy the index under the write lock so the snapshot and its
+        covered position are consistent, then write the file without holding
+        the lock. The snapshot goes to a temp file that I fsync and rename over
+        the old one, so a crash mid-write never leaves a torn hint in place.
+        
+        Raises:
+            OSError: If the snapshot cannot be written, or lazy recovery
+                didn't finish (the index is incomplete)
+        """
+        self._wait_recovered()
+        with self._lock:
+            covered_segment = self._active_segment
+            covered_end = self._valid_end
+            sizes = dict(self._segment_sizes)
+            sizes[covered_segment] = covered_end
+            items = list(self.index.items())
+            expires = dict(self._expires)
+            large = dict(self._large)
+            layout_version = self._layout_version
+            appended = self._appended_since_hint
+        
+        segment_rows = [HINT_SEGMENT.pack(segment, size, self._log_tail_crc(segment, size))
+                        for segment, size in sorted(sizes.items())]
+        fixed = []
+        keys = []
+        pack_entry = HINT_ENTRY.pack
+        for key, entry in items:
+            key_bytes = key.encode('utf-8')
+            fixed.append(pack_entry(len(key_bytes), entry.segment,
+                                    entry.value_offset, entry.value_length,
+                                    expires.get(key, 0), large.get(key, 0)))
+            keys.append(key_bytes)
+        body = b''.join(segment_rows) + b''.join(fixed) + b''.join(keys)
+        header = HINT_HEADER.pack(HINT_MAGIC, HINT_VERSION, covered_segment, covered_end,
+                                  len(segment_rows), len(items), zlib.crc32(body))
+        
+        temp_file = self.hint_file + ".tmp"
+        with open(temp_file, 'wb') as hint_handle:
+            hint_handle.write(header)
+            hint_handle.write(body)
+            hint_handle.flush()
+            os.fsync(hint_handle.fileno())
+        
+        with self._lock:
+            # If a compaction swapped segments while I was writing, my snapshot
+            # already describes files that are gone, so I throw it away
+            if self._layout_version != layout_version:
+                os.remove(temp_file)
+                return
+            os.replace(temp_file, self.hint_file)
+            self._appended_since_hint -= appended
+    
+    def _maybe_write_hint(self) -> None:
+        """
+        Start a background snapshot once enough new log data has accumulated.
+        
+        The caller must hold self._lock.
+        """
+        if (not self.use_hint
+                or self._recovering
+                or self._appended_since_hint < self.hint_interval_bytes
+                or (self._hint_thread is not None and self._hint_thread.is_alive())):
+            return
+        self._hint_thread = threading.Thread(target=self._hint_worker,
+                                             name="kv-hint", daemon=True)
+        self._hint_thread.start()
+    
+    def _hint_worker(self) -> None:
+        try:
+            self.write_hint()
+        except OSError as e:
+            print(f"Warning: I could not write hint file {self.hint_file}: {e}",
+                  file=sys.stderr, flush=True)
+    
+    @instrumented("set")
+    def set(self, key: str, value: str, ttl_ms: Optional[int] = None) -> None:
+        """
+        Set a key-value pair. I append to the log file and update the index.
         
         This operation demonstrates ACID properties:
         - Atomicity: Each write is a complete entry
         - Consistency: I keep the index in sync with the file
-        - Isolation: Single-threaded, so I have no concurrency issues
+        - Isolation: Appends and index updates happen under one lock
         - Durability: I use fsync() to ensure data reaches disk
         
-        Process:
-        1. I validate the inputs
-        2. I encode key and value to bytes (UTF-8)
-        3. I get the current file size (this becomes my offset)
-        4. I write: [key_length][value_length][key][value]
-        5. I call fsync() to force write to physical disk
-        6. I update the in-memory index
+        Process:
+        1. I validate the inputs
+        2. I encode key and value into one record:
+           [key_length][value_length][key][value]
+        3. "always" mode: I write and fsync the record myself
+           "group"/"periodic" mode: I queue the record and wait for the
+           flusher to write it with other records under a single fsync
+        4. I update the in-memory index only after the fsync succeeded
+        
+        A value longer than MAX_VALUE_LENGTH once encoded (MAX_TTL_VALUE_LENGTH
+        with a TTL) doesn't fit in one record, so I hand it to the chunked
+        large-value path (set_stream).
+        
+        Args:
+            key: The key to set (string, must not be empty)
+            value: The value to associate with the key (string)
+            ttl_ms: Delete the key this many milliseconds from now (None:
+                keep it until it is overwritten or deleted)
+            
+        Raises:
+            ValueError: If key is empty or invalid, or ttl_ms isn't positive
+            IOError: If write operation fails
+            OSError: If disk write fails
+        """
+        expires_at = 0
+        if ttl_ms is not None:
+            if ttl_ms <= 0:
+                raise ValueError("TTL must be positive")
+            expires_at = now_ms() + int(ttl_ms)
+        limit = MAX_TTL_VALUE_LENGTH if expires_at else MAX_VALUE_LENGTH
+        if isinstance(value, str) and len(value) > limit // 4:
+            # Up to 4 bytes per character, so it may be too long encoded
+            value_bytes = value.encode('utf-8')
+            if len(value_bytes) > limit:
+                self._set_large(key, io.BytesIO(value_bytes), expires_at)
+                return
+        record = self._encode_put(key, value, expires_at)
+        try:
+            self._commit(_PendingWrite(record[0], [record[1]]))
+        
+        except IOError as e:
+            # File write errors - critical failure
+            raise IOError(f"I failed to write to {self.data_file}: {e}") from e
+        
+        except OSError as e:
+            # Disk errors during writing or fsync
+            raise OSError(f"Disk error while I'm writing to {self.data_file}: {e}") from e
+        
+        except Exception as e:
+            # Unexpected errors
+            raise RuntimeError(f"Unexpected error in my set operation: {e}") from e
+    
+    @instrumented("set_stream")
+    def set_stream(self, key: str, fileobj, ttl_ms: Optional[int] = None,
+                   chunk_size: int = LARGE_CHUNK_SIZE) -> int:
+        """
+        Store a value of any size from a binary file object, without ever
+        holding more than one chunk of it in memory.
+        
+        I read the stream chunk_size bytes at a time into one reusable
+        buffer and append each piece as a RECORD_CHUNK record. At EOF I
+        write the RECORD_LARGE manifest and fsync once; only then does the
+        key point at the new value. A crash or a read error before that
+        leaves orphan chunks, which recovery skips and compaction drops.
+        
+        The whole value is written under the write lock, which keeps its
+        chunks right in front of the manifest. Other writers wait meanwhile,
+        so pass a local file or buffer rather than a slow network stream.
+        
+        Args:
+            key: The key to set (string, must not be empty)
+            fileobj: Binary file object, read until EOF
+            ttl_ms: Delete the key this many milliseconds from now
+            chunk_size: Data bytes per chunk record (at most LARGE_CHUNK_SIZE)
+            
+        Returns:
+            The length of the stored value in bytes
+            
+        Raises:
+            ValueError: If key, ttl_ms or chunk_size is invalid
+            OSError: If reading the stream or writing the log fails
+        """
+        expires_at = 0
+        if ttl_ms is not None:
+            if ttl_ms <= 0:
+                raise ValueError("TTL must be positive")
+            expires_at = now_ms() + int(ttl_ms)
+        return self._set_large(key, fileobj, expires_at, chunk_size)
+    
+    def _set_large(self, key: str, fileobj, expires_at: int = 0,
+                   chunk_size: int = LARGE_CHUNK_SIZE) -> int:
+        """
+        Write a value as chunk records plus a manifest. See set_stream().
+        
+        Args:
+            expires_at: Expiry time in unix ms, or 0 for none
+        """
+        if not key or not isinstance(key, str):
+            raise ValueError("Key cannot be empty")
+        key_bytes = key.encode('utf-8')
+        if len(key_bytes) > MAX_KEY_LENGTH:
+            raise ValueError(f"Key is longer than {MAX_KEY_LENGTH} bytes")
+        if not 0 < chunk_size <= LARGE_CHUNK_SIZE:
+            raise ValueError(f"Chunk size must be between 1 and {LARGE_CHUNK_SIZE}")
+        
+        view = memoryview(bytearray(chunk_size))
+        chunk_header = RECORD_CHUNK << RECORD_TYPE_SHIFT
+        pack_header = RECORD_HEADER.pack
+        with self._lock:
+            if self._closing:
+                raise OSError("Store is closed")
+            writer = self._open_writer()
+            start = self._valid_end
+            length = 0
+            crc = 0
+            try:
+                while True:
+                    count = _read_full(fileobj, view)
+                    if not count:
+                        break
+                    writer.write(pack_header(chunk_header, count))
+                    writer.write(view[:count])
+                    crc = zlib.crc32(view[:count], crc)
+                    length += count
+                    if count < chunk_size:
+                        break
+                chunks_length = -(-length // chunk_size) * HEADER_SIZE + length
+                
+                flags = RECORD_FLAG_TTL if expires_at else 0
+                prefix = EXPIRY.pack(expires_at) if expires_at else b''
+                value_start = HEADER_SIZE + len(key_bytes) + len(prefix)
+                manifest = b''.join((
+                    pack_header(len(key_bytes) | ((RECORD_LARGE | flags) << RECORD_TYPE_SHIFT),
+                                len(prefix) + LARGE_INFO.size),
+                    key_bytes, prefix,
+                    LARGE_INFO.pack(length, chunks_length + value_start, chunk_size, crc)))
+                
+                # _write_batch appends the manifest behind the chunks and
+                # makes all of it durable with its one fsync
+                self._valid_end = start + chunks_length
+                self._write_batch([_PendingWrite(manifest, [(key, len(key_bytes), len(manifest),
+                                                             LARGE_INFO.size, None, expires_at,
+                                                             chunks_length)])])
+            except BaseException:
+                self._valid_end = start
+                try:
+                    writer.flush()
+                    writer.truncate(start)
+                    writer.seek(start)
+                except (OSError, ValueError):
+                    pass
+                raise
+            self._appended_since_hint += chunks_length
+            self.metrics.add("bytes_appended", chunks_length)
+            self.metrics.add("large_values_written")
+        return length
+    
+    @instrumented("mset")
+    def mset(self, items) -> None:
+        """
+        Set many key-value pairs with one write and one fsync.
+        
+        The batch is atomic on recovery: I write a RECORD_BATCH header with
+        the number of records, their total length and a CRC32, followed by
+        the records themselves. _rebuild_index applies either the whole
+        batch or, if a crash tore it, none of it.
+        
+        Args:
+            items: A dict or an iterable of (key, value) pairs. If a key
+                repeats, the last value wins, as with consecutive SETs.
+            
+        Raises:
+            ValueError: If any key or value is invalid (nothing is written)
+            IOError: If write operation fails
+            OSError: If disk write fails
+        """
+        if isinstance(items, dict):
+            items = items.items()
+        
+        # I encode everything up front so a bad pair rejects the whole batch
+        chunks = []
+        for key, value in items:
+            chunks.append(self._encode_put(key, value))
+        if not chunks:
+            return
+        try:
+            self._commit(self._batch(chunks))
+        
+        except IOError as e:
+            # File write errors - critical failure
+            raise IOError(f"I failed to write to {self.data_file}: {e}") from e
+        
+        except Exception as e:
+            # Unexpected errors
+            raise RuntimeError(f"Unexpected error in my mset operation: {e}") from e
+    
+    @instrumented("delete")
+    def delete(self, *keys: str) -> int:
+        """
+        Delete keys by appending a tombstone record for each one.
+        
+        Deleting several keys is atomic on recovery, like MSET. The index
+        entries (and cached values) go away as soon as the tombstones are
+        durable; compaction reclaims the disk space later.
+        
+        Args:
+            keys: The keys to delete
+            
+        Returns:
+            How many of the keys existed
+            
+        Raises:
+            ValueError: If a key is empty
+            IOError: If write operation fails
+        """
+        for key in keys:
+            if not key:
+                raise ValueError("Key cannot be empty")
+        existing = [key for key in dict.fromkeys(keys) if self._alive(key)]
+        if not existing:
+            return 0
+        try:
+            self._commit(self._batch([self._encode_delete(key) for key in existing]))
+        except IOError as e:
+            raise IOError(f"I failed to write to {self.data_file}: {e}") from e
+        return len(existing)
+    
+    def ttl(self, key: str) -> int:
+        """
+        Remaining time to live of a key, like Redis PTTL.
+        
+        Returns:
+            Milliseconds until the key expires, -1 if it has no TTL, or -2
+            if it doesn't exist
+        """
+        if self._recovering and key not in self._recovery_written:
+            found = self._unrecovered(key)
+            if found is not None:
+                entry, expires_at = found
+                if entry is None:
+                    return -2
+                return max(0, expires_at - now_ms()) if expires_at else -1
+        if not self._alive(key):
+            return -2
+        expires_at = self._expires.get(key)
+        if expires_at is None:
+            return -1
+        return max(0, expires_at - now_ms())
+    
+    def import_records(self, records: Iterable[Tuple[str, Optional[str], int]],
+                       buffer_bytes: int = 4 * 1024 * 1024) -> int:
+        """
+        Bulk-load records far faster than one set() per record.
+        
+        I encode records into ~buffer_bytes buffers, append each buffer with
+        one write and publish its records in the index right away, and
+        fsync once at the end (and when a segment fills up). There is no
+        per-record fsync, lock round trip or response.
+        
+        Values too long for one record are stored chunked, as by
+        set_stream() (with an fsync each).
+        
+        Unlike set(), imported records become visible before they are
+        durable, and a crash part way through keeps only a prefix of the
+        import (recovery stops at the first torn record, as always). An
+        import is meant for seeding a store, so simply run it again.
+        
+        Args:
+            records: (key, value, expires_at) tuples as produced by
+                kv_bulk.read_records(): value None deletes the key,
+                expires_at is unix ms (0: no TTL). Expired records are skipped.
+            buffer_bytes: How much I encode before each write
+            
+        Returns:
+            How many records I applied
+            
+        Raises:
+            ValueError: If a key or value is invalid (records before it are kept)
+            IOError: If writing fails
+        """
+        count = 0
+        now = now_ms()
+        encode_put = self._encode_put
+        encode_delete = self._encode_delete
+        pack_header = RECORD_HEADER.pack
+        # With compression on every SET goes through _encode_put
+        inline = self._compressor is None
+        try:
+            chunks: List[bytes] = []
+            entries = []
+            position = 0
+            for key, value, expires_at in records:
+                large = None
+                if inline and value is not None and not expires_at and key and type(key) is str \
+                        and type(value) is str:
+                    # Plain SET, encoded inline: this loop is the whole import
+                    key_bytes = key.encode('utf-8')
+                    value_bytes = value.encode('utf-8')
+                    key_length = len(key_bytes)
+                    value_length = len(value_bytes)
+                    if key_length > MAX_KEY_LENGTH:
+                        raise ValueError(f"Key is longer than {MAX_KEY_LENGTH} bytes")
+                    if value_length <= MAX_VALUE_LENGTH:
+                        chunks.append(pack_header(key_length, value_length))
+                        chunks.append(key_bytes)
+                        chunks.append(value_bytes)
+                        position += HEADER_SIZE + key_length + value_length
+                        # I don't fill the value cache with bulk data (None invalidates)
+                        entries.append((key, key_length, position, value_length, None, 0, 0))
+                    else:
+                        large = value_bytes
+                else:
+                    if value is None:
+                        if not key:
+                            raise ValueError("Key cannot be empty")
+                        record, entry = encode_delete(key)
+                    elif expires_at and expires_at <= now:
+                        continue
+                    elif (isinstance(value, str) and len(value) > MAX_TTL_VALUE_LENGTH // 4
+                          and len(value.encode('utf-8')) > (MAX_TTL_VALUE_LENGTH if expires_at
+                                                            else MAX_VALUE_LENGTH)):
+                        large = value.encode('utf-8')
+                    else:
+                        record, entry = encode_put(key, value, expires_at)
+                    if large is None:
+                        chunks.append(record)
+                        entries.append((key, entry[1], position + entry[2], entry[3], None, entry[5], 0))
+                        position += len(record)
+                count += 1
+                if large is not None:
+                    # Too long for one record: it goes in chunked, after
+                    # everything buffered so far
+                    if entries:
+                        with self._lock:
+                            self._write_batch([_PendingWrite(b''.join(chunks), entries)], sync=False)
+                        chunks, entries, position = [], [], 0
+                    self._set_large(key, io.BytesIO(large), expires_at)
+                elif position >= buffer_bytes:
+                    with self._lock:
+                        self._write_batch([_PendingWrite(b''.join(chunks), entries)], sync=False)
+                    chunks, entries, position = [], [], 0
+            if entries:
+                with self._lock:
+                    self._write_batch([_PendingWrite(b''.join(chunks), entries)], sync=False)
+        finally:
+            with self._lock:
+                writer = self._open_writer()
+                writer.flush()
+                fsync_started = time.perf_counter()
+                os.fsync(writer.fileno())
+                self.metrics.observe("fsync", time.perf_counter() - fsync_started)
+        self.metrics.add("records_imported", count)
+        return count
+    
+    def export_records(self, page_size: int = 1024) -> Iterator[Tuple[str, str, int]]:
+        """
+        Stream every live key with its value and expiry time.
+        
+        I take a snapshot of the keys sorted by (segment, offset) and read
+        the values a page at a time in that order with _read_values(), so
+        the log is read sequentially in large blocks and only one page of
+        values is in memory. Keys deleted or expired while I iterate are
+        skipped; keys written meanwhile may or may not be included.
+        
+        Args:
+            page_size: Values read per step
+            
+        Yields:
+            (key, value, expires_at) with expires_at 0 for keys without a TTL
+        """
+        self._wait_recovered()
+        with self._lock:
+            located = sorted((entry.segment, entry.value_offset, key)
+                             for key, entry in self.index.items())
+        keys = [key for _, _, key in located]
+        del located
+        expires = self._expires
+        for first in range(0, len(keys), page_size):
+            page = keys[first:first + page_size]
+            for key, value in zip(page, self._read_values(page)):
+                if value is not None:
+                    yield key, value, expires.get(key, 0)
+    
+    def _read_values(self, keys: List[str], block_bytes: int = 8 * 1024 * 1024) -> List[Optional[str]]:
+        """
+        Read many values with as few reads as possible, bypassing the cache.
+        
+        I sort the keys by file position and fetch each run of nearby values
+        in one read of up to block_bytes, then slice the values out of it.
+        Like get_bytes(), I redo the whole page if a compaction swapped
+        files while I was reading.
+        
+        Returns:
+            One value (or None for missing and expired keys) per key
+        """
+        while True:
+            version = self._layout_version
+            if version & 1:
+                with self._lock:
+                    continue
+            
+            index = self.index
+            expired = self._expired if self._expires else None
+            located = []
+            large = []
+            for position, key in enumerate(keys):
+                entry = index.get(key)
+                if entry is not None and not (expired and expired(key)):
+                    if entry.value_length & LARGE_VALUE:
+                        large.append((position, entry))
+                    else:
+                        located.append((entry.segment, entry.value_offset,
+                                        entry.value_length & VALUE_LENGTH_MASK, position,
+                                        entry.value_length & COMPRESSED_VALUE))
+            located.sort()
+            
+            values: List[Optional[str]] = [None] * len(keys)
+            try:
+                first = 0
+                while first < len(located):
+                    segment, start, length, _, _ = located[first]
+                    end = start + length
+                    last = first + 1
+                    while (last < len(located) and located[last][0] == segment
+                           and located[last][1] + located[last][2] - start <= block_bytes):
+                        end = max(end, located[last][1] + located[last][2])
+                        last += 1
+                    block = self._read_value(IndexEntry(start, end - start, segment))
+                    for _, offset, length, position, compressed in located[first:last]:
+                        value = block[offset - start:offset - start + length]
+                        if compressed:
+                            value = self._decompress(value)
+                        values[position] = str(value, 'utf-8')
+                    first = last
+                for position, entry in large:
+                    values[position] = str(self._read_large(entry), 'utf-8')
+            except OSError:
+                if self._layout_version != version:
+                    continue
+                raise
+            if self._layout_version == version:
+                return values
+    
+    def _alive(self, key: str) -> bool:
+        """
+        True if the key is in the index and its TTL (if any) hasn't run out.
+        """
+        if self._recovering:
+            return self._live_entry(key) is not None
+        return key in self.index and not self._expired(key)
+    
+    def _live_entry(self, key: str) -> Optional[IndexEntry]:
+        """
+        The index entry of a key, or None if it doesn't exist or has expired.
+        
+        While lazy recovery runs, the newest record of a key not written
+        since startup may still be in the unreplayed log, so I ask
+        _unrecovered() before my index.
+        """
+        if self._recovering and key not in self._recovery_written:
+            found = self._unrecovered(key)
+            if found is not None:
+                return found[0]
+        entry = self.index.get(key)
+        if entry is None or (self._expires and self._expired(key)):
+            return None
+        return entry
+    
+    def _expired(self, key: str) -> bool:
+        """
+        True if the key has a TTL that has run out.
+        """
+        expires_at = self._expires.get(key)
+        return expires_at is not None and expires_at <= now_ms()
+    
+    def _expiry_loop(self) -> None:
+        """
+        Delete expired keys every expiry_interval seconds until close().
+        """
+        while not self._expiry_stop.wait(self.expiry_interval):
+            try:
+                self._expire_due()
+            except Exception as e:
+                # I try again on the next tick; GET already hides these keys
+                print(f"Warning: I couldn't delete expired keys: {e}",
+                      file=sys.stderr, flush=True)
+    
+    def _expire_due(self) -> int:
+        """
+        Write tombstones for every key whose TTL has run out.
+        
+        The timing wheel hands me exactly the entries that came due, so this
+        costs O(expired keys), not O(keys). An entry is stale if the key was
+        deleted or got a new expiry since it was scheduled; I skip those.
+        
+        Returns:
+            How many keys I deleted
+        """
+        with self._lock:
+            if self._closing:
+                return 0
+            expires = self._expires
+            due = [key for key, deadline in self._wheel.advance(now_ms())
+                   if expires.get(key) == deadline]
+            if self._recovering:
+                # A newer record not replayed yet replaces the TTL; the
+                # replay reschedules it
+                written = self._recovery_written
+                due = [key for key in due
+                       if key in written or self._unrecovered(key) is None]
+            if not due:
+                return 0
+            # I hold the write lock already, so I write the batch directly
+            # instead of queueing it for the flusher
+            due = list(dict.fromkeys(due))
+            try:
+                self._write_batch([self._batch([self._encode_delete(key) for key in due])])
+            except OSError:
+                for key in due:
+                    self._wheel.schedule(key, expires[key])
+                raise
+        self.metrics.add("expired_keys", len(due))
+        return len(due)
+    
+    def _batch(self, chunks: List[Tuple[bytes, Tuple]]) -> _PendingWrite:
+        """
+        Wrap encoded records into one pending write.
+        
+        A single record is written as is. Several get a RECORD_BATCH header
+        in front, so recovery applies all of them or none.
+        
+        Args:
+            chunks: (record bytes, record tuple) pairs from _encode_put or
+                _encode_delete
+        """
+        if len(chunks) == 1:
+            record, entry = chunks[0]
+            return _PendingWrite(record, [entry])
+        records = []
+        position = HEADER_SIZE + BATCH_INFO.size
+        for record, (key, key_length, value_end, value_length, value, expires_at, chunks_length) in chunks:
+            records.append((key, key_length, position + value_end, value_length, value,
+                            expires_at, chunks_length))
+            position += len(record)
+        body = b''.join(record for record, _ in chunks)
+        header = RECORD_HEADER.pack(RECORD_BATCH << RECORD_TYPE_SHIFT, BATCH_INFO.size)
+        info = BATCH_INFO.pack(len(records), len(body), zlib.crc32(body))
+        return _PendingWrite(header + info + body, records)
+    
+    def _encode_put(self, key: str, value: str, expires_at: int = 0) -> Tuple[bytes, Tuple]:
+        """
+        Validate and encode one SET record.
+        
+        Args:
+            key: The key
+            value: The value
+            expires_at: Expiry time in unix ms, or 0 for none
+        
+        Returns:
+            (record bytes, (key, key_length, value_end, value_length, value,
+            expires_at, 0)) as used by _PendingWrite, with value_end relative
+            to the record
+            
+        Raises:
+            ValueError: If key is empty or invalid
+        """
+        # I validate the input
+        if not key:
+            raise ValueError("Key cannot be empty")
+        
+        if not isinstance(key, str) or not isinstance(value, str):
+            raise ValueError("Key and value must be strings")
+        
+        # I convert strings to bytes using UTF-8 encoding
+        # UTF-8 is a variable-length encoding that handles all Unicode characters
+        key_bytes = key.encode('utf-8')
+        value_bytes = value.encode('utf-8')
+        
+        if len(key_bytes) > MAX_KEY_LENGTH:
+            raise ValueError(f"Key is longer than {MAX_KEY_LENGTH} bytes")
+        
+        # Recovery would take a longer value for corruption
+        limit = MAX_TTL_VALUE_LENGTH if expires_at else MAX_VALUE_LENGTH
+        if len(value_bytes) > limit:
+            raise ValueError(f"Value is longer than {limit} bytes; use set() or set_stream()")
+        
+        # I build the entry in my binary format as a single buffer:
+        # [4 bytes: key length][4 bytes: value length][key bytes][value bytes]
+        # With a TTL the value is prefixed with the 8-byte expiry time.
+        # A compressed value is stored in its compressed form; the index
+        # entry keeps that length with COMPRESSED_VALUE set.
+        flags = 0
+        value_length = len(value_bytes)
+        compressor = self._compressor
+        if compressor is not None:
+            stored = compressor.compress(value_bytes)
+            if stored is not None:
+                self.metrics.add("values_compressed")
+                self.metrics.add("compression_saved_bytes", len(value_bytes) - len(stored))
+                value_bytes = stored
+                flags = RECORD_FLAG_COMPRESSED
+                value_length = len(stored) | COMPRESSED_VALUE
+        if expires_at:
+            record = b''.join((RECORD_HEADER.pack(
+                                   len(key_bytes) | ((flags | RECORD_FLAG_TTL) << RECORD_TYPE_SHIFT),
+                                   len(value_bytes) + EXPIRY.size),
+                               key_bytes, EXPIRY.pack(expires_at), value_bytes))
+        else:
+            record = b''.join((RECORD_HEADER.pack(len(key_bytes) | (flags << RECORD_TYPE_SHIFT),
+                                                  len(value_bytes)),
+                               key_bytes, value_bytes))
+        return record, (key, len(key_bytes), len(record), value_length, value, expires_at, 0)
+    
+    def _encode_delete(self, key: str) -> Tuple[bytes, Tuple]:
+        """
+        Encode one tombstone record: [key_length | DELETE type][0][key].
+        """
+        key_bytes = key.encode('utf-8')
+        record = RECORD_HEADER.pack(len(key_bytes) | (RECORD_DELETE << RECORD_TYPE_SHIFT), 0) + key_bytes
+        return record, (key, len(key_bytes), len(record), TOMBSTONE, None, 0, 0)
+    
+    def _commit(self, pending: _PendingWrite) -> None:
+        """
+        Make one encoded write durable according to my durability mode.
+        
+        Raises:
+            OSError: If the write or fsync fails
+        """
+        if self.durability == DURABILITY_ALWAYS:
+            # One write, one fsync - the original behavior
+            with self._lock:
+                self._write_batch([pending])
+        else:
+            self._submit(pending)
+    
+    def _open_writer(self):
+        """
+        Open the append handle once and keep it for the life of the store.
+        
+        If recovery stopped before the end of the log, new records would
+        land behind the bytes it couldn't parse and my next _rebuild_index
+        would stop before reaching them, so I cut the log back first. A
+        record torn by a crash is simply dropped. Anything else (a damaged
+        record, maybe with good ones behind it) I move aside to a .corrupt
+        file before cutting, so no byte of it is lost.
+        
+        Returns:
+            The binary append file handle
+            
+        Raises:
+            OSError: If the tail can't be moved aside
+        """
+        if self._writer is None:
+            path = segment_path(self.data_file, self._active_segment)
+            writer = open(path, 'ab')
+            size = writer.tell()
+            if size > self._valid_end:
+                try:
+                    if _is_torn_tail(path, self._valid_end, size):
+                        print(f"Warning: I'm truncating a torn tail at offset {self._valid_end} "
+                              f"in {path}", file=sys.stderr, flush=True)
+                    else:
+                        corrupt_path = self._save_corrupt_tail(path, self._valid_end)
+                        print(f"ERROR: {path} has {size - self._valid_end} bytes I can't read "
+                              f"from offset {self._valid_end} on, and they are not a record torn "
+                              f"by a crash. Records in them are NOT loaded. I moved them to "
+                              f"{corrupt_path} and continue the log at offset {self._valid_end}.",
+                              file=sys.stderr, flush=True)
+                    writer.truncate(self._valid_end)
+                    writer.seek(self._valid_end)
+                except BaseException:
+                    writer.close()
+                    raise
+            self._writer = writer
+        return self._writer
+    
+    @staticmethod
+    def _save_corrupt_tail(path: str, start: int) -> str:
+        """
+        Copy the bytes of a log file from `start` on to a new
+        <path>.corrupt[.N] file and fsync it.
+        
+        Returns:
+            The new file's path
+        """
+        corrupt_path = path + ".corrupt"
+        number = 0
+        while os.path.exists(corrupt_path):
+            number += 1
+            corrupt_path = f"{path}.corrupt.{number}"
+        with open(path, 'rb') as source, open(corrupt_path, 'xb') as out:
+            source.seek(start)
+            while True:
+                block = source.read(LARGE_CHUNK_SIZE)
+                if not block:
+                    break
+                out.write(block)
+            out.flush()
+            os.fsync(out.fileno())
+        return corrupt_path
+    
+    def _write_batch(self, batch: List[_PendingWrite], sync: bool = True) -> None:
+        """
+        Append a batch of encoded records with one write and one fsync.
+        
+        The caller must hold self._lock. I only update the index after the
+        fsync, so a GET can never see a record that is not yet durable. If
+        the write fails halfway I cut the file back to where the batch
+        started, so a partial record never sits in front of later writes.
+        
+        Args:
+            batch: The pending records to make durable
+            sync: False skips the fsync (import_records() does one at the
+                end); I still fsync a segment before sealing it
+            
+        Raises:
+            OSError: If the write or fsync fails
+        """
+        writer = self._open_writer()
+        start = self._valid_end
+        try:
+            writer.write(b''.join(p.payload for p in batch))
+            
+            # flush() writes from Python buffer to OS buffer
+            writer.flush()
+            
+            # fsync() forces the OS to write from buffer to physical disk
+            # This is essential for durability - it survives power failures
+            if sync:
+                fsync_started = time.perf_counter()
+                os.fsync(writer.fileno())
+                self.metrics.observe("fsync", time.perf_counter() - fsync_started)
+        except BaseException:
+            try:
+                writer.truncate(start)
+                writer.seek(start)
+            except OSError:
+                pass
+            raise
+        
+        # The batch is durable, so now I can publish it in the index.
+        # Each value ends where its record ends, so I derive the value
+        # offset from the record end and the value length.
+        offset = start
+        index = self.index
+        segment = self._active_segment
+        segment_live = self._segment_live
+        cache = self._cache
+        ordered = self._ordered
+        expires = self._expires
+        large = self._large
+        # Keys lazy recovery must not overwrite with what it replays
+        written = self._recovery_written if self._recovering else None
+        # Live bytes added to this segment and dropped from older records;
+        # I apply the totals after the loop
+        added = removed = 0
+        for pending in batch:
+            for (key, key_length, value_end, value_length, value, expires_at,
+                 chunks_length) in pending.records:
+                if written is not None:
+                    written.add(key)
+                old_entry = index.get(key)
+                if old_entry is not None:
+                    old_size = HEADER_SIZE + key_length + (old_entry.value_length & VALUE_LENGTH_MASK)
+                    if expires and expires.pop(key, None) is not None:
+                        old_size += EXPIRY.size
+                    if old_entry.value_length & LARGE_VALUE:
+                        old_size += large.pop(key)
+                    segment_live[old_entry.segment] -= old_size
+                    removed += old_size
+                
+                if value_length == TOMBSTONE:
+                    if old_entry is not None:
+                        del index[key]
+                        if ordered is not None:
+                            ordered.discard(key)
+                        if cache is not None:
+                            cache.invalidate(key)
+                    if segment != self._segments[0]:
+                        # Older segments may still hold the key, so
+                        # compaction has to keep this tombstone
+                        tombstone_size = HEADER_SIZE + key_length
+                        self._segment_tombstones[segment] = (
+                            self._segment_tombstones.get(segment, 0) + tombstone_size)
+                        added += tombstone_size
+                    continue
+                
+                if old_entry is None and ordered is not None:
+                    ordered.add(key)
+                stored_length = value_length & VALUE_LENGTH_MASK
+                record_size = HEADER_SIZE + key_length + stored_length
+                value_offset = offset + value_end - stored_length
+                if chunks_length:
+                    large[key] = chunks_length
+                    record_size += chunks_length
+                    value_length |= LARGE_VALUE
+                index[key] = IndexEntry(value_offset, value_length, segment)
+                if expires_at:
+                    expires[key] = expires_at
+                    self._wheel.schedule(key, expires_at)
+                    record_size += EXPIRY.size
+                added += record_size
+                
+                # Write-through: the cache gets the new value right after the index
+                if cache is not None:
+                    if value is not None:
+                        cache.put(key, value, len(value) if value_length & COMPRESSED_VALUE
+                                  else value_length)
+                    else:
+                        cache.invalidate(key)
+            offset += len(pending.payload)
+        segment_live[segment] += added
+        self._live_bytes += added - removed
+        self._appended_since_hint += offset - start
+        metrics = self.metrics
+        metrics.add("bytes_appended", offset - start)
+        metrics.add("write_batches")
+        metrics.add("records_written", sum(len(pending.records) for pending in batch))
+        self._valid_end = offset
+        self._segment_sizes[segment] = offset
+        
+        if self.segment_max_bytes is not None and offset >= self.segment_max_bytes:
+            if not sync:
+                os.fsync(writer.fileno())
+            self._roll_segment()
+        self._maybe_write_hint()
+        self._maybe_compact()
+    
+    def _roll_segment(self) -> None:
+        """
+        Seal the active segment and start appending to a new one.
+        
+        Everything in the active segment is already fsynced, so sealing is
+        just closing the append handle. I create the new segment file right
+        away and fsync the directory, so the new segment survives a crash
+        even before its first record is written.
+        
+        The caller must hold self._lock.
+        """
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._sealed_bytes += self._valid_end
+        
+        segment = self._segments[-1] + 1
+        self._segments.append(segment)
+        self._active_segment = segment
+        self._segment_sizes[segment] = 0
+        self._segment_live[segment] = 0
+        self._valid_end = 0
+        self._open_writer()
+        self._sync_directory()
+    
+    def _submit(self, pending: _PendingWrite) -> None:
+        """
+        Queue a record for the flusher and block until it is durable.
+        
+        Args:
+            pending: The encoded record
+            
+        Raises:
+            OSError: If the flush that covered my record failed
+        """
+        with self._commit_cond:
+            if self._closing:
+                raise OSError("Store is closed")
+            self._commit_queue.append(pending)
+            self._commit_cond.notify_all()
+            while not pending.done:
+                self._commit_cond.wait()
+        
+        if pending.error is not None:
+            raise pending.error
+    
+    def _flusher_loop(self) -> None:
+        """
+        Background thread that turns queued records into durable batches.
+        
+        Group mode: I wait until either group_commit_max_batch records are
+        queued or the oldest record has waited group_commit_max_wait, then
+        write them all and fsync once.
+        
+        Periodic mode: I wake up every fsync_interval and flush whatever
+        arrived since the previous tick.
+        
+        Once close() is called I drain the queue before exiting.
+        """
+        next_tick = time.monotonic() + self.fsync_interval
+        while True:
+            with self._commit_cond:
+                while not self._commit_queue and not self._closing:
+                    self._commit_cond.wait()
+                if not self._commit_queue:
+                    return
+                
+                if self.durability == DURABILITY_GROUP:
+                    deadline = self._commit_queue[0].enqueued_at + self.group_commit_max_wait
+                    while (len(self._commit_queue) < self.group_commit_max_batch
+                           and not self._closing):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._commit_cond.wait(remaining)
+                    batch = self._commit_queue[:self.group_commit_max_batch]
+                    del self._commit_queue[:len(batch)]
+                else:
+                    while not self._closing:
+                        remaining = next_tick - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._commit_cond.wait(remaining)
+                    next_tick = max(next_tick + self.fsync_interval, time.monotonic())
+                    batch = self._commit_queue
+                    self._commit_queue = []
+            
+            error: Optional[BaseException] = None
+            try:
+                with self._lock:
+                    self._write_batch(batch)
+            except BaseException as e:
+                error = e
+            
+            # I wake up every writer in the batch, successful or not
+            with self._commit_cond:
+                for pending in batch:
+                    pending.error = error
+                    pending.done = True
+                self._commit_cond.notify_all()
+    
+    def cache_stats(self) -> Dict[str, int]:
+        """
+        Report value cache counters.
+        
+        Returns:
+            Dictionary with hits, misses, evictions, entries, used_bytes and
+            max_bytes (all zero when the cache is disabled)
+        """
+        if self._cache is None:
+            return {"hits": 0, "misses": 0, "evictions": 0, "entries": 0,
+                    "used_bytes": 0, "max_bytes": 0}
+        return self._cache.stats()
+    
+    def resize_cache(self, max_bytes: int) -> None:
+        """
+        Change the value cache size at runtime.
+        
+        Shrinking evicts entries right away. Resizing to 0 turns the cache off
+        and resizing a disabled cache turns it on with my cache_policy.
+        
+        Args:
+            max_bytes: New capacity in bytes
+            
+        Raises:
+            ValueError: If max_bytes is negative
+        """
+        if max_bytes < 0:
+            raise ValueError("Cache size cannot be negative")
+        with self._lock:
+            if max_bytes == 0:
+                self._cache = None
+            elif self._cache is None:
+                self._cache = CACHE_POLICIES[self.cache_policy](max_bytes)
+            else:
+                self._cache.resize(max_bytes)
+    
+    def compact(self, wait: bool = False) -> bool:
+        """
+        Rewrite the log so it only contains the records my index points to.
+        
+        With a single data file I compact that file. With segments I first
+        seal the active segment, then rewrite every sealed segment that has
+        dead records, one segment at a time (a segment with no live records
+        left is simply deleted).
+        
+        The merge runs in a background thread while SET/GET keep being served:
+        1. Under the write lock I note the current end of the segment and
+           copy its live index entries (this is the snapshot I compact)
+        2. Without the lock I copy every live record into <segment>.compact,
+           reading values in file order
+        3. Under the write lock again I append whatever was written to the
+           segment during step 2 (only possible for the active segment),
+           fsync, atomically rename the new file over the old one and move
+           the index entries to their new offsets. Entries overwritten during
+           step 2 keep pointing to their newer records, so no concurrent
+           write is lost.
+        
+        Args:
+            wait: Block until the compaction has finished
+            
+        Returns:
+            True if I started a compaction, False if one was already running
+        """
+        with self._lock:
+            running = self._compact_thread is not None and self._compact_thread.is_alive()
+            if not running:
+                self._compact_thread = threading.Thread(target=self._compact_worker,
+                                                        args=(True,),
+                                                        name="kv-compact", daemon=True)
+                self._compact_thread.start()
+            thread = self._compact_thread
+        if wait:
+            thread.join()
+        return not running
+    
+    def stats(self) -> Dict[str, object]:
+        """
+        Report everything I measure about myself.
+        
+        Returns:
+            Dictionary with:
+            - uptime_s, recovery_s (how long _rebuild_index took at startup)
+            - counters: bytes_appended, write_batches, records_written
+            - latency: per operation (get, set, mset, mget, fsync, recovery)
+              count, mean and p50/p99/p999/max in microseconds
+            - keys, slowlog_len, profiling
+            - cache: see cache_stats(); log: see compaction_stats()
+            - recovery: see recovery_progress()
+            - compression: codec ("off" without one), dictionary (number of
+              the one new values use, 0 for none); counters values_compressed
+              and compression_saved_bytes
+        """
+        stats = self.metrics.snapshot()
+        stats["recovery_s"] = self._recovery_seconds
+        stats["keys"] = len(self.index)
+        stats["cache"] = self.cache_stats()
+        stats["log"] = self.compaction_stats()
+        stats["recovery"] = self.recovery_progress()
+        compressor = self._compressor
+        stats["compression"] = {
+            "codec": self.compression or "off",
+            "dictionary": compressor.dictionary[0] if compressor and compressor.dictionary else 0,
+        }
+        return stats
+    
+    def compaction_stats(self) -> Dict[str, float]:
+        """
+        Report log size, live data and what compaction has reclaimed so far.
+        
+        Returns:
+            Dictionary with runs, bytes_reclaimed, last_bytes_reclaimed,
+            last_duration_s, failures, running, segments, log_bytes,
+            live_bytes and dead_ratio
+        """
+        with self._lock:
+            stats = dict(self._compact_stats)
+            log_bytes = self._sealed_bytes + self._valid_end
+            stats["running"] = self._compact_thread is not None and self._compact_thread.is_alive()
+            stats["segments"] = len(self._segments)
+            stats["log_bytes"] = log_bytes
+            stats["live_bytes"] = self._live_bytes
+            stats["dead_ratio"] = (log_bytes - self._live_bytes) / log_bytes if log_bytes else 0.0
+        return stats
+    
+    def _compactable(self, segment: int) -> bool:
+        """
+        The active segment is only rewritten when it is the only segment
+        (no segment_max_bytes); otherwise just sealed segments are.
+        """
+        return segment != self._active_segment or self.segment_max_bytes is None
+    
+    def _maybe_compact(self) -> None:
+        """
+        Start a background compaction when enough of the log is dead.
+        
+        With segments I only count dead bytes in sealed segments, since the
+        active one won't be compacted anyway.
+        
+        The caller must hold self._lock.
+        """
+        if self.compact_dead_ratio is None or self._recovering:
+            return
+        log_bytes = self._sealed_bytes + self._valid_end
+        if log_bytes < self.compact_min_bytes:
+            return
+        if self.segment_max_bytes is None:
+            dead = log_bytes - self._live_bytes
+        else:
+            dead = self._sealed_bytes - (self._live_bytes - self._segment_live[self._active_segment])
+        if dead / log_bytes < self.compact_dead_ratio:
+            return
+        if self._compact_thread is not None and self._compact_thread.is_alive():
+            return
+        self._compact_thread = threading.Thread(target=self._compact_worker,
+                                                args=(False,),
+                                                name="kv-compact", daemon=True)
+        self._compact_thread.start()
+    
+    def _compact_worker(self, manual: bool) -> None:
+        """
+        Pick the segments to compact and compact them one by one.
+        
+        A manual COMPACT rewrites every segment with dead records. The
+        automatic trigger only rewrites segments whose own dead ratio passed
+        compact_dead_ratio (or, if none did, the one with the most dead bytes).
+        
+        Args:
+            manual: True when started by compact() rather than the auto trigger
+        """
+        try:
+            # Until lazy recovery is done, my live byte counts are incomplete
+            self._wait_recovered()
+            with self._lock:
+                if manual and self.segment_max_bytes is not None and self._valid_end > 0:
+                    self._roll_segment()
+                
+                dead = {segment: self._segment_sizes[segment] - self._segment_live[segment]
+                        for segment in self._segments if self._compactable(segment)}
+                if manual:
+                    targets = [segment for segment, size in dead.items() if size > 0]
+                else:
+                    ratio = self.compact_dead_ratio or 0.0
+                    targets = [segment for segment, size in dead.items()
+                               if size and size / self._segment_sizes[segment] >= ratio]
+                    if not targets and any(dead.values()):
+                        targets = [max(dead, key=dead.get)]
+                if not targets:
+                    return
+                
+                # One pass over the index finds the live records of every
+                # target. Sealed segments only ever lose live records, so an
+                # early snapshot can only contain extra (dead) entries, which
+                # _swap_segment recognizes and skips.
+                groups: Dict[int, List[Tuple[str, IndexEntry, int, int]]] = {
+                    segment: [] for segment in targets}
+                expires = self._expires
+                large = self._large
+                for key, entry in self.index.items():
+                    group = groups.get(entry.segment)
+                    if group is not None:
+                        group.append((key, entry, expires.get(key, 0), large.get(key, 0)))
+                ends = {segment: self._segment_sizes[segment] for segment in targets}
+            
+            for segment in targets:
+                if self._closing:
+                    return
+                self._compact_segment(segment, groups.pop(segment), ends[segment])
+        except Exception as e:
+            self._compact_stats["failures"] += 1
+            print(f"Warning: Compaction of {self.data_file} failed: {e}",
+                  file=sys.stderr, flush=True)
+            return
+        
+        # The old snapshot describes the old files, so I write a fresh one
+        if self.use_hint:
+            self._hint_worker()
+    
+    def _compact_segment(self, segment: int, live: List[Tuple[str, IndexEntry, int, int]],
+                         snapshot_end: int) -> None:
+        """
+        Rewrite one segment with only its live records. See compact().
+        
+        Tombstones are only dropped from the oldest segment. In any other
+        sealed segment I keep a tombstone if the key is still deleted, since
+        an older segment may hold a record it hides. A PUT that expired
+        without a tombstone (while the store was closed) gets one here for
+        the same reason.
+        
+        A large value's chunk records are copied verbatim in front of its
+        new manifest, which finds them by relative distance as before.
+        
+        Args:
+            segment: The segment to rewrite
+            live: (key, entry, expires_at, chunks_length) for each index
+                entry that pointed into the segment at snapshot time
+            snapshot_end: Size of the segment at snapshot time
+            
+        Raises:
+            OSError: If the new segment cannot be written or swapped in
+        """
+        started = time.monotonic()
+        path = segment_path(self.data_file, segment)
+        
+        tombstones: List[str] = []
+        if segment != self._active_segment and segment != self._segments[0]:
+            records, _ = scan_segment(path)
+            now = now_ms()
+            deleted = [key for key, (value_offset, _, _, expires_at, _) in records.items()
+                       if value_offset == TOMBSTONE or (expires_at and expires_at <= now)]
+            if deleted:
+                with self._lock:
+                    index = self.index
+                    tombstones = [key for key in deleted if key not in index]
+        
+        if not live and not tombstones and segment != self._active_segment:
+            with self._lock:
+                self._drop_segment(segment)
+                self._record_compaction(snapshot_end, started)
+            return
+        
+        temp_file = path + ".compact"
+        live.sort(key=lambda item: item[1].value_offset)
+        # I open my own handle so a concurrent swap can't change what I read
+        source_fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        out = None
+        try:
+            # Step 2: copy the live records, in file order, into the new segment
+            out = open(temp_file, 'wb', buffering=1024 * 1024)
+            for key in tombstones:
+                out.write(self._encode_delete(key)[0])
+            tombstone_bytes = out.tell()
+            moved = []
+            for key, entry, expires_at, chunks_length in live:
+                if self._closing:
+                    # Shutdown wins over compaction; the old segment is untouched
+                    return
+                key_bytes = key.encode('utf-8')
+                value_length = entry.value_length & VALUE_LENGTH_MASK
+                value_bytes = self._pread(source_fd, value_length, entry.value_offset)
+                if len(value_bytes) < value_length:
+                    raise OSError(f"incomplete value at offset {entry.value_offset}")
+                record_type = RECORD_PUT
+                if entry.value_length & LARGE_VALUE:
+                    chunks_back = LARGE_INFO.unpack(value_bytes)[1]
+                    self._copy_range(source_fd, out, entry.value_offset - chunks_back, chunks_length)
+                    record_type = RECORD_LARGE
+                elif entry.value_length & COMPRESSED_VALUE:
+                    record_type |= RECORD_FLAG_COMPRESSED
+                if expires_at:
+                    out.write(RECORD_HEADER.pack(
+                        len(key_bytes) | ((record_type | RECORD_FLAG_TTL) << RECORD_TYPE_SHIFT),
+                        len(value_bytes) + EXPIRY.size))
+                    out.write(key_bytes)
+                    out.write(EXPIRY.pack(expires_at))
+                else:
+                    out.write(RECORD_HEADER.pack(len(key_bytes) | (record_type << RECORD_TYPE_SHIFT),
+                                                 len(value_bytes)))
+                    out.write(key_bytes)
+                moved.append((key, entry, out.tell()))
+                out.write(value_bytes)
+            
+            # Step 3: catch up on concurrent writes and swap, holding the lock
+            with self._lock:
+                tail_start = out.tell()
+                tail_end = self._valid_end if segment == self._active_segment else snapshot_end
+                self._copy_range(source_fd, out, snapshot_end, tail_end - snapshot_end)
+                out.flush()
+                os.fsync(out.fileno())
+                new_size = out.tell()
+                out.close()
+                out = None
+                
+                self._swap_segment(segment, temp_file, snapshot_end, tail_start, moved, new_size)
+                self._record_compaction(tail_end - new_size, started)
+                
+                # The kept tombstones replace whatever I counted as live before
+                change = tombstone_bytes - self._segment_tombstones.get(segment, 0)
+                self._segment_live[segment] += change
+                self._live_bytes += change
+                if tombstone_bytes:
+                    self._segment_tombstones[segment] = tombstone_bytes
+                else:
+                    self._segment_tombstones.pop(segment, None)
+        finally:
+            os.close(source_fd)
+            if out is not None:
+                out.close()
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+    
+    def _copy_range(self, source_fd: int, out, start: int, length: int) -> None:
+        """
+        Copy `length` bytes of a segment, from `start`, to a file object in
+        1MB pieces.
+        
+        Raises:
+            OSError: If the segment ends early
+        """
+        position = start
+        end = start + length
+        while position < end:
+            chunk = self._pread(source_fd, min(1024 * 1024, end - position), position)
+            if not chunk:
+                raise OSError(f"segment ended early at offset {position}")
+            out.write(chunk)
+            position += len(chunk)
+    
+    def _record_compaction(self, reclaimed: int, started: float) -> None:
+        """Update the compaction counters. The caller must hold self._lock."""
+        self._compact_stats["runs"] += 1
+        self._compact_stats["bytes_reclaimed"] += reclaimed
+        self._compact_stats["last_bytes_reclaimed"] = reclaimed
+        self._compact_stats["last_duration_s"] = time.monotonic() - started
+    
+    def _swap_segment(self, segment: int, temp_file: str, snapshot_end: int,
+                      tail_start: int, moved: List[Tuple[str, IndexEntry, int]],
+                      new_size: int) -> None:
+        """
+        Atomically replace a segment with its compacted file and fix the index.
+        
+        The caller must hold self._lock. I bump _layout_version to an odd
+        number for the duration so concurrent GETs wait and retry instead of
+        pairing an old offset with the new file.
+        
+        Args:
+            segment: The segment being replaced
+            temp_file: The fully written and fsynced compacted segment
+            snapshot_end: Old segment position the compaction snapshot covered
+            tail_start: Position in the new file where the copied tail begins
+            moved: (key, old entry, new value offset) for every copied record
+            new_size: Size of the compacted segment
+        """
+        active = segment == self._active_segment
+        self._layout_version += 1
+        try:
+            # I close my handles first; Windows can't rename over open files
+            if active and self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            self._close_reader(segment)
+            
+            os.replace(temp_file, segment_path(self.data_file, segment))
+            self._sync_directory()
+            
+            # Records written to the active segment during the merge were
+            # copied verbatim, so they just shift by a constant. Copied
+            # records only move if nothing overwrote their key in the meantime.
+            index = self.index
+            if active:
+                shift = tail_start - snapshot_end
+                shifted = [(key, entry) for key, entry in index.items()
+                           if entry.segment == segment and entry.value_offset >= snapshot_end]
+                for key, entry in shifted:
+                    index[key] = IndexEntry(entry.value_offset + shift, entry.value_length, segment)
+            for key, old_entry, value_offset in moved:
+                if index.get(key) == old_entry:
+                    index[key] = IndexEntry(value_offset, old_entry.value_length, segment)
+            
+            if active:
+                self._valid_end = new_size
+            else:
+                self._sealed_bytes += new_size - self._segment_sizes[segment]
+            self._segment_sizes[segment] = new_size
+            self._appended_since_hint += 1  # my last snapshot is out of date
+        finally:
+            self._layout_version += 1
+    
+    def _drop_segment(self, segment: int) -> None:
+        """
+        Delete a sealed segment that no index entry points to any more.
+        
+        The caller must hold self._lock.
+        """
+        self._layout_version += 1
+        try:
+            self._close_reader(segment)
+            os.remove(segment_path(self.data_file, segment))
+            self._sync_directory()
+            self._segments.remove(segment)
+            self._sealed_bytes -= self._segment_sizes.pop(segment)
+            self._live_bytes -= self._segment_live.pop(segment)
+            self._segment_tombstones.pop(segment, None)
+            
+            # Nothing is older than the oldest segment, so its tombstones
+            # are dead now and the next compaction may drop them
+            oldest = self._segments[0]
+            tombstone_bytes = self._segment_tombstones.pop(oldest, 0)
+            self._segment_live[oldest] -= tombstone_bytes
+            self._live_bytes -= tombstone_bytes
+            self._appended_since_hint += 1  # my last snapshot is out of date
+        finally:
+            self._layout_version += 1
+    
+    def _sync_directory(self) -> None:
+        """
+        fsync the directory holding the log so a rename survives a crash.
+        
+        Directories can't be opened on Windows, so there I skip this step.
+        """
+        if os.name == 'nt':
+            return
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.data_file)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    
+    @staticmethod
+    def _pread(fd: int, length: int, offset: int) -> bytes:
+        """
+        Positional read that also works where os.pread doesn't exist.
+        
+        The fallback moves the descriptor's file position, so it must only be
+        used on descriptors that nothing else is reading concurrently.
+        """
+        if hasattr(os, 'pread'):
+            return os.pread(fd, length, offset)
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, length)
+    
+    @instrumented("get")
+    def get(self, key: str) -> Optional[str]:
+        """
+        Get value for a key. I return None if the key doesn't exist.
+        
+        Process:
+        1. I validate the input
+        2. I look up the key in my index (O(1) with hash table)
+        3. If not found, I return None
+        4. If found, I read exactly the value bytes at entry.value_offset
+           (one pread, or a slice of the mapping in mmap mode)
+        5. I return the decoded value
+        
+        Time Complexity: O(1) for index lookup + O(1) for file read
+        
+        Args:
+            key: The key to retrieve (must not be empty)
+            
+        Returns:
+            The value associated with the key (string)
+            None if key doesn't exist
+            
+        Raises:
+            ValueError: If key is invalid
+            IOError: If file read fails
+        """
+        # I validate the input
+        if not key:
+            raise ValueError("Key cannot be empty")
+        
+        # A key whose TTL ran out is gone, even if my expiry thread hasn't
+        # written its tombstone yet. While lazy recovery runs, my index may
+        # not know the newest record of a key, so get_bytes() sorts out both
+        # and I leave the cache alone.
+        recovering = self._recovering
+        if self._expires and not recovering and self._expired(key):
+            return None
+        
+        # Hot keys are answered from the cache without touching the file
+        cache = None if recovering else self._cache
+        if cache is not None:
+            value = cache.get(key)
+            if value is not None:
+                return value
+        
+        try:
+            entry = self.index.get(key)
+            value_bytes = self.get_bytes(key)
+            if value_bytes is None:
+                return None
+            
+            # I decode the bytes back to string using UTF-8
+            try:
+                value = str(value_bytes, 'utf-8')
+            except UnicodeDecodeError as e:
+                raise IOError(f"Corrupted entry: invalid UTF-8 in value: {e}") from e
+            
+            # I only cache what I read if the key still points to the same
+            # record; otherwise a concurrent SET already cached a newer value
+            if cache is not None and entry is not None:
+                cache.put(key, value, len(value_bytes),
+                          check=lambda: self.index.get(key) == entry)
+            return value
+        
+        except IOError as e:
+            # File read errors
+            print(f"Error: I cannot read value for key '{key}': {e}", 
+                  file=sys.stderr, flush=True)
+            return None
+        
+        except OSError as e:
+            # Disk errors
+            print(f"Error: Disk error while I'm reading key '{key}': {e}", 
+                  file=sys.stderr, flush=True)
+            return None
+        
+        except Exception as e:
+            # Unexpected errors
+            print(f"Error: Unexpected error reading key '{key}': {e}", 
+                  file=sys.stderr, flush=True)
+            return None
+    
+    @instrumented("mget")
+    def mget(self, keys: List[str]) -> List[Optional[str]]:
+        """
+        Get the values for many keys.
+        
+        I read the keys in (segment, file offset) order rather than in the
+        order given, so the reads sweep through the log sequentially instead
+        of jumping back and forth. The result is still in the caller's order.
+        
+        Args:
+            keys: The keys to retrieve (each must not be empty)
+            
+        Returns:
+            One value (or None) per key, in the same order as `keys`
+            
+        Raises:
+            ValueError: If any key is invalid
+        """
+        for key in keys:
+            if not key:
+                raise ValueError("Key cannot be empty")
+        
+        index = self.index
+        recovering = self._recovering
+        located = []
+        for position, key in enumerate(keys):
+            entry = index.get(key)
+            if entry is not None:
+                located.append((entry.segment, entry.value_offset, position))
+            elif recovering:
+                # It may be in the part of the log not replayed yet
+                located.append((-1, 0, position))
+        located.sort()
+        
+        values: List[Optional[str]] = [None] * len(keys)
+        for _, _, position in located:
+            values[position] = self.get(keys[position])
+        return values
+    
+    def _ordered_keys(self) -> OrderedKeys:
+        """
+        The sorted key list, built from the index on first use.
+        
+        I build it under the write lock so no SET can slip in between the
+        snapshot of the keys and _write_batch starting to maintain it, and
+        only once lazy recovery has put every key in the index.
+        """
+        ordered = self._ordered
+        if ordered is None:
+            self._wait_recovered()
+            with self._lock:
+                if self._ordered is None:
+                    self._ordered = OrderedKeys(self.index.keys())
+                ordered = self._ordered
+        return ordered
+    
+    def _read_page(self, keys: List[str]) -> List[Tuple[str, str]]:
+        """
+        Fetch the values of a page of keys, in key order.
+        
+        mget() does the reads in file offset order. A key deleted after I
+        listed it simply drops out of the page.
+        """
+        return [(key, value) for key, value in zip(keys, self.mget(keys)) if value is not None]
+    
+    def scan(self, start: Optional[str] = None, end: Optional[str] = None,
+             prefix: Optional[str] = None, page_size: int = 256):
+        """
+        Lazily iterate over (key, value) pairs in key order.
+        
+        I fetch one page of keys at a time and read that page's values in
+        file offset order. Keys written while the iteration is running show
+        up if they sort after the current position.
+        
+        Args:
+            start: First key to return (inclusive; None: from the beginning)
+            end: Stop before this key (exclusive; None: to the end)
+            prefix: Only keys starting with this prefix
+            page_size: Keys fetched per step
+            
+        Yields:
+            (key, value) tuples in ascending key order
+        """
+        if prefix:
+            if start is None or start < prefix:
+                start = prefix
+            bound = prefix_end(prefix)
+            if bound is not None and (end is None or bound < end):
+                end = bound
+        ordered = self._ordered_keys()
+        after = False
+        while True:
+            keys = ordered.slice(start, end, page_size, after)
+            if not keys:
+                return
+            yield from self._read_page(keys)
+            start, after = keys[-1], True
+    
+    def scan_page(self, cursor: str = "0", prefix: Optional[str] = None,
+                  count: int = 10) -> Tuple[str, List[Tuple[str, str]]]:
+        """
+        One page of a resumable, cursor-based scan (like Redis SCAN).
+        
+        The cursor is "0" to start, and I return "0" once there is nothing
+        left. Any other cursor is the hex-encoded UTF-8 of the last key the
+        previous page returned, so it stays valid across restarts and
+        compactions: the next page simply starts after that key.
+        
+        Args:
+            cursor: "0" or a cursor returned by the previous call
+            prefix: Only keys starting with this prefix
+            count: Maximum pairs to return
+            
+        Returns:
+            (next cursor, [(key, value), ...]) in key order
+            
+        Raises:
+            ValueError: If the cursor or count is invalid
+        """
+        if count < 1:
+            raise ValueError("COUNT must be at least 1")
+        if cursor == "0":
+            low, after = None, False
+        else:
+            try:
+                low, after = bytes.fromhex(cursor).decode('utf-8'), True
+            except ValueError:
+                raise ValueError(f"Invalid cursor '{cursor}'") from None
+        
+        high = None
+        if prefix:
+            if low is None or low < prefix:
+                low, after = prefix, False
+            high = prefix_end(prefix)
+        
+        keys = self._ordered_keys().slice(low, high, count, after)
+        if len(keys) < count:
+            next_cursor = "0"
+        else:
+            next_cursor = keys[-1].encode('utf-8').hex()
+        return next_cursor, self._read_page(keys)
+    
+    def get_bytes(self, key: str):
+        """
+        Get the raw value bytes for a key without decoding them.
+        
+        In mmap mode the result is a memoryview into the mapped log, so no
+        copy is made. In pread mode it is a bytes object from a single read.
+        A large value is assembled from its chunks into one bytearray; use
+        get_stream() to read it without holding it all in memory.
+        
+        Args:
+            key: The key to retrieve
+            
+        Returns:
+            bytes or memoryview with the value, or None if the key doesn't exist
+            
+        Raises:
+            IOError: If the value cannot be read completely
+        """
+        while True:
+            # If a compaction is swapping files right now, I wait for it
+            version = self._layout_version
+            if version & 1:
+                with self._lock:
+                    continue
+            
+            # I look up the key in my index (O(1) with dictionary)
+            if self._recovering:
+                entry = self._live_entry(key)
+                if entry is None:
+                    return None
+            else:
+                entry = self.index.get(key)
+                
+                # If the key is not in my index (or has expired), it doesn't exist
+                if entry is None or (self._expires and self._expired(key)):
+                    return None
+            
+            try:
+                if entry.value_length & LARGE_VALUE:
+                    value_bytes = self._read_large(entry)
+                elif entry.value_length & COMPRESSED_VALUE:
+                    value_bytes = self._decompress(self._read_value(IndexEntry(
+                        entry.value_offset, entry.value_length & VALUE_LENGTH_MASK, entry.segment)))
+                else:
+                    value_bytes = self._read_value(entry)
+            except OSError:
+                # The descriptor may have been swapped out mid-read
+                if self._layout_version != version:
+                    continue
+                raise
+            
+            # If the layout changed while I was reading, the entry and the
+            # file may not belong together, so I simply read again
+            if self._layout_version == version:
+                return value_bytes
+    
+    def get_stream(self, key: str) -> Optional[ValueReader]:
+        """
+        Open a value for streaming instead of reading it into memory.
+        
+        The reader works for any value, but exists for large ones: read it
+        with readinto() into a buffer you reuse, or send it to a socket with
+        its sendfile() method. It is a snapshot - writes to the key after
+        this call don't affect it. Close it when done (it is a context manager).
         
         Args:
-            key: The key to set (string, must not be empty)
-            value: The value to associate with the key (string)
+            key: The key to open
+            
+        Returns:
+            A ValueReader, or None if the key doesn't exist
             
         Raises:
-            ValueError: If key is empty or invalid
-            IOError: If write operation fails
-            OSError: If disk write fails
+            ValueError: If key is empty
+            IOError: If the value cannot be read
         """
-        # I validate the input
         if not key:
             raise ValueError("Key cannot be empty")
+        while True:
+            version = self._layout_version
+            if version & 1:
+                with self._lock:
+                    continue
+            entry = self._live_entry(key)
+            if entry is None:
+                return None
+            try:
+                stream = self._open_stream(entry)
+            except OSError:
+                if self._layout_version != version:
+                    continue
+                raise
+            # My descriptor must belong to the file the entry describes
+            if self._layout_version == version:
+                return stream
+            stream.close()
+    
+    def _open_stream(self, entry: IndexEntry) -> ValueReader:
+        """
+        Open a private descriptor on an entry's segment and wrap it in a
+        ValueReader, reading the manifest first for a large value.
         
-        if not isinstance(key, str) or not isinstance(value, str):
-            raise ValueError("Key and value must be strings")
-        
-        file_handle = None
+        A compressed value is at most 1MB once decompressed, so I decompress
+        it into an unlinked temporary file and stream from that.
+        """
+        if entry.value_length & COMPRESSED_VALUE:
+            value_bytes = self._decompress(self._read_value(IndexEntry(
+                entry.value_offset, entry.value_length & VALUE_LENGTH_MASK, entry.segment)))
+            with tempfile.TemporaryFile() as temp:
+                temp.write(value_bytes)
+                temp.flush()
+                fd = os.dup(temp.fileno())
+            return ValueReader(fd, 0, len(value_bytes), len(value_bytes), len(value_bytes))
+        fd = os.open(segment_path(self.data_file, entry.segment),
+                     os.O_RDONLY | getattr(os, 'O_BINARY', 0))
         try:
-            # I convert strings to bytes using UTF-8 encoding
-            # UTF-8 is a variable-length encoding that handles all Unicode characters
-            key_bytes = key.encode('utf-8')
-            value_bytes = value.encode('utf-8')
-            
-            # I open the file in append+binary mode ('ab')
-            # 'a' = append (writes go to end of file)
-            # 'b' = binary (no text processing)
-            file_handle = open(self.data_file, 'ab')
-            
-            # I get the current position in the file - this is where my entry starts
-            # I'll store this offset in the index
-            offset = file_handle.tell()
-            
-            # I write the entry in my binary format:
-            # [4 bytes: key length][4 bytes: value length][key bytes][value bytes]
-            
-            # I write the key length as a 4-byte big-endian integer
-            file_handle.write(len(key_bytes).to_bytes(4, 'big'))
-            
-            # I write the value length as a 4-byte big-endian integer
-            file_handle.write(len(value_bytes).to_bytes(4, 'big'))
-            
-            # I write the actual key bytes
-            file_handle.write(key_bytes)
-            
-            # I write the actual value bytes
-            file_handle.write(value_bytes)
-            
-            # CRITICAL: I ensure data is written to disk
-            # flush() writes from Python buffer to OS buffer
-            file_handle.flush()
+            if not entry.value_length & LARGE_VALUE:
+                return ValueReader(fd, entry.value_offset, entry.value_length,
+                                   entry.value_length, entry.value_length)
+            info = self._pread(fd, LARGE_INFO.size, entry.value_offset)
+            if len(info) < LARGE_INFO.size:
+                raise IOError(f"Corrupted entry: incomplete large value at offset {entry.value_offset}")
+            length, chunks_back, chunk_size, crc = LARGE_INFO.unpack(info)
+            return ValueReader(fd, entry.value_offset - chunks_back + HEADER_SIZE,
+                               HEADER_SIZE + chunk_size, chunk_size, length, crc)
+        except BaseException:
+            os.close(fd)
+            raise
+    
+    def _read_large(self, entry: IndexEntry) -> bytearray:
+        """
+        Read a whole large value into one buffer, chunk by chunk.
+        """
+        with self._open_stream(entry) as stream:
+            value_bytes = bytearray(stream.length)
+            view = memoryview(value_bytes)
+            filled = 0
+            while filled < len(value_bytes):
+                filled += stream.readinto(view[filled:])
+        return value_bytes
+    
+    def _reader(self, segment: int) -> int:
+        """
+        Return the read-only descriptor for a segment, opening it on first use.
+        """
+        fd = self._reader_fds.get(segment)
+        if fd is None:
+            with self._map_lock:
+                fd = self._reader_fds.get(segment)
+                if fd is None:
+                    # O_BINARY only exists (and only matters) on Windows
+                    fd = os.open(segment_path(self.data_file, segment),
+                                 os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+                    self._reader_fds[segment] = fd
+        return fd
+    
+    def _close_reader(self, segment: int) -> None:
+        """
+        Drop the read descriptor and mapping of a segment that is being
+        replaced or removed. The caller must hold self._lock.
+        """
+        with self._map_lock:
+            self._maps.pop(segment, None)
+            fd = self._reader_fds.pop(segment, None)
+            if fd is not None:
+                os.close(fd)
+    
+    def _read_value(self, entry: IndexEntry):
+        """
+        Read the value bytes that an index entry points to.
+        
+        pread mode: one os.pread() at entry.value_offset. os.pread doesn't
+        touch the shared file position, so concurrent readers are safe. On
+        platforms without pread (Windows) I fall back to seek + read under
+        a lock.
+        
+        mmap mode: I slice the mapping. If the value lies past the end of
+        my current mapping, the segment has grown since I mapped it, so I
+        remap it first.
+        
+        Args:
+            entry: The index entry to read
             
-            # fsync() forces the OS to write from buffer to physical disk
-            # This is essential for durability - it survives power failures
-            # Without fsync(), the data might only be in RAM
-            os.fsync(file_handle.fileno())
+        Returns:
+            The value as bytes (pread) or memoryview (mmap)
             
-            # I update the in-memory index with the new entry
-            # The dictionary automatically handles overwrites (last write wins)
-            self.index[key] = IndexEntry(offset, len(value_bytes))
+        Raises:
+            IOError: If the value extends past the end of the segment
+        """
+        end = entry.value_offset + entry.value_length
         
-        except IOError as e:
-            # File write errors - critical failure
-            raise IOError(f"I failed to write to {self.data_file}: {e}") from e
+        if self.read_mode == READ_MODE_MMAP:
+            mapping = self._maps.get(entry.segment)
+            if mapping is None or len(mapping) < end:
+                mapping = self._remap(entry.segment, end)
+            return memoryview(mapping)[entry.value_offset:end]
         
-        except OSError as e:
-            # Disk errors during writing or fsync
-            raise OSError(f"Disk error while I'm writing to {self.data_file}: {e}") from e
+        fd = self._reader(entry.segment)
+        if hasattr(os, 'pread'):
+            value_bytes = os.pread(fd, entry.value_length, entry.value_offset)
+        else:
+            with self._map_lock:
+                os.lseek(fd, entry.value_offset, os.SEEK_SET)
+                value_bytes = os.read(fd, entry.value_length)
         
-        except Exception as e:
-            # Unexpected errors
-            raise RuntimeError(f"Unexpected error in my set operation: {e}") from e
+        if len(value_bytes) < entry.value_length:
+            raise IOError(f"Corrupted entry: incomplete value at offset {entry.value_offset}")
+        return value_bytes
+    
+    def _decompress(self, stored) -> bytes:
+        """
+        Decode the stored form of a compressed value.
         
-        finally:
-            # I ensure the file is always closed
-            if file_handle is not None:
-                try:
-                    file_handle.close()
-                except Exception as e:
-                    print(f"Warning: Error closing file after write: {e}", 
-                          file=sys.stderr, flush=True)
+        Raises:
+            IOError: If the value is corrupted or its dictionary is missing
+        """
+        try:
+            return decompress(stored, self._dictionary)
+        except ValueError as e:
+            raise IOError(f"Corrupted entry: {e}") from e
     
-    def get(self, key: str) -> Optional[str]:
+    def _dictionary(self, number: int) -> bytes:
         """
-        Get value for a key. I return None if the key doesn't exist.
+        Return compression dictionary `number`, reading it from disk if I
+        haven't seen it yet (another process may have trained it).
+        """
+        data = self._dictionaries.get(number)
+        if data is None:
+            data = read_dictionary(dictionary_path(self.data_file, number))
+            self._dictionaries[number] = data
+        return data
+    
+    def _latest_dictionary(self) -> Optional[Tuple[int, bytes]]:
+        """
+        (number, data) of my newest dictionary, or None if I have none.
+        """
+        if not self._dictionaries:
+            return None
+        number = max(self._dictionaries)
+        return number, self._dictionaries[number]
+    
+    def train_dictionary(self, samples: int = 1000,
+                         size: int = MAX_DICTIONARY_BYTES) -> Optional[int]:
+        """
+        Train a compression dictionary from the values I store and use it
+        for new small values from now on.
         
-        Process:
-        1. I validate the input
-        2. I look up the key in my index (O(1) with hash table)
-        3. If not found, I return None
-        4. If found, I seek to the file offset and read the value
-        5. I return the decoded value
+        I sample up to `samples` keys spread evenly over the index, build a
+        dictionary from their values (kv_codec.train_dictionary) and write
+        it next to the log before any record can refer to it. Records
+        compressed with older dictionaries stay readable, since dictionary
+        files are never removed.
         
-        Time Complexity: O(1) for index lookup + O(1) for file read
+        Args:
+            samples: How many values to learn from
+            size: Dictionary size limit in bytes (at most 32KB is used)
+            
+        Returns:
+            The new dictionary's number, or None if the values had nothing
+            in common to put in one
+            
+        Raises:
+            ValueError: If compression is off
+            OSError: If the dictionary can't be written
+        """
+        if self._compressor is None:
+            raise ValueError("Compression is off; open the store with compression set")
+        self._wait_recovered()
+        with self._lock:
+            # Chunked values are never compressed, so I leave them out
+            keys = [key for key, entry in self.index.items()
+                    if not entry.value_length & LARGE_VALUE]
+        step = max(1, len(keys) // max(1, samples))
+        keys = keys[::step][:samples]
+        values = [value.encode('utf-8') for value in self._read_values(keys)
+                  if value is not None and len(value) <= DICTIONARY_VALUE_BYTES]
+        data = train_dictionary(values, min(size, MAX_DICTIONARY_BYTES))
+        if not data:
+            return None
+        with self._lock:
+            number = max(self._dictionaries, default=0) + 1
+            write_dictionary(dictionary_path(self.data_file, number), data)
+            self._dictionaries[number] = data
+            self._compressor = Compressor(self.compression, self.compression_min_bytes,
+                                          dictionary=(number, data))
+        self.metrics.add("dictionaries_trained")
+        return number
+    
+    def _remap(self, segment: int, needed: int) -> mmap.mmap:
+        """
+        Map a segment again so that the mapping covers at least `needed` bytes.
+        
+        I map the whole file as it is now, which also covers everything
+        appended since the previous mapping. The old mapping is not closed
+        because memoryviews handed out earlier may still point into it.
         
         Args:
-            key: The key to retrieve (must not be empty)
+            segment: The segment to map
+            needed: Minimum number of bytes the mapping must cover
             
         Returns:
-            The value associated with the key (string)
-            None if key doesn't exist
+            The current mapping
             
         Raises:
-            ValueError: If key is invalid
-            IOError: If file read fails
+            IOError: If the segment is shorter than `needed`
         """
-        # I validate the input
-        if not key:
-            raise ValueError("Key cannot be empty")
+        fd = self._reader(segment)
+        with self._map_lock:
+            mapping = self._maps.get(segment)
+            if mapping is not None and len(mapping) >= needed:
+                return mapping
+            size = os.fstat(fd).st_size
+            if size < needed:
+                raise IOError(f"Corrupted entry: segment ends at {size}, value needs {needed} bytes")
+            mapping = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+            self._maps[segment] = mapping
+            return mapping
+    
+    def execute(self, line: str) -> Optional[str]:
+        """
+        Execute one command line and return the text to send back.
         
-        # I look up the key in my index (O(1) with dictionary)
-        entry = self.index.get(key)
+        This is the command dispatcher shared by my stdin REPL (run) and my
+        network server (kv_server.py), so both speak exactly the same
+        protocol. I don't handle EXIT here - ending the session is up to
+        the caller.
+        
+        Supported commands:
+        - SET <key> <value> [EX <seconds> | PX <milliseconds>]: I store a
+          key-value pair, optionally expiring after the given time
+        - GET <key>: I retrieve the value for a key
+        - DEL <k1> [<k2> ...]: I delete keys and return how many existed
+        - TTL <key>: I return the milliseconds left, -1 (no TTL) or -2 (no key)
+        - MSET <k1> <v1> [<k2> <v2> ...]: I store many pairs in one atomic write
+        - MGET <k1> [<k2> ...]: I return one value (or "(nil)") per key
+        - SCAN <cursor> [MATCH <prefix>] [COUNT <n>]: I return the next cursor
+          and then a page of "<key> <value>" lines in key order
+        - RANGE <start> <end> [COUNT <n>]: I return "<key> <value>" lines for
+          start <= key < end ("-" leaves a side open), or "(empty)"
+        - CACHE STATS / CACHE RESIZE <bytes>: I report or resize the value cache
+        - COMPACT: I start a background log compaction
+        - IMPORT <path> [tsv|jsonl|native]: I bulk-load a file (see
+          import_records) and return how many records it had
+        - EXPORT <path> [tsv|jsonl|native]: I write every live key to a file
+          and return how many I wrote
+        - STATS (or INFO): I return my counters and latency percentiles
+        - SLOWLOG GET [n] / LEN / RESET: I report or clear the slow log
+        - PROFILE ON [every] / OFF / DUMP [path]: I sample hot calls with cProfile
         
-        # If the key is not in my index, it doesn't exist
-        if entry is None:
+        Args:
+            line: One command line, without the trailing newline
+            
+        Returns:
+            The response (possibly several lines joined by "\n"), or None
+            if the line was blank
+        """
+        # I remove leading/trailing whitespace (including newline)
+        line = line.strip()
+        
+        # I parse the command line
+        # split(None, 2) splits on whitespace, max 3 parts
+        # This allows values to contain spaces
+        # Example: "SET key my value" -> ["SET", "key", "my value"]
+        parts = line.split(None, 2)
+        
+        # I skip if nothing was parsed
+        if not parts:
             return None
         
-        file_handle = None
+        # I extract the command and convert to uppercase for case-insensitive matching
+        command = parts[0].upper()
+        
         try:
-            # I open the file in binary read mode
-            file_handle = open(self.data_file, 'rb')
+            # I handle the SET command: SET <key> <value>
+            if command == "SET":
+                # I validate: need exactly 3 parts (SET, key, value)
+                if len(parts) < 3:
+                    return "Error: SET requires key and value"
+                
+                try:
+                    # I store the key-value pair (parts[1] is the key, parts[2] the value)
+                    value, ttl_ms = _parse_set(parts[2])
+                    self.set(parts[1], value, ttl_ms)
+                    return "OK"
+                
+                except (ValueError, IOError, OSError) as e:
+                    # I handle errors from my set() operation
+                    return f"Error: {e}"
+            
+            # I handle the GET command: GET <key>
+            elif command == "GET":
+                # I validate: need exactly 2 parts (GET, key)
+                if len(parts) < 2:
+                    return "Error: GET requires key"
+                
+                try:
+                    # I retrieve the value from my store
+                    value = self.get(parts[1])
+                    
+                    # I return the result:
+                    # - If key exists, the value
+                    # - If key doesn't exist, "(nil)" (Redis convention)
+                    return "(nil)" if value is None else value
+                
+                except ValueError as e:
+                    # I handle validation errors
+                    return f"Error: {e}"
+            
+            # I handle the DEL command: DEL <key> [<key> ...]
+            elif command == "DEL":
+                keys = line.split()[1:]
+                if not keys:
+                    return "Error: DEL requires at least one key"
+                try:
+                    return str(self.delete(*keys))
+                except (ValueError, IOError, OSError) as e:
+                    return f"Error: {e}"
             
-            # I seek to the position where this entry starts
-            # entry.offset points to the beginning of the entry
-            file_handle.seek(entry.offset)
+            # I handle the TTL command: TTL <key>
+            elif command == "TTL":
+                if len(parts) != 2:
+                    return "Error: TTL requires key"
+                return str(self.ttl(parts[1]))
             
-            # I read and parse the entry format:
-            # [key_len: 4 bytes][val_len: 4 bytes][key: variable][value: variable]
+            # I handle the MSET command: MSET <key> <value> [<key> <value> ...]
+            # Values can't contain spaces here, since pairs are space-separated
+            elif command == "MSET":
+                words = line.split()[1:]
+                if not words or len(words) % 2:
+                    return "Error: MSET requires key value pairs"
+                try:
+                    self.mset(zip(words[0::2], words[1::2]))
+                    return "OK"
+                except (ValueError, IOError, OSError, RuntimeError) as e:
+                    return f"Error: {e}"
             
-            # I read the key length (I need this to skip over the key)
-            key_len_bytes = file_handle.read(4)
-            if len(key_len_bytes) < 4:
-                raise IOError(f"Corrupted entry: I cannot read key length at offset {entry.offset}")
+            # I handle the MGET command: MGET <key> [<key> ...]
+            # I return one line per key, in the order they were given
+            elif command == "MGET":
+                keys = line.split()[1:]
+                if not keys:
+                    return "Error: MGET requires at least one key"
+                values = self.mget(keys)
+                return "\n".join("(nil)" if value is None else value for value in values)
             
-            key_len = int.from_bytes(key_len_bytes, 'big')
+            # I handle the SCAN command: SCAN <cursor> [MATCH <prefix>] [COUNT <n>]
+            # I return the next cursor first, then one "<key> <value>" line per pair
+            elif command == "SCAN":
+                words = line.split()[1:]
+                if not words or len(words) % 2 == 0:
+                    return "Error: SCAN requires cursor [MATCH prefix] [COUNT n]"
+                options = {name.upper(): value for name, value in zip(words[1::2], words[2::2])}
+                if set(options) - {"MATCH", "COUNT"} or not options.get("COUNT", "1").isdigit():
+                    return "Error: SCAN requires cursor [MATCH prefix] [COUNT n]"
+                try:
+                    cursor, pairs = self.scan_page(words[0], options.get("MATCH"),
+                                                   int(options.get("COUNT", 10)))
+                except ValueError as e:
+                    return f"Error: {e}"
+                return "\n".join([cursor] + [f"{key} {value}" for key, value in pairs])
             
-            # I skip the value length (4 bytes) - I already know it from my index
-            val_len_bytes = file_handle.read(4)
-            if len(val_len_bytes) < 4:
-                raise IOError(f"Corrupted entry: I cannot read value length at offset {entry.offset}")
+            # I handle the RANGE command: RANGE <start> <end> [COUNT <n>]
+            # Keys from start (inclusive) to end (exclusive); "-" means unbounded
+            elif command == "RANGE":
+                words = line.split()[1:]
+                if len(words) not in (2, 4) or (len(words) == 4 and (
+                        words[2].upper() != "COUNT" or not words[3].isdigit())):
+                    return "Error: RANGE requires start end [COUNT n]"
+                start = None if words[0] == "-" else words[0]
+                end = None if words[1] == "-" else words[1]
+                limit = int(words[3]) if len(words) == 4 else None
+                pairs = self.scan(start, end)
+                lines = [f"{key} {value}" for key, value in itertools.islice(pairs, limit)]
+                return "\n".join(lines) if lines else "(empty)"
             
-            # I skip over the key bytes to get to the value
-            file_handle.seek(key_len, 1)  # I seek relative to current position
+            # I handle the STATS command (INFO is an alias): one "name=value"
+            # line per metric, with nested names joined by dots
+            elif command in ("STATS", "INFO"):
+                return "\n".join(f"{name}={value}" for name, value in _flatten(self.stats()))
             
-            # I read the actual value bytes
-            value_bytes = file_handle.read(entry.value_length)
-            if len(value_bytes) < entry.value_length:
-                raise IOError(f"Corrupted entry: incomplete value at offset {entry.offset}")
+            # I handle the SLOWLOG command: SLOWLOG GET [n] | SLOWLOG LEN | SLOWLOG RESET
+            elif command == "SLOWLOG":
+                words = line.split()[1:]
+                action = words[0].upper() if words else ""
+                if action == "GET" and (len(words) == 1 or (len(words) == 2 and words[1].isdigit())):
+                    entries = self.metrics.slowlog(int(words[1]) if len(words) == 2 else 10)
+                    lines = [f"{entry_id} {timestamp} {micros}us {name} {args}".rstrip()
+                             for entry_id, timestamp, micros, name, args in entries]
+                    return "\n".join(lines) if lines else "(empty)"
+                elif action == "LEN" and len(words) == 1:
+                    return str(self.metrics.slowlog_len())
+                elif action == "RESET" and len(words) == 1:
+                    self.metrics.slowlog_reset()
+                    return "OK"
+                return "Error: SLOWLOG requires GET [n], LEN or RESET"
             
-            # I decode the bytes back to string using UTF-8
-            try:
-                return value_bytes.decode('utf-8')
-            except UnicodeDecodeError as e:
-                raise IOError(f"Corrupted entry: invalid UTF-8 in value: {e}") from e
+            # I handle the PROFILE command: PROFILE ON [every] | PROFILE OFF | PROFILE DUMP [path]
+            # ON samples one in `every` (default 100) GET/SET/MSET/MGET calls with cProfile
+            elif command == "PROFILE":
+                words = line.split()[1:]
+                action = words[0].upper() if words else ""
+                if action == "ON" and (len(words) == 1 or (len(words) == 2 and words[1].isdigit())):
+                    try:
+                        self.metrics.start_profiling(int(words[1]) if len(words) == 2 else 100)
+                    except ValueError as e:
+                        return f"Error: {e}"
+                    return "OK"
+                elif action == "OFF" and len(words) == 1:
+                    self.metrics.stop_profiling()
+                    return "OK"
+                elif action == "DUMP" and len(words) <= 2:
+                    profiler = self.metrics.last_profiler
+                    if profiler is None:
+                        return "Error: Profiling has not been turned on"
+                    return profiler.report(path=words[1] if len(words) == 2 else None)
+                return "Error: PROFILE requires ON [every], OFF or DUMP [path]"
+            
+            # I handle the CACHE command: CACHE STATS | CACHE RESIZE <bytes>
+            elif command == "CACHE":
+                action = parts[1].upper() if len(parts) > 1 else ""
+                if action == "STATS":
+                    stats = self.cache_stats()
+                    return " ".join(f"{name}={value}" for name, value in stats.items())
+                elif action == "RESIZE" and len(parts) == 3 and parts[2].isdigit():
+                    self.resize_cache(int(parts[2]))
+                    return "OK"
+                else:
+                    return "Error: CACHE requires STATS or RESIZE <bytes>"
+            
+            # I handle the COMPACT command: I start a background merge
+            elif command == "COMPACT":
+                self.compact()
+                return "OK"
+            
+            # I handle IMPORT/EXPORT <path> [format]; the format defaults to
+            # one guessed from the file name
+            elif command in ("IMPORT", "EXPORT"):
+                # kv_bulk imports my record format, so I import it lazily
+                import kv_bulk
+                words = line.split()[1:]
+                if len(words) not in (1, 2) or words[0] == "-":
+                    return f"Error: {command} requires path [tsv|jsonl|native]"
+                fmt = words[1].lower() if len(words) == 2 else kv_bulk.guess_format(words[0])
+                if fmt not in kv_bulk.FORMATS:
+                    return f"Error: {command} requires path [tsv|jsonl|native]"
+                try:
+                    if command == "IMPORT":
+                        # A native file may be another store's log, with
+                        # values compressed against its dictionaries
+                        dictionaries = load_dictionaries(words[0]) if fmt == "native" else None
+                        with open(words[0], 'rb') as stream:
+                            return str(self.import_records(
+                                kv_bulk.read_records(stream, fmt, dictionaries)))
+                    with open(words[0], 'wb') as stream:
+                        return str(kv_bulk.write_records(stream, self.export_records(), fmt))
+                except (ValueError, IOError, OSError) as e:
+                    return f"Error: {e}"
+            
+            # I handle unknown commands
+            else:
+                return f"Error: Unknown command '{command}'"
         
-        except IOError as e:
-            # File read errors
-            print(f"Error: I cannot read value for key '{key}': {e}", 
-                  file=sys.stderr, flush=True)
-            return None
+        # I catch any other exceptions so one bad command can't end the session
+        except Exception as e:
+            return f"Error: Unexpected error: {e}"
+    
+    def execute_batch(self, lines: List[str]) -> List[str]:
+        """
+        Execute a batch of command lines and return their responses in order.
         
-        except OSError as e:
-            # Disk errors
-            print(f"Error: Disk error while I'm reading key '{key}': {e}", 
-                  file=sys.stderr, flush=True)
-            return None
+        I turn every run of consecutive SETs (without a TTL, which mset()
+        doesn't take) into one mset(), so a pipelined burst of writes costs
+        one write and one fsync. If the mset fails (for example one key is
+        too long) I fall back to running the SETs one by one, so each gets
+        its own response. Blank lines get no response, as with execute().
         
-        except Exception as e:
-            # Unexpected errors
-            print(f"Error: Unexpected error reading key '{key}': {e}", 
-                  file=sys.stderr, flush=True)
-            return None
+        Args:
+            lines: Command lines (EXIT is the caller's business)
+            
+        Returns:
+            One response per non-blank line
+        """
+        responses: List[str] = []
+        run: List[tuple] = []
         
-        finally:
-            # I ensure the file is always closed
-            if file_handle is not None:
+        def flush_sets() -> None:
+            if not run:
+                return
+            if len(run) > 1:
                 try:
-                    file_handle.close()
-                except Exception as e:
-                    print(f"Warning: Error closing file after read: {e}", 
-                          file=sys.stderr, flush=True)
+                    self.mset([(key, value) for _, key, value in run])
+                    responses.extend("OK" for _ in run)
+                    run.clear()
+                    return
+                except Exception:
+                    pass
+            responses.extend(self.execute(line) for line, _, _ in run)
+            run.clear()
+        
+        for line in lines:
+            parts = line.strip().split(None, 2)
+            if len(parts) == 3 and parts[0].upper() == "SET":
+                value, ttl_ms = _parse_set(parts[2])
+                if ttl_ms is None:
+                    run.append((line, parts[1], value))
+                    continue
+            flush_sets()
+            response = self.execute(line)
+            if response is not None:
+                responses.append(response)
+        flush_sets()
+        return responses
     
-    def run(self) -> None:
+    def run(self, pipelined: Optional[bool] = None) -> None:
         """
         Main CLI loop. I read from STDIN and write to STDOUT.
         
         This is how I implement a REPL (Read-Eval-Print Loop):
         1. I read a command from STDIN
-        2. I parse and validate the command
-        3. I execute the command
-        4. I print the result to STDOUT
-        5. I loop until EXIT or EOF
+        2. I parse, validate and execute it with execute()
+        3. I print the result to STDOUT
+        4. I loop until EXIT or EOF
         
-        Supported commands:
-        - SET <key> <value>: I store a key-value pair
-        - GET <key>: I retrieve the value for a key
-        - EXIT: I exit the program
+        See execute() for the supported commands; EXIT ends the loop.
         
         I use flush=True to ensure output is immediately sent to STDOUT,
         which is critical for piped communication (e.g., with Gradebot).
         
+        When STDIN is a pipe or file rather than a terminal I switch to
+        pipelined mode (see _run_pipelined): commands are read and answered
+        in batches instead of one line and one flushed print at a time.
+        
         Error Handling:
         - I report invalid commands but don't crash the program
         - I catch errors in SET/GET operations and report them
         - I handle keyboard interrupt (Ctrl+C) gracefully
+        
+        Args:
+            pipelined: Force pipelined mode on or off (default: on unless
+                STDIN is a terminal)
         """
+        if pipelined is None:
+            try:
+                pipelined = not os.isatty(sys.stdin.fileno())
+            except (AttributeError, OSError, ValueError):
+                # A stand-in stdin without a file descriptor (tests, IDEs)
+                pipelined = False
+        if pipelined:
+            self._run_pipelined()
+            return
+        
         # Main event loop - I continue until EXIT or EOF
         while True:
             try:
@@ -473,82 +4197,15 @@ class SimpleKVStore:
                 if not line:
                     break
                 
-                # I remove leading/trailing whitespace (including newline)
-                line = line.strip()
-                
-                # I skip empty lines
-                if not line:
-                    continue
-                
-                # I parse the command line
-                # split(None, 2) splits on whitespace, max 3 parts
-                # This allows values to contain spaces
-                # Example: "SET key my value" -> ["SET", "key", "my value"]
-                parts = line.split(None, 2)
-                
-                # I skip if nothing was parsed
-                if not parts:
-                    continue
-                
-                # I extract the command and convert to uppercase for case-insensitive matching
-                command = parts[0].upper()
-                
                 # I handle the EXIT command
-                if command == "EXIT":
+                if line.strip().upper() == "EXIT":
                     break
                 
-                # I handle the SET command: SET <key> <value>
-                elif command == "SET":
-                    # I validate: need exactly 3 parts (SET, key, value)
-                    if len(parts) < 3:
-                        print("Error: SET requires key and value", flush=True)
-                        continue
-                    
-                    # I extract the key (parts[1]) and value (parts[2])
-                    key = parts[1]
-                    value = parts[2]
-                    
-                    try:
-                        # I store the key-value pair
-                        self.set(key, value)
-                        
-                        # I send a success response to STDOUT
-                        # flush=True ensures immediate output (important for piped I/O)
-                        print("OK", flush=True)
-                    
-                    except (ValueError, IOError, OSError) as e:
-                        # I handle errors from my set() operation
-                        print(f"Error: {e}", flush=True)
-                
-                # I handle the GET command: GET <key>
-                elif command == "GET":
-                    # I validate: need exactly 2 parts (GET, key)
-                    if len(parts) < 2:
-                        print("Error: GET requires key", flush=True)
-                        continue
-                    
-                    # I extract the key
-                    key = parts[1]
-                    
-                    try:
-                        # I retrieve the value from my store
-                        value = self.get(key)
-                        
-                        # I print the result:
-                        # - If key exists, I print the value
-                        # - If key doesn't exist, I print "(nil)" (Redis convention)
-                        if value is None:
-                            print("(nil)", flush=True)
-                        else:
-                            print(value, flush=True)
-                    
-                    except ValueError as e:
-                        # I handle validation errors
-                        print(f"Error: {e}", flush=True)
+                response = self.execute(line)
                 
-                # I handle unknown commands
-                else:
-                    print(f"Error: Unknown command '{command}'", flush=True)
+                # I skip empty lines
+                if response is not None:
+                    print(response, flush=True)
             
             # I handle Ctrl+C gracefully
             except KeyboardInterrupt:
@@ -558,20 +4215,245 @@ class SimpleKVStore:
             # This prevents my program from crashing on unexpected errors
             except Exception as e:
                 print(f"Error: Unexpected error: {e}", flush=True)
+    
+    def _run_pipelined(self) -> None:
+        """
+        The REPL for piped input: read big chunks, answer in batches.
+        
+        os.read() returns whatever STDIN has right now (up to 1MB), blocking
+        only when nothing is there. Every complete line in that chunk is one
+        batch for execute_batch(), which merges consecutive SETs into one
+        durable write, and the batch's responses leave in a single write.
+        So I flush exactly when I'm about to wait for more input: a client
+        that streams thousands of commands gets few large writes, and one
+        typing a command at a time still gets each answer right away.
+        Responses are always in command order.
+        """
+        fd = sys.stdin.fileno()
+        out = sys.stdout
+        pending = b""
+        while True:
+            try:
+                data = os.read(fd, 1024 * 1024)
+            except KeyboardInterrupt:
+                break
+            if data:
+                lines, pending = _split_batch(pending + data)
+            else:
+                # EOF: a last line without a newline still counts
+                lines, pending = ([pending.decode('utf-8', 'replace')] if pending else []), b""
+            
+            exiting = not data
+            for position, line in enumerate(lines):
+                if line.strip().upper() == "EXIT":
+                    lines = lines[:position]
+                    exiting = True
+                    break
+            
+            if lines:
+                try:
+                    responses = self.execute_batch(lines)
+                except Exception as e:
+                    responses = [f"Error: Unexpected error: {e}"]
+                if responses:
+                    out.write("\n".join(responses) + "\n")
+                    out.flush()
+            if exiting:
+                break
+
+
+def _split_batch(data: bytes) -> Tuple[List[str], bytes]:
+    """
+    Split buffered input into complete command lines and the unfinished rest.
+    """
+    cut = data.rfind(b"\n")
+    if cut < 0:
+        return [], data
+    return data[:cut].decode('utf-8', 'replace').split("\n"), data[cut + 1:]
+
+
+def _parse_set(value: str) -> Tuple[str, Optional[int]]:
+    """
+    Split the value of a SET command line from its expiry option.
+    
+    A value ending in "EX <seconds>" or "PX <milliseconds>" sets a TTL, so
+    such a value can't be stored literally with SET (MSET still can).
+    
+    Returns:
+        (value, ttl_ms), where ttl_ms is None without an expiry option
+    """
+    words = value.rsplit(None, 2)
+    if len(words) == 3 and words[1].upper() in ("EX", "PX") and words[2].isdigit():
+        ttl_ms = int(words[2])
+        return words[0], ttl_ms * 1000 if words[1].upper() == "EX" else ttl_ms
+    return value, None
+
+
+def _flatten(stats: Dict[str, object], prefix: str = ""):
+    """
+    Yield (dotted name, value) for every leaf of a nested stats dictionary.
+    """
+    for name, value in stats.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{name}.")
+        elif isinstance(value, float):
+            yield f"{prefix}{name}", f"{value:.6g}"
+        else:
+            yield f"{prefix}{name}", value
+
+
+def _arg_parser(description: str = "Simple persistent key-value store") -> argparse.ArgumentParser:
+    """
+    Build the command line parser for the store options.
+    
+    Every option has a default that matches the original behavior, so
+    running "python kv_store.py" with no arguments works exactly as before.
+    kv_server.py adds its own network options on top of these.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--data-file", default="data.db",
+                        help="Path to the append-only log, or the store directory "
+                             "with --engine lsm (default: data.db)")
+    parser.add_argument("--engine", choices=["log", "lsm"], default="log",
+                        help="Storage engine: log keeps every key in memory, lsm keeps "
+                             "sorted tables on disk for data sets larger than memory "
+                             "(kv_lsm.py; the log, cache and index options don't apply)")
+    parser.add_argument("--durability", choices=DURABILITY_MODES, default=DURABILITY_ALWAYS,
+                        help="fsync policy for SET (default: always)")
+    parser.add_argument("--group-commit-wait-ms", type=float, default=0.0,
+                        help="Max time a group commit waits for its batch to fill")
+    parser.add_argument("--group-commit-batch", type=int, default=256,
+                        help="Max records per group commit")
+    parser.add_argument("--fsync-interval-ms", type=float, default=10.0,
+                        help="fsync period for periodic durability")
+    parser.add_argument("--read-mode", choices=READ_MODES, default=READ_MODE_PREAD,
+                        help="How GET reads values from the log (default: pread)")
+    parser.add_argument("--no-hint", action="store_true",
+                        help="Don't load or write the index snapshot (.hint) file")
+    parser.add_argument("--lazy-recovery", action="store_true",
+                        help="Serve right away and replay the log in the background")
+    parser.add_argument("--segment-size", type=int, default=None,
+                        help="Roll the log over to a new segment file at this many bytes")
+    parser.add_argument("--cache-bytes", type=int, default=0,
+                        help="Size of the in-memory value cache (default: off)")
+    parser.add_argument("--cache-policy", choices=sorted(CACHE_POLICIES), default="lru",
+                        help="Value cache eviction policy (default: lru)")
+    parser.add_argument("--index-engine", choices=sorted(INDEX_ENGINES), default="dict",
+                        help="In-memory index structure (default: dict)")
+    parser.add_argument("--slowlog-threshold-ms", type=float, default=10.0,
+                        help="Log operations at least this slow to SLOWLOG (default: 10)")
+    parser.add_argument("--compression", choices=COMPRESSIONS, default=None,
+                        help="Compress new values with this codec (default: off)")
+    parser.add_argument("--compression-min-bytes", type=int, default=64,
+                        help="Store values shorter than this uncompressed (default: 64)")
+    parser.add_argument("--train-dictionary", type=int, default=0, metavar="SAMPLES",
+                        help="On startup, train a compression dictionary from this many "
+                             "stored values (needs --compression)")
+    return parser
+
+
+def _bulk(store: SimpleKVStore, args: argparse.Namespace) -> None:
+    """
+    Run --import / --export instead of the REPL ("-" is stdin/stdout).
+    """
+    import kv_bulk
+    path = args.import_path or args.export_path
+    fmt = args.format or kv_bulk.guess_format(path)
+    started = time.perf_counter()
+    if args.import_path:
+        dictionaries = load_dictionaries(path) if fmt == "native" and path != "-" else None
+        stream = kv_bulk.open_input(path)
+        try:
+            count = store.import_records(kv_bulk.read_records(stream, fmt, dictionaries))
+        finally:
+            if path != "-":
+                stream.close()
+        verb = "Imported"
+    else:
+        stream = kv_bulk.open_output(path)
+        try:
+            count = kv_bulk.write_records(stream, store.export_records(), fmt)
+        finally:
+            if path != "-":
+                stream.close()
+        verb = "Exported"
+    elapsed = time.perf_counter() - started
+    print(f"{verb} {count} records in {elapsed:.2f}s "
+          f"({count / elapsed if elapsed else 0:.0f} records/s)", file=sys.stderr, flush=True)
+
+
+def _parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse command line options.
+    """
+    parser = _arg_parser()
+    bulk = parser.add_mutually_exclusive_group()
+    bulk.add_argument("--import", dest="import_path", metavar="PATH",
+                      help="Bulk-load records from PATH ('-' for stdin) and exit")
+    bulk.add_argument("--export", dest="export_path", metavar="PATH",
+                      help="Write every live key to PATH ('-' for stdout) and exit")
+    parser.add_argument("--format", choices=["tsv", "jsonl", "native"],
+                        help="Format for --import/--export (default: from the file name, else tsv)")
+    return parser.parse_args(argv)
+
+
+def _open_store(args: argparse.Namespace) -> SimpleKVStore:
+    """
+    Create a store from parsed command line options.
+    """
+    if args.engine == "lsm":
+        from kv_lsm import LSMKVStore
+        return LSMKVStore(args.data_file, slowlog_threshold_ms=args.slowlog_threshold_ms)
+    store = SimpleKVStore(args.data_file,
+                          durability=args.durability,
+                          group_commit_max_wait_ms=args.group_commit_wait_ms,
+                          group_commit_max_batch=args.group_commit_batch,
+                          fsync_interval_ms=args.fsync_interval_ms,
+                          read_mode=args.read_mode,
+                          use_hint=not args.no_hint,
+                          segment_max_bytes=args.segment_size,
+                          cache_bytes=args.cache_bytes,
+                          cache_policy=args.cache_policy,
+                          index_engine=args.index_engine,
+                          slowlog_threshold_ms=args.slowlog_threshold_ms,
+                          lazy_recovery=args.lazy_recovery,
+                          compression=args.compression,
+                          compression_min_bytes=args.compression_min_bytes)
+    if args.train_dictionary:
+        try:
+            number = store.train_dictionary(args.train_dictionary)
+        except BaseException:
+            store.close()
+            raise
+        if number is None:
+            print("Warning: the stored values share too little for a compression dictionary",
+                  file=sys.stderr, flush=True)
+        else:
+            print(f"Trained compression dictionary {number}", file=sys.stderr, flush=True)
+    return store
 
 
 # Entry point: I only run this if the file is executed directly (not imported)
 if __name__ == "__main__":
+    args = _parse_args()
+    store = None
     try:
         # I create an instance of my key-value store
-        # I use the default data file "data.db"
-        store = SimpleKVStore()
+        store = _open_store(args)
         
-        # I start the CLI loop
-        # This will run until I receive EXIT command or EOF
-        store.run()
+        if args.import_path or args.export_path:
+            _bulk(store, args)
+        else:
+            # I start the CLI loop
+            # This will run until I receive EXIT command or EOF
+            store.run()
     
     except Exception as e:
         # I catch any initialization errors
         print(f"Fatal error: {e}", file=sys.stderr, flush=True)
         sys.exit(1)
+    
+    finally:
+        # I flush queued writes and close the log before exiting
+        if store is not None:
+            store.close()